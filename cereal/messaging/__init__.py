@@ -6,9 +6,11 @@ from msgq import fake_event_handle, pub_sock, sub_sock, drain_sock_raw, context
 
 import os
 import capnp
+import heapq
 import time
+import numpy as np
 
-from typing import Optional, List, Union, Dict, Deque
+from typing import Any, Optional, List, Union, Dict, Deque, Tuple
 from collections import deque
 
 from cereal import log
@@ -29,7 +31,8 @@ def new_message(service: Optional[str], size: Optional[int] = None, **kwargs) ->
     **kwargs
   }
   dat = log.Event.new_message(**args)
-  if service is not None:
+  # a service given in kwargs is copied in as is, initializing it first would leave an unused struct in the message
+  if service is not None and service not in kwargs:
     if size is None:
       dat.init(service)
     else:
@@ -87,6 +90,40 @@ def recv_one_retry(sock: SubSocket) -> capnp.lib.capnp._DynamicStructReader:
       return log_from_bytes(dat)
 
 
+class FrequencyTracker:
+  """Average frequency of received messages over a full and a recent window, kept as running sums"""
+  def __init__(self, maxlen: int):
+    self.dts: Deque[float] = deque(maxlen=maxlen)
+    self.recent_dts: Deque[float] = deque(maxlen=int(maxlen / 10) or maxlen)
+    self.dts_sum = 0.
+    self.recent_dts_sum = 0.
+    self.cnt = 0
+
+  def add(self, dt: float) -> None:
+    if len(self.dts) == self.dts.maxlen:
+      self.dts_sum -= self.dts[0]
+    if len(self.recent_dts) == self.recent_dts.maxlen:
+      self.recent_dts_sum -= self.recent_dts[0]
+    self.dts.append(dt)
+    self.recent_dts.append(dt)
+    self.dts_sum += dt
+    self.recent_dts_sum += dt
+
+    # resync once per window, so rounding errors don't accumulate
+    self.cnt += 1
+    if self.cnt % len(self.dts) == 0:
+      self.dts_sum = sum(self.dts)
+      self.recent_dts_sum = sum(self.recent_dts)
+
+  @property
+  def avg_freq(self) -> float:
+    return len(self.dts) / self.dts_sum if self.dts_sum != 0 else 0
+
+  @property
+  def recent_avg_freq(self) -> float:
+    return len(self.recent_dts) / self.recent_dts_sum if self.recent_dts_sum != 0 else 0
+
+
 class SubMaster:
   def __init__(self, services: List[str], poll: Optional[str] = None,
                ignore_alive: Optional[List[str]] = None, ignore_avg_freq: Optional[List[str]] = None,
@@ -98,9 +135,14 @@ class SubMaster:
     self.recv_frame = {s: 0 for s in services}
     self.alive = {s: False for s in services}
     self.freq_ok = {s: False for s in services}
-    self.recv_dts: Dict[str, Deque[float]] = {}
+    self.recv_freq: Dict[str, FrequencyTracker] = {}
+    # (time, service) at which a service is no longer alive unless received again, stale entries are skipped
+    self.alive_deadlines: List[Tuple[float, str]] = []
+    self.alive_deadline: Dict[str, float] = {}
     self.sock = {}
     self.data = {}
+    # values derived from the latest message of each service, dropped when a new one is received
+    self.field_cache: Dict[str, Dict[Tuple[str, str], Any]] = {s: {} for s in services}
     self.valid = {}
     self.logMonoTime = {}
 
@@ -148,11 +190,33 @@ class SubMaster:
           min_freq = min(freq, freq / 2.)
       self.max_freq[s] = max_freq*1.2
       self.min_freq[s] = min_freq*0.8
-      self.recv_dts[s] = deque(maxlen=int(10*freq))
+      self.recv_freq[s] = FrequencyTracker(int(10*freq))
 
   def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
     return self.data[s]
 
+  def get_field(self, s: str, field: str) -> Any:
+    """Field of a service's latest message given by a dotted path (e.g. 'meta.laneChangeState'), traversed once per message"""
+    cache = self.field_cache[s]
+    key = ('field', field)
+    if key not in cache:
+      value = self.data[s]
+      for name in field.split('.'):
+        value = getattr(value, name)
+      cache[key] = value
+    return cache[key]
+
+  def get_array(self, s: str, field: str) -> np.ndarray:
+    """Numeric list field of a service's latest message as a read-only array, converted once per message"""
+    cache = self.field_cache[s]
+    key = ('array', field)
+    arr: Optional[np.ndarray] = cache.get(key)
+    if arr is None:
+      arr = np.array(self.get_field(s, field), dtype=np.float64)
+      arr.flags.writeable = False
+      cache[key] = arr
+    return arr
+
   def _check_avg_freq(self, s: str) -> bool:
     return SERVICE_LIST[s].frequency > 0.99 and (s not in self.ignore_average_freq) and (s not in self.ignore_alive)
 
@@ -178,31 +242,30 @@ class SubMaster:
       self.updated[s] = True
 
       if self.recv_time[s] > 1e-5:
-        self.recv_dts[s].append(cur_time - self.recv_time[s])
+        self.recv_freq[s].add(cur_time - self.recv_time[s])
       self.recv_time[s] = cur_time
       self.recv_frame[s] = self.frame
       self.data[s] = getattr(msg, s)
       self.logMonoTime[s] = msg.logMonoTime
       self.valid[s] = msg.valid
+      self.field_cache[s].clear()
 
-    for s in self.data:
+    # alive and freq_ok only change for services just received, or whose alive deadline passed
+    if self.frame == 0:
+      services = list(self.data)
+    else:
+      services = [s for s, updated in self.updated.items() if updated]
+    for s in services:
       if SERVICE_LIST[s].frequency > 1e-5 and not self.simulation:
         # alive if delay is within 10x the expected frequency
-        self.alive[s] = (cur_time - self.recv_time[s]) < (10. / SERVICE_LIST[s].frequency)
+        self.alive_deadline[s] = self.recv_time[s] + 10. / SERVICE_LIST[s].frequency
+        self.alive[s] = cur_time < self.alive_deadline[s]
+        if self.alive[s]:
+          heapq.heappush(self.alive_deadlines, (self.alive_deadline[s], s))
 
         # check average frequency; slow to fall, quick to recover
-        dts = self.recv_dts[s]
-        assert dts.maxlen is not None
-        recent_dts = list(dts)[-int(dts.maxlen / 10):]
-        try:
-          avg_freq = 1 / (sum(dts) / len(dts))
-          avg_freq_recent = 1 / (sum(recent_dts) / len(recent_dts))
-        except ZeroDivisionError:
-          avg_freq = 0
-          avg_freq_recent = 0
-
-        avg_freq_ok = self.min_freq[s] <= avg_freq <= self.max_freq[s]
-        recent_freq_ok = self.min_freq[s] <= avg_freq_recent <= self.max_freq[s]
+        avg_freq_ok = self.min_freq[s] <= self.recv_freq[s].avg_freq <= self.max_freq[s]
+        recent_freq_ok = self.min_freq[s] <= self.recv_freq[s].recent_avg_freq <= self.max_freq[s]
         self.freq_ok[s] = avg_freq_ok or recent_freq_ok
       else:
         self.freq_ok[s] = True
@@ -211,6 +274,11 @@ class SubMaster:
         else:
           self.alive[s] = True
 
+    while len(self.alive_deadlines) and self.alive_deadlines[0][0] <= cur_time:
+      deadline, s = heapq.heappop(self.alive_deadlines)
+      if deadline == self.alive_deadline[s]:
+        self.alive[s] = False
+
   def all_alive(self, service_list: Optional[List[str]] = None) -> bool:
     if service_list is None:
       service_list = list(self.sock.keys())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import os
+import time
+
+import cereal.messaging as messaging
+from cereal import car, log
+
+N = int(os.getenv("N", "20000"))
+
+
+def car_state():
+  CS = car.CarState.new_message(vEgo=20., aEgo=0.5, steeringAngleDeg=3., canValid=True)
+  CS.cruiseState.enabled = True
+  CS.init('buttonEvents', 2)
+  CS.init('events', 3)
+  return CS
+
+
+def car_control():
+  CC = car.CarControl.new_message(enabled=True, latActive=True, longActive=True)
+  CC.actuators.accel = 0.5
+  CC.actuators.steer = 0.1
+  CC.orientationNED = [0.1, 0.2, 0.3]
+  CC.angularVelocity = [0.1, 0.2, 0.3]
+  CC.hudControl.setSpeed = 30.
+  return CC
+
+
+def actuators_output():
+  return car.CarControl.Actuators.new_message(accel=0.5, steer=0.1)
+
+
+def pid_state():
+  return log.ControlsState.LateralPIDState.new_message(active=True, p=0.1, i=0.2, f=0.3, output=0.6)
+
+
+def init_then_copy(service, payload):
+  msg = messaging.new_message(service)
+  msg.valid = True
+  setattr(msg, service, payload)
+  return msg
+
+
+def copy_in_new_message(service, payload):
+  return messaging.new_message(service, valid=True, **{service: payload})
+
+
+def car_output(build):
+  # carOutput is built in place, only its actuators are copied
+  msg = messaging.new_message('carOutput', valid=True)
+  msg.carOutput.actuatorsOutput = build
+  return msg
+
+
+def controls_state(build):
+  msg = messaging.new_message('controlsState', valid=True)
+  msg.controlsState.enabled = True
+  msg.controlsState.curvature = 0.01
+  msg.controlsState.lateralControlState.pidState = build
+  return msg
+
+
+def benchmark(build, payload):
+  # everything PubMaster.send does before handing the bytes to the socket
+  t = time.perf_counter()
+  for _ in range(N):
+    dat = build(payload).to_bytes()
+  return (time.perf_counter() - t) / N, len(dat)
+
+
+if __name__ == "__main__":
+  cases = [
+    ("carState", car_state()),
+    ("carControl", car_control()),
+  ]
+  for service, payload in cases:
+    for name, build in [("init, then copy", init_then_copy), ("copy in new_message", copy_in_new_message)]:
+      dt, size = benchmark(lambda p, build=build, service=service: build(service, p), payload)
+      print(f"{service:>14} {name:>20}: {dt * 1e6:6.2f} us, {size:4d} bytes per publish")
+
+  for service, build_in_place, payload in [("carOutput", car_output, actuators_output()), ("controlsState", controls_state, pid_state())]:
+    dt, size = benchmark(build_in_place, payload)
+    print(f"{service:>14} {'built in place':>20}: {dt * 1e6:6.2f} us, {size:4d} bytes per publish")
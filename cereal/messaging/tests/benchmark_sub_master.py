@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import capnp
+import os
+import time
+from collections import deque
+
+import cereal.messaging as messaging
+from cereal.services import SERVICE_LIST
+
+FRAMES = int(os.getenv("FRAMES", "10000"))
+FREQUENCY = 100.
+
+# controlsd's subscriptions
+SERVICES = ['deviceState', 'pandaStates', 'peripheralState', 'modelV2', 'liveCalibration',
+            'carOutput', 'driverMonitoringState', 'longitudinalPlan', 'liveLocationKalman',
+            'managerState', 'liveParameters', 'radarState', 'liveTorqueParameters', 'testJoystick',
+            'roadCameraState', 'driverCameraState', 'wideRoadCameraState', 'accelerometer', 'gyroscope']
+
+
+class RecomputingSubMaster(messaging.SubMaster):
+  """Checks every service's liveness and average frequency on every update, from the full history of receive times"""
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.recv_dts = {s: deque(maxlen=tracker.dts.maxlen) for s, tracker in self.recv_freq.items()}
+
+  def update_msgs(self, cur_time, msgs):
+    self.frame += 1
+    self.updated = dict.fromkeys(self.updated, False)
+    for msg in msgs:
+      if msg is None:
+        continue
+
+      s = msg.which()
+      self.seen[s] = True
+      self.updated[s] = True
+      if self.recv_time[s] > 1e-5:
+        self.recv_dts[s].append(cur_time - self.recv_time[s])
+      self.recv_time[s] = cur_time
+      self.recv_frame[s] = self.frame
+      self.data[s] = getattr(msg, s)
+      self.logMonoTime[s] = msg.logMonoTime
+      self.valid[s] = msg.valid
+
+    for s in self.data:
+      if SERVICE_LIST[s].frequency > 1e-5 and not self.simulation:
+        self.alive[s] = (cur_time - self.recv_time[s]) < (10. / SERVICE_LIST[s].frequency)
+        dts = self.recv_dts[s]
+        recent_dts = list(dts)[-int(dts.maxlen / 10):]
+        try:
+          avg_freq = 1 / (sum(dts) / len(dts))
+          avg_freq_recent = 1 / (sum(recent_dts) / len(recent_dts))
+        except ZeroDivisionError:
+          avg_freq = 0
+          avg_freq_recent = 0
+        self.freq_ok[s] = self.min_freq[s] <= avg_freq <= self.max_freq[s] or self.min_freq[s] <= avg_freq_recent <= self.max_freq[s]
+      else:
+        self.freq_ok[s] = True
+        self.alive[s] = self.seen[s] if self.simulation else True
+
+
+def messages_per_frame():
+  # each service is received at its own rate, in a 100Hz loop
+  msgs = {}
+  for s in SERVICES:
+    try:
+      msgs[s] = messaging.new_message(s).as_reader()
+    except capnp.lib.capnp.KjException:
+      msgs[s] = messaging.new_message(s, 1).as_reader()
+
+  frames = []
+  for i in range(FRAMES):
+    frames.append([msg for s, msg in msgs.items()
+                   if SERVICE_LIST[s].frequency > 0 and i % max(1, round(FREQUENCY / SERVICE_LIST[s].frequency)) == 0])
+  return frames
+
+
+def benchmark(sm, frames):
+  t = time.perf_counter()
+  for i, msgs in enumerate(frames):
+    sm.update_msgs(1. + i / FREQUENCY, msgs)
+    sm.all_checks()
+  return (time.perf_counter() - t) / len(frames)
+
+
+if __name__ == "__main__":
+  frames = messages_per_frame()
+  print(f"{len(SERVICES)} services, {sum(len(f) for f in frames) / len(frames):.1f} msgs per update at {FREQUENCY:.0f}Hz")
+  for name, cls in [("recomputing", RecomputingSubMaster), ("incremental", messaging.SubMaster)]:
+    sm = cls(SERVICES, frequency=FREQUENCY)
+    print(f"{name:>12}: {benchmark(sm, frames) * 1e6:6.1f} us per update")
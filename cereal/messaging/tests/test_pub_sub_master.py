@@ -96,6 +96,21 @@ class TestSubMaster(unittest.TestCase):
         else:
           assert not sm._check_avg_freq(service)
 
+  def test_field_cache(self):
+    sock = "liveLocationKalman"
+    sm = messaging.SubMaster([sock,])
+    for i in range(3):
+      msg = messaging.new_message(sock)
+      msg.liveLocationKalman.calibratedOrientationNED.value = [i, i + 1, i + 2]
+      msg.liveLocationKalman.gpsOK = bool(i % 2)
+      sm.update_msgs(time.monotonic(), [msg.as_reader()])
+
+      value = sm.get_array(sock, "calibratedOrientationNED.value")
+      self.assertEqual(value.tolist(), [i, i + 1, i + 2])
+      self.assertFalse(value.flags.writeable)
+      self.assertIs(value, sm.get_array(sock, "calibratedOrientationNED.value"))
+      self.assertEqual(sm.get_field(sock, "gpsOK"), bool(i % 2))
+
   def test_alive(self):
     pass
 
@@ -120,9 +120,7 @@ class Car:
 
     # carParams - logged every 50 seconds (> 1 per segment)
     if self.sm.frame % int(50. / DT_CTRL) == 0:
-      cp_send = messaging.new_message('carParams')
-      cp_send.valid = True
-      cp_send.carParams = self.CP
+      cp_send = messaging.new_message('carParams', valid=True, carParams=self.CP)
       self.pm.send('carParams', cp_send)
 
     # publish new carOutput
@@ -132,9 +130,7 @@ class Car:
     self.pm.send('carOutput', co_send)
 
     # kick off controlsd step while we actuate the latest carControl packet
-    cs_send = messaging.new_message('carState')
-    cs_send.valid = CS.canValid
-    cs_send.carState = CS
+    cs_send = messaging.new_message('carState', valid=CS.canValid, carState=CS)
     cs_send.carState.canErrorCounter = self.can_rcv_cum_timeout_counter
     cs_send.carState.cumLagMs = -self.rk.remaining * 1000.
     self.pm.send('carState', cs_send)
@@ -25,6 +25,43 @@ def is_valid_for_fingerprint(msg, car_fingerprint: dict[int, int]):
   return (adr in car_fingerprint and car_fingerprint[adr] == len(msg.dat)) or adr >= 0x800
 
 
+def _build_fingerprint_index(fingerprints: dict[str, list[dict[int, int]]]) -> tuple[list[str], dict[int, dict[int, int]]]:
+  """Builds an inverted index from each address and message length to the set of cars with a fingerprint containing
+     it. Sets of cars are bitsets, car i of the returned list is bit i.
+  """
+  cars = list(fingerprints)
+  index: dict[int, dict[int, int]] = {}
+  for i, car_name in enumerate(cars):
+    for fingerprint in fingerprints[car_name]:
+      for address, length in (fingerprint | _DEBUG_ADDRESS).items():
+        lengths = index.setdefault(address, {})
+        lengths[length] = lengths.get(length, 0) | (1 << i)
+  return cars, index
+
+
+_LEGACY_FINGERPRINT_CARS, _FINGERPRINT_INDEX = _build_fingerprint_index(_FINGERPRINTS)
+_LEGACY_FINGERPRINT_CAR_BITS = {car_name: 1 << i for i, car_name in enumerate(_LEGACY_FINGERPRINT_CARS)}
+_ALL_LEGACY_FINGERPRINT_CARS_MASK = (1 << len(_LEGACY_FINGERPRINT_CARS)) - 1
+
+
+def compatible_cars_mask(address: int, length: int) -> int:
+  """Returns the bitset of cars that could have sent a message with this address and length."""
+  # ignore addresses that are more than 11 bits
+  if address >= 0x800:
+    return _ALL_LEGACY_FINGERPRINT_CARS_MASK
+  return _FINGERPRINT_INDEX.get(address, {}).get(length, 0)
+
+
+def cars_from_mask(mask: int) -> list[str]:
+  """Returns the cars in a bitset of cars."""
+  cars = []
+  while mask:
+    bit = mask & -mask
+    cars.append(_LEGACY_FINGERPRINT_CARS[bit.bit_length() - 1])
+    mask ^= bit
+  return cars
+
+
 def eliminate_incompatible_cars(msg, candidate_cars):
   """Removes cars that could not have sent msg.
 
@@ -35,18 +72,8 @@ def eliminate_incompatible_cars(msg, candidate_cars):
      Returns:
       A list containing the subset of candidate_cars that could have sent msg.
   """
-  compatible_cars = []
-
-  for car_name in candidate_cars:
-    car_fingerprints = _FINGERPRINTS[car_name]
-
-    for fingerprint in car_fingerprints:
-      # add alien debug address
-      if is_valid_for_fingerprint(msg, fingerprint | _DEBUG_ADDRESS):
-        compatible_cars.append(car_name)
-        break
-
-  return compatible_cars
+  mask = compatible_cars_mask(msg.address, len(msg.dat))
+  return [car_name for car_name in candidate_cars if _LEGACY_FINGERPRINT_CAR_BITS[car_name] & mask]
 
 
 def all_known_cars():
@@ -59,6 +86,11 @@ def all_legacy_fingerprint_cars():
   return list(_FINGERPRINTS.keys())
 
 
+def all_legacy_fingerprint_cars_mask() -> int:
+  """Returns the bitset of all known cars, FPv1 only."""
+  return _ALL_LEGACY_FINGERPRINT_CARS_MASK
+
+
 # A dict that maps old platform strings to their latest representations
 MIGRATION = {
   "ACURA ILX 2016 ACURAWATCH PLUS": HONDA.ACURA_ILX,
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from collections import defaultdict
 from collections.abc import Iterator
+from functools import cache
 from typing import Any, Protocol, TypeVar
 
 from tqdm import tqdm
@@ -48,25 +49,32 @@ def build_fw_dict(fw_versions: list[capnp.lib.capnp._DynamicStructBuilder], filt
   return dict(fw_versions_dict)
 
 
-class MatchFwToCar(Protocol):
-  def __call__(self, live_fw_versions: LiveFwVersions, match_brand: str = None, log: bool = True) -> set[str]:
-    ...
+def build_fw_dicts(fw_versions: list[capnp.lib.capnp._DynamicStructBuilder]) -> dict[str, dict[AddrType, set[bytes]]]:
+  """Returns build_fw_dict of each brand, reading fw_versions once"""
+  fw_versions_dicts: defaultdict[str, defaultdict[AddrType, set[bytes]]] = defaultdict(lambda: defaultdict(set))
+  for fw in fw_versions:
+    if not fw.logging:
+      sub_addr = fw.subAddress
+      fw_versions_dicts[fw.brand][(fw.address, sub_addr if sub_addr != 0 else None)].add(fw.fwVersion)
+  return {brand: dict(fw_versions_dict) for brand, fw_versions_dict in fw_versions_dicts.items()}
 
 
-def match_fw_to_car_fuzzy(live_fw_versions: LiveFwVersions, match_brand: str = None, log: bool = True, exclude: str = None) -> set[str]:
-  """Do a fuzzy FW match. This function will return a match, and the number of firmware version
-  that were matched uniquely to that specific car. If multiple ECUs uniquely match to different cars
-  the match is rejected."""
+# Lookup tables from the offline FW versions, built once per brand. A brand of None includes all brands
+
+# (addr, sub_addr, fw) to the cars with this FW response on the address
+FuzzyFwTable = dict[tuple[int, int | None, bytes], tuple[str, ...]]
+
+# (car, ECUs to check) per car, with each ECU as (ecu type, (addr, sub_addr), expected versions, required if missing)
+ExactFwTable = list[tuple[str, list[tuple[int, AddrType, frozenset[bytes], bool]]]]
+
 
-  # Build lookup table from (addr, sub_addr, fw) to list of candidate cars
+@cache
+def get_fuzzy_fw_table(match_brand: str | None) -> FuzzyFwTable:
   all_fw_versions = defaultdict(list)
   for candidate, fw_by_addr in FW_VERSIONS.items():
     if not is_brand(MODEL_TO_BRAND[candidate], match_brand):
       continue
 
-    if candidate == exclude:
-      continue
-
     for addr, fws in fw_by_addr.items():
       # These ECUs are known to be shared between models (EPS only between hybrid/ICE version)
       # Getting this exactly right isn't crucial, but excluding camera and radar makes it almost
@@ -76,6 +84,44 @@ def match_fw_to_car_fuzzy(live_fw_versions: LiveFwVersions, match_brand: str = N
         continue
       for f in fws:
         all_fw_versions[(addr[1], addr[2], f)].append(candidate)
+  return {k: tuple(v) for k, v in all_fw_versions.items()}
+
+
+@cache
+def get_exact_fw_table(match_brand: str | None) -> ExactFwTable:
+  table = []
+  for candidate, fws in FW_VERSIONS.items():
+    if not is_brand(MODEL_TO_BRAND[candidate], match_brand):
+      continue
+
+    config = FW_QUERY_CONFIGS[MODEL_TO_BRAND[candidate]]
+    ecus = []
+    for (ecu_type, addr, sub_addr), expected_versions in fws.items():
+      # Virtual debug ecu doesn't need to match the database
+      if ecu_type == Ecu.debug:
+        continue
+
+      # Some models can sometimes miss an ecu, or show on two different addresses
+      # FIXME: this logic can be improved to be more specific, should require one of the two addresses
+      # Non essential ecus are ignored if missing
+      required = candidate not in config.non_essential_ecus.get(ecu_type, []) and ecu_type in ESSENTIAL_ECUS
+      ecus.append((ecu_type, (addr, sub_addr), frozenset(expected_versions), required))
+    table.append((candidate, ecus))
+  return table
+
+
+class MatchFwToCar(Protocol):
+  def __call__(self, live_fw_versions: LiveFwVersions, match_brand: str = None, log: bool = True) -> set[str]:
+    ...
+
+
+def match_fw_to_car_fuzzy(live_fw_versions: LiveFwVersions, match_brand: str = None, log: bool = True, exclude: str = None) -> set[str]:
+  """Do a fuzzy FW match. This function will return a match, and the number of firmware version
+  that were matched uniquely to that specific car. If multiple ECUs uniquely match to different cars
+  the match is rejected."""
+
+  # Lookup table from (addr, sub_addr, fw) to candidate cars
+  all_fw_versions = get_fuzzy_fw_table(match_brand)
 
   matched_ecus = set()
   match: str | None = None
@@ -83,7 +129,9 @@ def match_fw_to_car_fuzzy(live_fw_versions: LiveFwVersions, match_brand: str = N
     ecu_key = (addr[0], addr[1])
     for version in versions:
       # All cars that have this FW response on the specified address
-      candidates = all_fw_versions[(*ecu_key, version)]
+      candidates = all_fw_versions.get((*ecu_key, version), ())
+      if exclude is not None:
+        candidates = tuple(c for c in candidates if c != exclude)
 
       if len(candidates) == 1:
         matched_ecus.add(ecu_key)
@@ -111,37 +159,22 @@ def match_fw_to_car_exact(live_fw_versions: LiveFwVersions, match_brand: str = N
   if extra_fw_versions is None:
     extra_fw_versions = {}
 
-  invalid = set()
-  candidates = {c: f for c, f in FW_VERSIONS.items() if
-                is_brand(MODEL_TO_BRAND[c], match_brand)}
-
-  for candidate, fws in candidates.items():
-    config = FW_QUERY_CONFIGS[MODEL_TO_BRAND[candidate]]
-    for ecu, expected_versions in fws.items():
-      expected_versions = expected_versions + extra_fw_versions.get(candidate, {}).get(ecu, [])
-      ecu_type = ecu[0]
-      addr = ecu[1:]
-
-      found_versions = live_fw_versions.get(addr, set())
-      if not len(found_versions):
-        # Some models can sometimes miss an ecu, or show on two different addresses
-        # FIXME: this logic can be improved to be more specific, should require one of the two addresses
-        if candidate in config.non_essential_ecus.get(ecu_type, []):
-          continue
-
-        # Ignore non essential ecus
-        if ecu_type not in ESSENTIAL_ECUS:
-          continue
-
-      # Virtual debug ecu doesn't need to match the database
-      if ecu_type == Ecu.debug:
+  matches = set()
+  for candidate, ecus in get_exact_fw_table(match_brand):
+    extra_versions = extra_fw_versions.get(candidate, {})
+    for ecu_type, addr, expected_versions, required in ecus:
+      found_versions = live_fw_versions.get(addr)
+      if not found_versions:
+        if required:
+          break
         continue
 
-      if not any(found_version in expected_versions for found_version in found_versions):
-        invalid.add(candidate)
+      if found_versions.isdisjoint(expected_versions) and found_versions.isdisjoint(extra_versions.get((ecu_type, *addr), ())):
         break
+    else:
+      matches.add(candidate)
 
-  return set(candidates.keys()) - invalid
+  return matches
 
 
 def match_fw_to_car(fw_versions: list[capnp.lib.capnp._DynamicStructBuilder], vin: str,
@@ -153,11 +186,12 @@ def match_fw_to_car(fw_versions: list[capnp.lib.capnp._DynamicStructBuilder], vi
   if allow_fuzzy:
     exact_matches.append((False, match_fw_to_car_fuzzy))
 
+  fw_versions_dicts = build_fw_dicts(fw_versions)
   for exact_match, match_func in exact_matches:
     # For each brand, attempt to fingerprint using all FW returned from its queries
     matches: set[str] = set()
     for brand in VERSIONS.keys():
-      fw_versions_dict = build_fw_dict(fw_versions, filter_brand=brand)
+      fw_versions_dict = fw_versions_dicts.get(brand, {})
       matches |= match_func(fw_versions_dict, match_brand=brand, log=log)
 
       # If specified and no matches so far, fall back to brand's fuzzy fingerprinting function
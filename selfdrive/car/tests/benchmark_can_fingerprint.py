@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+from cereal import log, messaging
+from openpilot.selfdrive.car.car_helpers import FRAME_FINGERPRINT, can_fingerprint
+from openpilot.selfdrive.car.fingerprints import _DEBUG_ADDRESS, _FINGERPRINTS, all_legacy_fingerprint_cars, \
+                                                all_legacy_fingerprint_cars_mask, cars_from_mask, compatible_cars_mask, \
+                                                is_valid_for_fingerprint
+from openpilot.selfdrive.car.tests.routes import routes
+from openpilot.tools.lib.logreader import LogReader
+
+MAX_FRAMES = 200
+
+
+def loop_eliminate_incompatible_cars(msg, candidate_cars):
+  # checks every fingerprint of every candidate
+  compatible_cars = []
+  for car_name in candidate_cars:
+    for fingerprint in _FINGERPRINTS[car_name]:
+      if is_valid_for_fingerprint(msg, fingerprint | _DEBUG_ADDRESS):
+        compatible_cars.append(car_name)
+        break
+  return compatible_cars
+
+
+def fingerprinted_messages(can):
+  return [c for c in can.can if c.src in (0, 1) and c.address < 0x800 and c.address not in (0x7df, 0x7e0, 0x7e8)]
+
+
+def eliminate_loop(frames):
+  candidate_cars = {b: all_legacy_fingerprint_cars() for b in (0, 1)}
+  for msgs in frames:
+    for msg in msgs:
+      candidate_cars[msg.src] = loop_eliminate_incompatible_cars(msg, candidate_cars[msg.src])
+  return candidate_cars
+
+
+def eliminate_indexed(frames):
+  candidate_cars = {b: all_legacy_fingerprint_cars_mask() for b in (0, 1)}
+  for msgs in frames:
+    for msg in msgs:
+      candidate_cars[msg.src] &= compatible_cars_mask(msg.address, len(msg.dat))
+  return {b: cars_from_mask(mask) for b, mask in candidate_cars.items()}
+
+
+def route_frames(route: str, segment: int | None) -> list:
+  frames = []
+  for msg in LogReader(f"{route}/{segment or 0}"):
+    if msg.which() == 'can':
+      frames.append(msg.as_builder().as_reader())
+      if len(frames) == MAX_FRAMES:
+        break
+  return frames
+
+
+def fingerprint_frames(car_model: str) -> list:
+  # the first fingerprint of the car on both buses, sent every frame
+  can = messaging.new_message('can', 1)
+  can.can = [log.CanData(address=address, dat=b'\x00' * length, src=src)
+             for address, length in _FINGERPRINTS[car_model][0].items() for src in (0, 1)]
+  return [can.as_reader()] * (FRAME_FINGERPRINT + 2)
+
+
+def benchmark(name: str, frames: list):
+  msgs = [fingerprinted_messages(can) for can in frames]
+  results = {}
+  for method, eliminate in [("loop", eliminate_loop), ("indexed", eliminate_indexed)]:
+    t = time.perf_counter()
+    results[method] = eliminate(msgs)
+    dt = time.perf_counter() - t
+    print(f"{name:>36} {method:>8}: {dt / len(frames) * 1e6:8.1f} us per frame")
+  assert {b: sorted(cars) for b, cars in results["loop"].items()} == {b: sorted(cars) for b, cars in results["indexed"].items()}, name
+
+  frame_iter = iter(frames)
+  t = time.perf_counter()
+  car_fingerprint, _ = can_fingerprint(lambda: next(frame_iter, frames[-1]))
+  print(f"{name:>36} {'total':>8}: {(time.perf_counter() - t) * 1e3:8.1f} ms, fingerprinted {car_fingerprint}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measures the time CAN fingerprinting spends eliminating candidate cars",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--routes", type=int, default=0, help="Number of test routes of CAN fingerprinted cars to replay")
+  parser.add_argument("--cars", type=str, nargs="*", default=list(_FINGERPRINTS)[::10],
+                      help="Cars to fingerprint from their offline fingerprints")
+  args = parser.parse_args()
+
+  for car_model in args.cars:
+    benchmark(car_model, fingerprint_frames(car_model))
+
+  test_routes = [r for r in routes if r.car_model in _FINGERPRINTS][:args.routes]
+  for test_route in test_routes:
+    benchmark(test_route.route, route_frames(test_route.route, test_route.segment))
@@ -2,7 +2,8 @@ from parameterized import parameterized
 
 from cereal import log, messaging
 from openpilot.selfdrive.car.car_helpers import FRAME_FINGERPRINT, can_fingerprint
-from openpilot.selfdrive.car.fingerprints import _FINGERPRINTS as FINGERPRINTS
+from openpilot.selfdrive.car.fingerprints import _DEBUG_ADDRESS, _FINGERPRINTS as FINGERPRINTS, all_legacy_fingerprint_cars, \
+                                                eliminate_incompatible_cars, is_valid_for_fingerprint
 
 
 class TestCanFingerprint:
@@ -24,6 +25,19 @@ class TestCanFingerprint:
       assert finger[1] == fingerprint
       assert finger[2] == {}
 
+  def test_eliminate_incompatible_cars(self):
+    """Tests the fingerprint index against checking every fingerprint of every car"""
+    messages = {(address, length) for fingerprints in FINGERPRINTS.values() for fingerprint in fingerprints
+                for address, length in fingerprint.items()}
+    messages |= {(address, length + 1) for address, length in messages} | {(0x800, 1), (1880, 8)}
+
+    candidate_cars = all_legacy_fingerprint_cars()
+    for address, length in messages:
+      msg = log.CanData(address=address, dat=b'\x00' * length)
+      expected = [car_name for car_name in candidate_cars
+                  if any(is_valid_for_fingerprint(msg, fingerprint | _DEBUG_ADDRESS) for fingerprint in FINGERPRINTS[car_name])]
+      assert eliminate_incompatible_cars(msg, candidate_cars) == expected
+
   def test_timing(self, subtests):
     # just pick any CAN fingerprinting car
     car_model = "CHEVROLET_BOLT_EUV"
@@ -651,12 +651,12 @@ class Controls:
 
     # Orientation and angle rates can be useful for carcontroller
     # Only calibrated (car) frame is relevant for the carcontroller
-    orientation_value = list(self.sm['liveLocationKalman'].calibratedOrientationNED.value)
+    orientation_value = self.sm.get_array('liveLocationKalman', 'calibratedOrientationNED.value')
     if len(orientation_value) > 2:
-      CC.orientationNED = orientation_value
-    angular_rate_value = list(self.sm['liveLocationKalman'].angularVelocityCalibrated.value)
+      CC.orientationNED = orientation_value.tolist()
+    angular_rate_value = self.sm.get_array('liveLocationKalman', 'angularVelocityCalibrated.value')
     if len(angular_rate_value) > 2:
-      CC.angularVelocity = angular_rate_value
+      CC.angularVelocity = angular_rate_value.tolist()
 
     CC.cruiseControl.override = self.enabled and not CC.longActive and self.CP.openpilotLongitudinalControl
     CC.cruiseControl.cancel = CS.cruiseState.enabled and (not self.enabled or not self.CP.pcmCruise)
@@ -775,16 +775,12 @@ class Controls:
 
     # onroadEvents - logged every second or on change
     if (self.sm.frame % int(1. / DT_CTRL) == 0) or (self.events.names != self.events_prev):
-      ce_send = messaging.new_message('onroadEvents', len(self.events))
-      ce_send.valid = True
-      ce_send.onroadEvents = self.events.to_msg()
+      ce_send = messaging.new_message('onroadEvents', valid=True, onroadEvents=self.events.to_msg())
       self.pm.send('onroadEvents', ce_send)
     self.events_prev = self.events.names.copy()
 
     # carControl
-    cc_send = messaging.new_message('carControl')
-    cc_send.valid = CS.canValid
-    cc_send.carControl = CC
+    cc_send = messaging.new_message('carControl', valid=CS.canValid, carControl=CC)
     self.pm.send('carControl', cc_send)
 
   def step(self):
@@ -1,7 +1,7 @@
 import copy
+import heapq
 import os
 import json
-from collections import defaultdict
 from dataclasses import dataclass
 
 from openpilot.common.basedir import BASEDIR
@@ -24,7 +24,7 @@ def set_offroad_alert(alert: str, show_alert: bool, extra_text: str = None) -> N
 
 @dataclass
 class AlertEntry:
-  alert: Alert | None = None
+  alert: Alert
   start_frame: int = -1
   end_frame: int = -1
 
@@ -33,29 +33,56 @@ class AlertEntry:
 
 class AlertManager:
   def __init__(self):
-    self.alerts: dict[str, AlertEntry] = defaultdict(AlertEntry)
+    # only alerts active as of the last processed frame are kept
+    self.alerts: dict[str, AlertEntry] = {}
+    # alerts of equal priority and start frame are ordered by when their type was first added
+    self.alert_order: dict[str, int] = {}
+    # (-priority, -start_frame, order, alert_type), items no longer matching their entry are dropped once on top
+    self.heap: list[tuple[int, int, int, str]] = []
+    # entries and heap items looked at by the last process_alerts call
+    self.alerts_processed = 0
+
+  def _heap_key(self, alert_type: str, entry: AlertEntry) -> tuple[int, int, int, str]:
+    return -entry.alert.priority, -entry.start_frame, self.alert_order[alert_type], alert_type
 
   def add_many(self, frame: int, alerts: list[Alert]) -> None:
     for alert in alerts:
-      entry = self.alerts[alert.alert_type]
+      entry = self.alerts.get(alert.alert_type)
+      if entry is None:
+        entry = self.alerts[alert.alert_type] = AlertEntry(alert)
+        self.alert_order.setdefault(alert.alert_type, len(self.alert_order))
+        prev_key = None
+      else:
+        prev_key = (entry.alert.priority, entry.start_frame)
+
       entry.alert = alert
       if not entry.active(frame):
         entry.start_frame = frame
       min_end_frame = entry.start_frame + alert.duration
       entry.end_frame = max(frame + 1, min_end_frame)
 
-  def process_alerts(self, frame: int, clear_event_types: set) -> Alert | None:
-    current_alert = AlertEntry()
-    for v in self.alerts.values():
-      if not v.alert:
-        continue
+      if (alert.priority, entry.start_frame) != prev_key:
+        heapq.heappush(self.heap, self._heap_key(alert.alert_type, entry))
 
-      if v.alert.event_type in clear_event_types:
-        v.end_frame = -1
+  def process_alerts(self, frame: int, clear_event_types: set) -> Alert | None:
+    self.alerts_processed = len(self.alerts)
+    for alert_type, entry in list(self.alerts.items()):
+      if entry.alert.event_type in clear_event_types:
+        entry.end_frame = -1
+      if not entry.active(frame):
+        del self.alerts[alert_type]
 
-      # sort by priority first and then by start_frame
-      greater = current_alert.alert is None or (v.alert.priority, v.start_frame) > (current_alert.alert.priority, current_alert.start_frame)
-      if v.active(frame) and greater:
-        current_alert = v
+    # rebuild once mostly stale, rather than letting items under a long-lived alert pile up
+    if len(self.heap) > 2 * len(self.alerts) + 16:
+      self.heap = [self._heap_key(alert_type, entry) for alert_type, entry in self.alerts.items()]
+      heapq.heapify(self.heap)
 
-    return current_alert.alert
+    # sort by priority first and then by start_frame
+    while len(self.heap):
+      key = self.heap[0]
+      top = self.alerts.get(key[3])
+      self.alerts_processed += 1
+      if top is not None and self._heap_key(key[3], top) == key:
+        return top.alert
+      heapq.heappop(self.heap)
+    return None
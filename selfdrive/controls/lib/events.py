@@ -2,6 +2,7 @@
 import bisect
 import math
 import os
+import numpy as np
 from enum import IntEnum
 from collections.abc import Callable
 
@@ -43,15 +44,30 @@ class ET:
   PERMANENT = 'permanent'
 
 
+# one bit per event type, events' types are kept as a bitmask of these
+ET_BIT = {et: 1 << i for i, et in enumerate(v for k, v in vars(ET).items() if not k.startswith('_'))}
+
 # get event name from enum
 EVENT_NAME = {v: k for k, v in EventName.schema.enumerants.items()}
+NUM_EVENTS = max(EVENT_NAME) + 1
+
+
+def event_types_mask(event_types) -> int:
+  mask = 0
+  for et in event_types:
+    mask |= ET_BIT[et]
+  return mask
 
 
 class Events:
   def __init__(self):
     self.events: list[int] = []
     self.static_events: list[int] = []
-    self.event_counters = dict.fromkeys(EVENTS.keys(), 0)
+    # frames each event has been active for, indexed by event name
+    self.event_counters = np.zeros(NUM_EVENTS, dtype=np.int64)
+    # types of the current and static events, EVENTS is read when events are added
+    self.types_mask = 0
+    self.static_types_mask = 0
 
   @property
   def names(self) -> list[int]:
@@ -61,21 +77,30 @@ class Events:
     return len(self.events)
 
   def add(self, event_name: int, static: bool=False) -> None:
+    types_mask = event_types_mask(EVENTS.get(event_name, {}))
     if static:
       bisect.insort(self.static_events, event_name)
+      self.static_types_mask |= types_mask
     bisect.insort(self.events, event_name)
+    self.types_mask |= types_mask
 
   def clear(self) -> None:
-    self.event_counters = {k: (v + 1 if k in self.events else 0) for k, v in self.event_counters.items()}
+    event_counters = np.zeros(NUM_EVENTS, dtype=np.int64)
+    event_counters[self.events] = self.event_counters[self.events] + 1
+    self.event_counters = event_counters
     self.events = self.static_events.copy()
+    self.types_mask = self.static_types_mask
 
   def contains(self, event_type: str) -> bool:
-    return any(event_type in EVENTS.get(e, {}) for e in self.events)
+    return bool(self.types_mask & ET_BIT.get(event_type, 0))
 
   def create_alerts(self, event_types: list[str], callback_args=None):
     if callback_args is None:
       callback_args = []
 
+    if not self.types_mask & event_types_mask(event_types):
+      return []
+
     ret = []
     for e in self.events:
       types = EVENTS[e].keys()
@@ -93,7 +118,7 @@ class Events:
 
   def add_from_msg(self, events):
     for e in events:
-      bisect.insort(self.events, e.name.raw)
+      self.add(e.name.raw)
 
   def to_msg(self):
     ret = []
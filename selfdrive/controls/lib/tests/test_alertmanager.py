@@ -1,9 +1,18 @@
 import random
 
-from openpilot.selfdrive.controls.lib.events import Alert, EVENTS
+from cereal import car, log
+from openpilot.selfdrive.controls.lib.events import ET, Alert, EVENTS, Priority
 from openpilot.selfdrive.controls.lib.alertmanager import AlertManager
 
 
+def make_alert(alert_type: str, event_type: str, priority: Priority, duration: float = 0.2) -> Alert:
+  alert = Alert("", "", log.ControlsState.AlertStatus.normal, log.ControlsState.AlertSize.small, priority,
+                car.CarControl.HUDControl.VisualAlert.none, car.CarControl.HUDControl.AudibleAlert.none, duration)
+  alert.alert_type = alert_type
+  alert.event_type = event_type
+  return alert
+
+
 class TestAlertManager:
 
   def test_duration(self):
@@ -37,3 +46,35 @@ class TestAlertManager:
           shown = current_alert is not None
           should_show = frame <= show_duration
           assert shown == should_show, f"{frame=} {add_duration=} {duration=}"
+
+  def test_priority(self):
+    """
+      Enforce that the highest priority alert is shown, and the most recent one among equal priorities
+    """
+    high = make_alert("high", ET.WARNING, Priority.HIGHEST)
+    low = make_alert("low", ET.PERMANENT, Priority.LOWER)
+    low2 = make_alert("low2", ET.PERMANENT, Priority.LOWER)
+
+    AM = AlertManager()
+    AM.add_many(0, [low, ])
+    assert AM.process_alerts(0, set()) is low
+    AM.add_many(1, [high, low])
+    assert AM.process_alerts(1, set()) is high
+    AM.add_many(2, [low, low2])
+    assert AM.process_alerts(2, {ET.WARNING}) is low2
+
+  def test_expiry(self):
+    """
+      Enforce that expired alerts are dropped, so only active ones are processed each frame
+    """
+    AM = AlertManager()
+    for frame in range(100):
+      AM.add_many(frame, [make_alert(f"alert{frame}", ET.PERMANENT, Priority(frame % 6)), ])
+      AM.process_alerts(frame, set())
+
+    alert = make_alert("alert", ET.PERMANENT, Priority.LOWEST)
+    for frame in range(200, 300):
+      AM.add_many(frame, [alert, ])
+      assert AM.process_alerts(frame, set()) is alert
+      assert list(AM.alerts) == ["alert"]
+    assert AM.alerts_processed == 2
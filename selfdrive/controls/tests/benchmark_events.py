@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import os
+import time
+
+from cereal import car
+from openpilot.selfdrive.controls.lib.events import ET, EVENTS, Alert, Events
+
+N = int(os.getenv("N", "100000"))
+EventName = car.CarEvent.EventName
+
+# events added per frame, as seen in controlsd
+MIXES = {
+  "engaged, no events": [],
+  "engaged, driver monitoring warning": [EventName.preDriverDistracted],
+  "overriding": [EventName.gasPressedOverride, EventName.steerOverride],
+  "disengaged, blocked": [EventName.doorOpen, EventName.seatbeltNotLatched, EventName.wrongGear, EventName.pcmDisable],
+  "faults": [EventName.canError, EventName.steerTempUnavailable, EventName.commIssue, EventName.radarFault,
+             EventName.posenetInvalid, EventName.usbError],
+}
+# the event types controlsd checks every frame
+CHECKED_TYPES = [ET.NO_ENTRY, ET.SOFT_DISABLE, ET.IMMEDIATE_DISABLE, ET.USER_DISABLE, ET.OVERRIDE_LATERAL,
+                 ET.OVERRIDE_LONGITUDINAL, ET.PRE_ENABLE, ET.ENABLE, ET.NO_ENTRY]
+
+
+def update_events(events: Events, names: list[int]):
+  events.clear()
+  for name in names:
+    events.add(name)
+  for et in CHECKED_TYPES:
+    events.contains(et)
+  events.create_alerts([ET.PERMANENT, ET.WARNING])
+
+
+if __name__ == "__main__":
+  for mix, names in MIXES.items():
+    # alert callbacks need the full controlsd state, only events with fixed alerts are created
+    assert all(isinstance(a, Alert) for n in names for et, a in EVENTS[n].items() if et in (ET.PERMANENT, ET.WARNING)), mix
+
+    events = Events()
+    events.add(EventName.dashcamMode, static=True)
+    t = time.perf_counter()
+    for _ in range(N):
+      update_events(events, names)
+    print(f"{mix:>36}: {(time.perf_counter() - t) / N * 1e6:6.2f} us per frame")
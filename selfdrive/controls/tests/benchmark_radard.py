@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import time
+
+import cereal.messaging as messaging
+from cereal import car
+from openpilot.selfdrive.controls.radard import RADAR_TO_CAMERA, RadarD
+from openpilot.selfdrive.test.process_replay.test_processes import segments
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+FRAMES = int(os.getenv("FRAMES", "2000"))
+RADAR_TS = 0.05
+
+
+def replayed_frames(segment: str):
+  """radard inputs from a segment, with its published tracks standing in for the radar points"""
+  frames, msgs = [], []
+  for msg in LogReader(get_url(*segment.rsplit("--", 1))):
+    if msg.which() in ('carState', 'modelV2'):
+      msgs.append(msg)
+    elif msg.which() == 'liveTracks':
+      points = [{'trackId': t.trackId, 'dRel': t.dRel, 'yRel': t.yRel, 'vRel': t.vRel, 'measured': True} for t in msg.liveTracks]
+      frames.append((msg.logMonoTime, msgs, car.RadarData.new_message(points=points)))
+      msgs = []
+  return frames
+
+
+def synthetic_frames(n_points: int):
+  """A radar reporting n_points moving objects, some of them dropping out and replaced, with a lead on one of them"""
+  objects = {i: [random.uniform(5., 100.), random.uniform(-10., 10.), random.uniform(-10., 5.)] for i in range(n_points)}
+  next_id = n_points
+
+  frames = []
+  for i in range(FRAMES):
+    if random.random() < 0.1:
+      objects.pop(random.choice(list(objects)))
+      objects[next_id] = [random.uniform(5., 100.), random.uniform(-10., 10.), random.uniform(-10., 5.)]
+      next_id += 1
+    for obj in objects.values():
+      obj[0] += obj[2] * RADAR_TS
+    points = [{'trackId': k, 'dRel': d, 'yRel': y, 'vRel': v, 'measured': True} for k, (d, y, v) in objects.items()]
+
+    cs = messaging.new_message('carState', carState={'vEgo': 20.})
+    model = messaging.new_message('modelV2')
+    model.modelV2.temporalPose.trans = [20., 0., 0.]
+    lead_d, lead_y, lead_v = objects[min(objects)]
+    model.modelV2.leadsV3 = [{'prob': 0.9, 'x': [lead_d + RADAR_TO_CAMERA], 'y': [-lead_y], 'v': [lead_v + 20.],
+                              'xStd': [1.], 'yStd': [0.5], 'vStd': [1.]}] * 2
+    frames.append((int(i * RADAR_TS * 1e9), [cs.as_reader(), model.as_reader()], car.RadarData.new_message(points=points)))
+  return frames
+
+
+def benchmark(frames) -> float:
+  sm = messaging.SubMaster(['modelV2', 'carState'])
+  RD = RadarD(RADAR_TS)
+
+  dt = 0.
+  for t, msgs, rr in frames:
+    sm.update_msgs(t * 1e-9, msgs)
+    start = time.perf_counter()
+    RD.update(sm, rr)
+    dt += time.perf_counter() - start
+  return dt / len(frames)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measures the time radard takes to update its tracks and leads")
+  parser.add_argument("--cars", type=str, nargs="*", default=["TOYOTA", "TOYOTA3", "HYUNDAI", "GM"],
+                      help="Cars of the test_processes segments to replay (e.g. HONDA)")
+  parser.add_argument("--points", type=int, nargs="*", default=[16, 32, 64], help="Synthetic radar point counts")
+  args = parser.parse_args()
+
+  random.seed(0)
+  for n_points in args.points:
+    print(f"{n_points:>3} synthetic points: {benchmark(synthetic_frames(n_points)) * 1e6:7.1f} us per update")
+
+  for car_name in args.cars:
+    segment = next(seg for c, seg in segments if c == car_name.upper())
+    frames = replayed_frames(segment)
+    avg_points = sum(len(rr.points) for *_, rr in frames) / max(len(frames), 1)
+    print(f"{car_name:>10}, {avg_points:4.1f} points: {benchmark(frames) * 1e6:7.1f} us per update")
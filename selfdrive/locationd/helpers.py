@@ -5,19 +5,73 @@ from cereal import log
 
 
 class NPQueue:
+  """Circular buffer of rows, along with the sum of their outer products"""
   def __init__(self, maxlen: int, rowsize: int) -> None:
     self.maxlen = maxlen
-    self.arr = np.empty((0, rowsize))
+    self.buf = np.empty((maxlen, rowsize))
+    self.moments = np.zeros((rowsize, rowsize))
+    self.idx = 0
+    self.size = 0
 
   def __len__(self) -> int:
-    return len(self.arr)
+    return self.size
+
+  @property
+  def arr(self) -> np.ndarray:
+    # oldest row first
+    if self.size < self.maxlen:
+      return self.buf[:self.size]
+    return np.concatenate((self.buf[self.idx:], self.buf[:self.idx]))
 
   def append(self, pt: list[float]) -> None:
-    if len(self.arr) < self.maxlen:
-      self.arr = np.append(self.arr, [pt], axis=0)
+    row = np.array(pt, dtype=np.float64)
+    if self.size == self.maxlen:
+      old = self.buf[self.idx]
+      self.moments += row[:, None] * row - old[:, None] * old
     else:
-      self.arr[:-1] = self.arr[1:]
-      self.arr[-1] = pt
+      self.moments += row[:, None] * row
+
+    self.buf[self.idx] = row
+    self.idx = (self.idx + 1) % self.maxlen
+    self.size = min(self.size + 1, self.maxlen)
+
+    # resync the running sums once per pass over the buffer, so rounding errors don't build up
+    if self.idx == 0:
+      self.moments = self.buf.T @ self.buf
+
+
+class TimeSeriesBuffer:
+  """Fixed size history of timestamped samples, queried by interpolation. Timestamps must be increasing.
+
+  Samples are written twice, one buffer length apart, so the history is always a contiguous view.
+  """
+  def __init__(self, maxlen: int, fields: list[str]) -> None:
+    self.maxlen = maxlen
+    # the first row holds the timestamps
+    self.fields = {field: i + 1 for i, field in enumerate(fields)}
+    self.buf = np.zeros((len(fields) + 1, 2 * maxlen))
+    self.idx = 0
+    self.size = 0
+
+  def __len__(self) -> int:
+    return self.size
+
+  def append(self, t: float, *values: float) -> None:
+    self.buf[:, self.idx] = self.buf[:, self.idx + self.maxlen] = (t, *values)
+    self.idx = (self.idx + 1) % self.maxlen
+    self.size = min(self.size + 1, self.maxlen)
+
+  @property
+  def t(self) -> np.ndarray:
+    start = self.idx + self.maxlen - self.size
+    return self.buf[0, start:start + self.size]
+
+  def values(self, field: str) -> np.ndarray:
+    start = self.idx + self.maxlen - self.size
+    return self.buf[self.fields[field], start:start + self.size]
+
+  def interp(self, t: float | np.ndarray, field: str) -> float | np.ndarray:
+    return np.interp(t, self.t, self.values(field))
 
 
 class PointBuckets:
@@ -47,6 +101,10 @@ class PointBuckets:
       return points
     return points[np.random.choice(np.arange(len(points)), min(len(points), num_points), replace=False)]
 
+  def get_moments(self) -> np.ndarray:
+    moments: np.ndarray = np.sum([x.moments for x in self.buckets.values()], axis=0)
+    return moments
+
   def load_points(self, points: list[list[float]]) -> None:
     for point in points:
       self.add_point(*point)
@@ -0,0 +1,44 @@
+import numpy as np
+
+from cereal import car
+from openpilot.selfdrive.locationd.helpers import NPQueue, TimeSeriesBuffer
+from openpilot.selfdrive.locationd.torqued import FRICTION_FACTOR, TorqueEstimator, slope2rot
+
+
+class TestTorqued:
+
+  def test_queue(self):
+    q = NPQueue(maxlen=10, rowsize=3)
+    for i in range(25):
+      q.append([i, 1.0, -i])
+      expected = np.array([[j, 1.0, -j] for j in range(max(0, i - 9), i + 1)])
+      assert len(q) == len(expected)
+      np.testing.assert_array_equal(q.arr, expected)
+      np.testing.assert_allclose(q.moments, expected.T @ expected)
+
+  def test_time_series(self):
+    buf = TimeSeriesBuffer(maxlen=10, fields=['a', 'b'])
+    for i in range(25):
+      buf.append(0.1 * i, i, -i)
+      times = 0.1 * np.arange(max(0, i - 9), i + 1)
+      assert len(buf) == len(times)
+      np.testing.assert_allclose(buf.t, times)
+      np.testing.assert_allclose(buf.values('b'), -np.round(times * 10))
+      np.testing.assert_allclose(buf.interp(times[-1] - 0.05, 'a'), (times[-1] - 0.05) * 10 if i else 0)
+
+  def test_estimate_params(self):
+    """
+      Enforce that the fit from the running sums matches a total least squares fit of all points
+    """
+    np.random.seed(0)
+    est = TorqueEstimator(car.CarParams.new_message())
+    x = np.random.uniform(-0.5, 0.5, 5000)
+    y = 2.0 * x + 0.1 + np.random.normal(0, 0.2, len(x))
+    for steer, lat_acc in zip(x, y, strict=True):
+      est.filtered_points.add_point(float(steer), float(lat_acc))
+
+    points = est.filtered_points.get_points()
+    _, _, v = np.linalg.svd(points, full_matrices=False)
+    slope, offset = -v.T[0:2, 2] / v.T[2, 2]
+    _, spread = np.matmul(points[:, [0, 2]], slope2rot(slope)).T
+    np.testing.assert_allclose(est.estimate_params(), [slope, offset, np.std(spread) * FRICTION_FACTOR], rtol=1e-9)
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import numpy as np
-from collections import deque, defaultdict
 
 import cereal.messaging as messaging
 from cereal import car, log
@@ -9,14 +8,12 @@ from openpilot.common.realtime import config_realtime_process, DT_MDL
 from openpilot.common.filter_simple import FirstOrderFilter
 from openpilot.common.swaglog import cloudlog
 from openpilot.selfdrive.controls.lib.vehicle_model import ACCELERATION_DUE_TO_GRAVITY
-from openpilot.selfdrive.locationd.helpers import PointBuckets, ParameterEstimator
+from openpilot.selfdrive.locationd.helpers import PointBuckets, ParameterEstimator, TimeSeriesBuffer
 
 HISTORY = 5  # secs
 POINTS_PER_BUCKET = 1500
 MIN_POINTS_TOTAL = 4000
 MIN_POINTS_TOTAL_QLOG = 600
-FIT_POINTS_TOTAL = 2000
-FIT_POINTS_TOTAL_QLOG = 600
 MIN_VEL = 15  # m/s
 FRICTION_FACTOR = 1.5  # ~85% of data coverage
 FACTOR_SANITY = 0.3
@@ -53,17 +50,18 @@ class TorqueEstimator(ParameterEstimator):
   def __init__(self, CP, decimated=False):
     self.hist_len = int(HISTORY / DT_MDL)
     self.lag = CP.steerActuatorDelay + .2   # from controlsd
+    # times checked for engagement before a point, relative to it
+    self.engage_offsets = np.arange(-MIN_ENGAGE_BUFFER, 0, DT_MDL)
+    self.engage_t = np.empty_like(self.engage_offsets)
     if decimated:
       self.min_bucket_points = MIN_BUCKET_POINTS / 10
       self.min_points_total = MIN_POINTS_TOTAL_QLOG
-      self.fit_points = FIT_POINTS_TOTAL_QLOG
       self.factor_sanity = FACTOR_SANITY_QLOG
       self.friction_sanity = FRICTION_SANITY_QLOG
 
     else:
       self.min_bucket_points = MIN_BUCKET_POINTS
       self.min_points_total = MIN_POINTS_TOTAL
-      self.fit_points = FIT_POINTS_TOTAL
       self.factor_sanity = FACTOR_SANITY
       self.friction_sanity = FRICTION_SANITY
 
@@ -129,7 +127,11 @@ class TorqueEstimator(ParameterEstimator):
   def reset(self):
     self.resets += 1.0
     self.decay = MIN_FILTER_DECAY
-    self.raw_points = defaultdict(lambda: deque(maxlen=self.hist_len))
+    self.raw_points = {
+      'carControl': TimeSeriesBuffer(self.hist_len, ['active']),
+      'carOutput': TimeSeriesBuffer(self.hist_len, ['steer_torque']),
+      'carState': TimeSeriesBuffer(self.hist_len, ['vego', 'steer_override']),
+    }
     self.filtered_points = TorqueBuckets(x_bounds=STEER_BUCKET_BOUNDS,
                                          min_points=self.min_bucket_points,
                                          min_points_total=self.min_points_total,
@@ -137,14 +139,20 @@ class TorqueEstimator(ParameterEstimator):
                                          rowsize=3)
 
   def estimate_params(self):
-    points = self.filtered_points.get_points(self.fit_points)
+    # sums of the outer products of all points, rows being [steer, 1, lateral_acc]
+    moments = self.filtered_points.get_moments()
     # total least square solution as both x and y are noisy observations
     # this is empirically the slope of the hysteresis parallelogram as opposed to the line through the diagonals
     try:
-      _, _, v = np.linalg.svd(points, full_matrices=False)
-      slope, offset = -v.T[0:2, 2] / v.T[2, 2]
-      _, spread = np.matmul(points[:, [0, 2]], slope2rot(slope)).T
-      friction_coeff = np.std(spread) * FRICTION_FACTOR
+      _, v = np.linalg.eigh(moments)
+      slope, offset = -v[0:2, 0] / v[2, 0]
+      # spread of the points across the fit line, from the same sums
+      rot = slope2rot(slope)
+      w = np.array([rot[0, 1], 0.0, rot[1, 1]])
+      n = moments[1, 1]
+      spread_mean = (w @ moments[:, 1]) / n
+      spread_var = (w @ moments @ w) / n - spread_mean**2
+      friction_coeff = np.sqrt(max(spread_var, 0.0)) * FRICTION_FACTOR
     except np.linalg.LinAlgError as e:
       cloudlog.exception(f"Error computing live torque params: {e}")
       slope = offset = friction_coeff = np.nan
@@ -158,25 +166,22 @@ class TorqueEstimator(ParameterEstimator):
 
   def handle_log(self, t, which, msg):
     if which == "carControl":
-      self.raw_points["carControl_t"].append(t + self.lag)
-      self.raw_points["active"].append(msg.latActive)
+      self.raw_points["carControl"].append(t + self.lag, msg.latActive)
     elif which == "carOutput":
-      self.raw_points["carOutput_t"].append(t + self.lag)
-      self.raw_points["steer_torque"].append(-msg.actuatorsOutput.steer)
+      self.raw_points["carOutput"].append(t + self.lag, -msg.actuatorsOutput.steer)
     elif which == "carState":
-      self.raw_points["carState_t"].append(t + self.lag)
-      self.raw_points["vego"].append(msg.vEgo)
-      self.raw_points["steer_override"].append(msg.steeringPressed)
+      self.raw_points["carState"].append(t + self.lag, msg.vEgo, msg.steeringPressed)
     elif which == "liveLocationKalman":
-      if len(self.raw_points['steer_torque']) == self.hist_len:
+      if len(self.raw_points['carOutput']) == self.hist_len:
         yaw_rate = msg.angularVelocityCalibrated.value[2]
         roll = msg.orientationNED.value[0]
-        active = np.interp(np.arange(t - MIN_ENGAGE_BUFFER, t, DT_MDL), self.raw_points['carControl_t'], self.raw_points['active']).astype(bool)
-        steer_override = np.interp(np.arange(t - MIN_ENGAGE_BUFFER, t, DT_MDL), self.raw_points['carState_t'], self.raw_points['steer_override']).astype(bool)
-        vego = np.interp(t, self.raw_points['carState_t'], self.raw_points['vego'])
-        steer = np.interp(t, self.raw_points['carOutput_t'], self.raw_points['steer_torque'])
+        np.add(self.engage_offsets, t, out=self.engage_t)
+        active = self.raw_points['carControl'].interp(self.engage_t, 'active').all()
+        steer_override = self.raw_points['carState'].interp(self.engage_t, 'steer_override').any()
+        vego = self.raw_points['carState'].interp(t, 'vego')
+        steer = self.raw_points['carOutput'].interp(t, 'steer_torque')
         lateral_acc = (vego * yaw_rate) - (np.sin(roll) * ACCELERATION_DUE_TO_GRAVITY)
-        if all(active) and (not any(steer_override)) and (vego > MIN_VEL) and (abs(steer) > STEER_MIN_THRESHOLD) and (abs(lateral_acc) <= LAT_ACC_THRESHOLD):
+        if active and (not steer_override) and (vego > MIN_VEL) and (abs(steer) > STEER_MIN_THRESHOLD) and (abs(lateral_acc) <= LAT_ACC_THRESHOLD):
           self.filtered_points.add_point(float(steer), float(lateral_acc))
 
   def get_msg(self, valid=True, with_points=False):
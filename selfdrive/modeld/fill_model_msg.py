@@ -1,57 +1,122 @@
+import functools
 import os
+import time
 import capnp
 import numpy as np
-from cereal import log
+from cereal import log, messaging
 from openpilot.selfdrive.modeld.constants import ModelConstants, Plan, Meta
 
 SEND_RAW_PRED = os.getenv('SEND_RAW_PRED')
 
 ConfidenceClass = log.ModelDataV2.ConfidenceClass
 
+T_IDXS = np.array(ModelConstants.T_IDXS)
+X_IDXS = np.array(ModelConstants.X_IDXS)
+
 class PublishState:
   def __init__(self):
     self.disengage_buffer = np.zeros(ModelConstants.CONFIDENCE_BUFFER_LEN*ModelConstants.DISENGAGE_WIDTH, dtype=np.float32)
     self.prev_brake_5ms2_probs = np.zeros(ModelConstants.FCW_5MS2_PROBS_WIDTH, dtype=np.float32)
     self.prev_brake_3ms2_probs = np.zeros(ModelConstants.FCW_3MS2_PROBS_WIDTH, dtype=np.float32)
 
+# values are lists, fields that are None are left as they are
 def fill_xyzt(builder, t, x, y, z, x_std=None, y_std=None, z_std=None):
-  builder.t = t
-  builder.x = x.tolist()
-  builder.y = y.tolist()
-  builder.z = z.tolist()
+  if t is not None:
+    builder.t = t
+  if x is not None:
+    builder.x = x
+  builder.y = y
+  builder.z = z
   if x_std is not None:
-    builder.xStd = x_std.tolist()
+    builder.xStd = x_std
   if y_std is not None:
-    builder.yStd = y_std.tolist()
+    builder.yStd = y_std
   if z_std is not None:
-    builder.zStd = z_std.tolist()
+    builder.zStd = z_std
 
 def fill_xyvat(builder, t, x, y, v, a, x_std=None, y_std=None, v_std=None, a_std=None):
-  builder.t = t
-  builder.x = x.tolist()
-  builder.y = y.tolist()
-  builder.v = v.tolist()
-  builder.a = a.tolist()
+  if t is not None:
+    builder.t = t
+  builder.x = x
+  builder.y = y
+  builder.v = v
+  builder.a = a
   if x_std is not None:
-    builder.xStd = x_std.tolist()
+    builder.xStd = x_std
   if y_std is not None:
-    builder.yStd = y_std.tolist()
+    builder.yStd = y_std
   if v_std is not None:
-    builder.vStd = v_std.tolist()
+    builder.vStd = v_std
   if a_std is not None:
-    builder.aStd = a_std.tolist()
+    builder.aStd = a_std
+
+@functools.cache
+def get_poly_fit(degree):
+  # the least squares polynomial fit at T_IDXS is a fixed linear map of the values
+  return np.linalg.pinv(np.polynomial.polynomial.polyvander(T_IDXS, degree))
 
 def fill_xyz_poly(builder, degree, x, y, z):
   xyz = np.stack([x, y, z], axis=1)
-  coeffs = np.polynomial.polynomial.polyfit(ModelConstants.T_IDXS, xyz, deg=degree)
+  coeffs = get_poly_fit(degree) @ xyz
   builder.xCoefficients = coeffs[:, 0].tolist()
   builder.yCoefficients = coeffs[:, 1].tolist()
   builder.zCoefficients = coeffs[:, 2].tolist()
 
+def get_plan_t_idxs(plan_x: np.ndarray) -> list[float]:
+  # times at X_IDXS according to model plan
+  plan_t_idxs = np.full(ModelConstants.IDX_N, np.nan)
+  plan_t_idxs[0] = 0.0
+  # index of the last plan point before the first one that's further away than each X_IDXS
+  tidx = np.searchsorted(np.maximum.accumulate(plan_x[1:]), X_IDXS[1:])
+  n = np.count_nonzero(tidx < ModelConstants.IDX_N - 1)
+  tidx = tidx[:n]
+
+  # interpolate to find `t` for each X_IDXS the plan extends to
+  current_x_val = plan_x[tidx]
+  dx = plan_x[tidx+1] - current_x_val
+  with np.errstate(divide='ignore', invalid='ignore'):
+    p = np.where(np.abs(dx) > 1e-9, (X_IDXS[1:n+1] - current_x_val) / dx, np.nan)
+  plan_t_idxs[1:n+1] = p * T_IDXS[tidx+1] + (1 - p) * T_IDXS[tidx]
+
+  # if the Plan doesn't extend far enough, set plan_t to the max value (10s), the rest is left unknown
+  if n < ModelConstants.IDX_N - 1:
+    plan_t_idxs[n+1] = T_IDXS[-1]
+  plan_t: list[float] = plan_t_idxs.tolist()
+  return plan_t
+
+def fill_model_msg_constants(extended_msg: capnp._DynamicStructBuilder) -> None:
+  # fields of modelV2 that are the same every frame
+  modelV2 = extended_msg.modelV2
+  for builder in (modelV2.position, modelV2.velocity, modelV2.acceleration, modelV2.orientation, modelV2.orientationRate):
+    builder.t = ModelConstants.T_IDXS
+  for lane_line in modelV2.init('laneLines', ModelConstants.NUM_LANE_LINES):
+    lane_line.x = ModelConstants.X_IDXS
+  for road_edge in modelV2.init('roadEdges', ModelConstants.NUM_ROAD_EDGES):
+    road_edge.x = ModelConstants.X_IDXS
+  for lead, prob_time in zip(modelV2.init('leadsV3', ModelConstants.LEAD_MHP_SELECTION), ModelConstants.LEAD_T_OFFSETS, strict=True):
+    lead.t = ModelConstants.LEAD_T_IDXS
+    lead.probTime = prob_time
+  modelV2.meta.init('disengagePredictions').t = ModelConstants.META_T_IDXS
+
+class ModelMsgTemplates:
+  """drivingModelData and modelV2 messages with their constant fields filled in, copied for each frame"""
+  def __init__(self):
+    self.base_msg = messaging.new_message('drivingModelData')
+    self.extended_msg = messaging.new_message('modelV2')
+    fill_model_msg_constants(self.extended_msg)
+
+  def new_messages(self) -> tuple[capnp._DynamicStructBuilder, capnp._DynamicStructBuilder]:
+    base_msg, extended_msg = self.base_msg.copy(), self.extended_msg.copy()
+    base_msg.logMonoTime = extended_msg.logMonoTime = int(time.monotonic() * 1e9)
+    return base_msg, extended_msg
+
 def fill_model_msg(base_msg: capnp._DynamicStructBuilder, extended_msg: capnp._DynamicStructBuilder,
                    net_output_data: dict[str, np.ndarray], publish_state: PublishState,
                    vipc_frame_id: int, vipc_frame_id_extra: int, frame_id: int, frame_drop: float,
-                   timestamp_eof: int, model_execution_time: float, valid: bool) -> None:
+                   timestamp_eof: int, model_execution_time: float, valid: bool, constants_filled: bool = False) -> None:
+  if not constants_filled:
+    fill_model_msg_constants(extended_msg)
+
   frame_age = frame_id - vipc_frame_id if frame_id > vipc_frame_id else 0
   frame_drop_perc = frame_drop * 100
   extended_msg.valid = valid
@@ -75,16 +140,13 @@ def fill_model_msg(base_msg: capnp._DynamicStructBuilder, extended_msg: capnp._D
   modelV2.modelExecutionTime = model_execution_time
 
   # plan
-  position = modelV2.position
-  fill_xyzt(position, ModelConstants.T_IDXS, *net_output_data['plan'][0,:,Plan.POSITION].T, *net_output_data['plan_stds'][0,:,Plan.POSITION].T)
-  velocity = modelV2.velocity
-  fill_xyzt(velocity, ModelConstants.T_IDXS, *net_output_data['plan'][0,:,Plan.VELOCITY].T)
-  acceleration = modelV2.acceleration
-  fill_xyzt(acceleration, ModelConstants.T_IDXS, *net_output_data['plan'][0,:,Plan.ACCELERATION].T)
-  orientation = modelV2.orientation
-  fill_xyzt(orientation, ModelConstants.T_IDXS, *net_output_data['plan'][0,:,Plan.T_FROM_CURRENT_EULER].T)
-  orientation_rate = modelV2.orientationRate
-  fill_xyzt(orientation_rate, ModelConstants.T_IDXS, *net_output_data['plan'][0,:,Plan.ORIENTATION_RATE].T)
+  plan = net_output_data['plan'][0].T.tolist()
+  plan_stds = net_output_data['plan_stds'][0].T.tolist()
+  fill_xyzt(modelV2.position, None, *plan[Plan.POSITION], *plan_stds[Plan.POSITION])
+  fill_xyzt(modelV2.velocity, None, *plan[Plan.VELOCITY])
+  fill_xyzt(modelV2.acceleration, None, *plan[Plan.ACCELERATION])
+  fill_xyzt(modelV2.orientation, None, *plan[Plan.T_FROM_CURRENT_EULER])
+  fill_xyzt(modelV2.orientationRate, None, *plan[Plan.ORIENTATION_RATE])
 
   # poly path
   poly_path = driving_model_data.path
@@ -95,67 +157,49 @@ def fill_model_msg(base_msg: capnp._DynamicStructBuilder, extended_msg: capnp._D
   action.desiredCurvature = float(net_output_data['desired_curvature'][0,0])
 
   # times at X_IDXS according to model plan
-  PLAN_T_IDXS = [np.nan] * ModelConstants.IDX_N
-  PLAN_T_IDXS[0] = 0.0
-  plan_x = net_output_data['plan'][0,:,Plan.POSITION][:,0].tolist()
-  for xidx in range(1, ModelConstants.IDX_N):
-    tidx = 0
-    # increment tidx until we find an element that's further away than the current xidx
-    while tidx < ModelConstants.IDX_N - 1 and plan_x[tidx+1] < ModelConstants.X_IDXS[xidx]:
-      tidx += 1
-    if tidx == ModelConstants.IDX_N - 1:
-      # if the Plan doesn't extend far enough, set plan_t to the max value (10s), then break
-      PLAN_T_IDXS[xidx] = ModelConstants.T_IDXS[ModelConstants.IDX_N - 1]
-      break
-    # interpolate to find `t` for the current xidx
-    current_x_val = plan_x[tidx]
-    next_x_val = plan_x[tidx+1]
-    p = (ModelConstants.X_IDXS[xidx] - current_x_val) / (next_x_val - current_x_val) if abs(next_x_val - current_x_val) > 1e-9 else float('nan')
-    PLAN_T_IDXS[xidx] = p * ModelConstants.T_IDXS[tidx+1] + (1 - p) * ModelConstants.T_IDXS[tidx]
+  PLAN_T_IDXS = get_plan_t_idxs(net_output_data['plan'][0,:,Plan.POSITION][:,0].astype(np.float64))
 
   # lane lines
-  modelV2.init('laneLines', 4)
-  for i in range(4):
-    lane_line = modelV2.laneLines[i]
-    fill_xyzt(lane_line, PLAN_T_IDXS, np.array(ModelConstants.X_IDXS), net_output_data['lane_lines'][0,i,:,0], net_output_data['lane_lines'][0,i,:,1])
+  lane_lines = net_output_data['lane_lines'][0].transpose(0, 2, 1).tolist()
+  for lane_line, (y, z) in zip(modelV2.laneLines, lane_lines, strict=True):
+    fill_xyzt(lane_line, PLAN_T_IDXS, None, y, z)
   modelV2.laneLineStds = net_output_data['lane_lines_stds'][0,:,0,0].tolist()
-  modelV2.laneLineProbs = net_output_data['lane_lines_prob'][0,1::2].tolist()
+  lane_line_probs = net_output_data['lane_lines_prob'][0,1::2].tolist()
+  modelV2.laneLineProbs = lane_line_probs
 
   lane_line_meta = driving_model_data.laneLineMeta
-  lane_line_meta.leftY = modelV2.laneLines[1].y[0]
-  lane_line_meta.leftProb = modelV2.laneLineProbs[1]
-  lane_line_meta.rightY = modelV2.laneLines[2].y[0]
-  lane_line_meta.rightProb = modelV2.laneLineProbs[2]
+  lane_line_meta.leftY = lane_lines[1][0][0]
+  lane_line_meta.leftProb = lane_line_probs[1]
+  lane_line_meta.rightY = lane_lines[2][0][0]
+  lane_line_meta.rightProb = lane_line_probs[2]
 
   # road edges
-  modelV2.init('roadEdges', 2)
-  for i in range(2):
-    road_edge = modelV2.roadEdges[i]
-    fill_xyzt(road_edge, PLAN_T_IDXS, np.array(ModelConstants.X_IDXS), net_output_data['road_edges'][0,i,:,0], net_output_data['road_edges'][0,i,:,1])
+  road_edges = net_output_data['road_edges'][0].transpose(0, 2, 1).tolist()
+  for road_edge, (y, z) in zip(modelV2.roadEdges, road_edges, strict=True):
+    fill_xyzt(road_edge, PLAN_T_IDXS, None, y, z)
   modelV2.roadEdgeStds = net_output_data['road_edges_stds'][0,:,0,0].tolist()
 
   # leads
-  modelV2.init('leadsV3', 3)
-  for i in range(3):
-    lead = modelV2.leadsV3[i]
-    fill_xyvat(lead, ModelConstants.LEAD_T_IDXS, *net_output_data['lead'][0,i].T, *net_output_data['lead_stds'][0,i].T)
-    lead.prob = net_output_data['lead_prob'][0,i].tolist()
-    lead.probTime = ModelConstants.LEAD_T_OFFSETS[i]
+  leads = net_output_data['lead'][0].transpose(0, 2, 1).tolist()
+  lead_stds = net_output_data['lead_stds'][0].transpose(0, 2, 1).tolist()
+  lead_probs = net_output_data['lead_prob'][0].tolist()
+  for lead, xyva, xyva_std, prob in zip(modelV2.leadsV3, leads, lead_stds, lead_probs, strict=True):
+    fill_xyvat(lead, None, *xyva, *xyva_std)
+    lead.prob = prob
 
   # meta
+  meta_probs = net_output_data['meta'][0].tolist()
   meta = modelV2.meta
   meta.desireState = net_output_data['desire_state'][0].reshape(-1).tolist()
   meta.desirePrediction = net_output_data['desire_pred'][0].reshape(-1).tolist()
-  meta.engagedProb = net_output_data['meta'][0,Meta.ENGAGED].item()
-  meta.init('disengagePredictions')
+  meta.engagedProb = meta_probs[Meta.ENGAGED][0]
   disengage_predictions = meta.disengagePredictions
-  disengage_predictions.t = ModelConstants.META_T_IDXS
-  disengage_predictions.brakeDisengageProbs = net_output_data['meta'][0,Meta.BRAKE_DISENGAGE].tolist()
-  disengage_predictions.gasDisengageProbs = net_output_data['meta'][0,Meta.GAS_DISENGAGE].tolist()
-  disengage_predictions.steerOverrideProbs = net_output_data['meta'][0,Meta.STEER_OVERRIDE].tolist()
-  disengage_predictions.brake3MetersPerSecondSquaredProbs = net_output_data['meta'][0,Meta.HARD_BRAKE_3].tolist()
-  disengage_predictions.brake4MetersPerSecondSquaredProbs = net_output_data['meta'][0,Meta.HARD_BRAKE_4].tolist()
-  disengage_predictions.brake5MetersPerSecondSquaredProbs = net_output_data['meta'][0,Meta.HARD_BRAKE_5].tolist()
+  disengage_predictions.brakeDisengageProbs = meta_probs[Meta.BRAKE_DISENGAGE]
+  disengage_predictions.gasDisengageProbs = meta_probs[Meta.GAS_DISENGAGE]
+  disengage_predictions.steerOverrideProbs = meta_probs[Meta.STEER_OVERRIDE]
+  disengage_predictions.brake3MetersPerSecondSquaredProbs = meta_probs[Meta.HARD_BRAKE_3]
+  disengage_predictions.brake4MetersPerSecondSquaredProbs = meta_probs[Meta.HARD_BRAKE_4]
+  disengage_predictions.brake5MetersPerSecondSquaredProbs = meta_probs[Meta.HARD_BRAKE_5]
 
   publish_state.prev_brake_5ms2_probs[:-1] = publish_state.prev_brake_5ms2_probs[1:]
   publish_state.prev_brake_5ms2_probs[-1] = net_output_data['meta'][0,Meta.HARD_BRAKE_5][0]
@@ -166,11 +210,13 @@ def fill_model_msg(base_msg: capnp._DynamicStructBuilder, extended_msg: capnp._D
   meta.hardBrakePredicted = hard_brake_predicted.item()
 
   # temporal pose
+  sim_pose = net_output_data['sim_pose'][0].tolist()
+  sim_pose_stds = net_output_data['sim_pose_stds'][0].tolist()
   temporal_pose = modelV2.temporalPose
-  temporal_pose.trans = net_output_data['sim_pose'][0,:3].tolist()
-  temporal_pose.transStd = net_output_data['sim_pose_stds'][0,:3].tolist()
-  temporal_pose.rot = net_output_data['sim_pose'][0,3:].tolist()
-  temporal_pose.rotStd = net_output_data['sim_pose_stds'][0,3:].tolist()
+  temporal_pose.trans = sim_pose[:3]
+  temporal_pose.transStd = sim_pose_stds[:3]
+  temporal_pose.rot = sim_pose[3:]
+  temporal_pose.rotStd = sim_pose_stds[3:]
 
   # confidence
   if vipc_frame_id % (2*ModelConstants.MODEL_FREQ) == 0:
@@ -1,21 +1,35 @@
 import numpy as np
 from openpilot.selfdrive.modeld.constants import ModelConstants
 
-def sigmoid(x):
-  return 1. / (1. + np.exp(-x))
+def sigmoid(x, out=None):
+  if out is None:
+    return 1. / (1. + np.exp(-x))
+  np.negative(x, out=out)
+  np.exp(out, out=out)
+  out += 1.
+  np.reciprocal(out, out=out)
+  return out
 
 def softmax(x, axis=-1):
-  x -= np.max(x, axis=axis, keepdims=True)
+  x -= x.max(axis=axis, keepdims=True)
   if x.dtype == np.float32 or x.dtype == np.float64:
     np.exp(x, out=x)
   else:
     x = np.exp(x)
-  x /= np.sum(x, axis=axis, keepdims=True)
+  x /= x.sum(axis=axis, keepdims=True)
   return x
 
 class Parser:
   def __init__(self, ignore_missing=False):
     self.ignore_missing = ignore_missing
+    # parsed outputs are written to the same arrays every frame
+    self.buffers: dict[str, np.ndarray] = {}
+
+  def get_buffer(self, name, shape, dtype):
+    buf = self.buffers.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+      buf = self.buffers[name] = np.empty(shape, dtype=dtype)
+    return buf
 
   def check_missing(self, outs, name):
     if name not in outs and not self.ignore_missing:
@@ -34,7 +48,7 @@ class Parser:
     if self.check_missing(outs, name):
       return
     raw = outs[name]
-    outs[name] = sigmoid(raw)
+    outs[name] = sigmoid(raw, out=self.get_buffer(name, raw.shape, raw.dtype))
 
   def parse_mdn(self, name, outs, in_N=0, out_N=1, out_shape=None):
     if self.check_missing(outs, name):
@@ -42,34 +56,30 @@ class Parser:
     raw = outs[name]
     raw = raw.reshape((raw.shape[0], max(in_N, 1), -1))
 
-    pred_mu = raw[:,:,:(raw.shape[2] - out_N)//2]
     n_values = (raw.shape[2] - out_N)//2
     pred_mu = raw[:,:,:n_values]
-    pred_std = np.exp(raw[:,:,n_values: 2*n_values])
+    pred_std = np.exp(raw[:,:,n_values: 2*n_values], out=self.get_buffer(name + '_stds', pred_mu.shape, raw.dtype))
 
     if in_N > 1:
-      weights = np.zeros((raw.shape[0], in_N, out_N), dtype=raw.dtype)
-      for i in range(out_N):
-        weights[:,:,i - out_N] = softmax(raw[:,:,i - out_N], axis=-1)
+      weights = self.get_buffer(name + '_weights', (raw.shape[0], in_N, out_N), raw.dtype)
+      weights[:] = softmax(raw[:,:,-out_N:], axis=1)
 
+      frames = np.arange(raw.shape[0])[:,np.newaxis]
       if out_N == 1:
-        for fidx in range(weights.shape[0]):
-          idxs = np.argsort(weights[fidx][:,0])[::-1]
-          weights[fidx] = weights[fidx][idxs]
-          pred_mu[fidx] = pred_mu[fidx][idxs]
-          pred_std[fidx] = pred_std[fidx][idxs]
+        # most likely hypothesis first
+        idxs = np.argsort(weights[:,:,0], axis=1)[:,::-1]
+        weights[:] = weights[frames, idxs]
+        pred_mu[:] = pred_mu[frames, idxs]
+        pred_std[:] = pred_std[frames, idxs]
       full_shape = tuple([raw.shape[0], in_N] + list(out_shape))
       outs[name + '_weights'] = weights
       outs[name + '_hypotheses'] = pred_mu.reshape(full_shape)
       outs[name + '_stds_hypotheses'] = pred_std.reshape(full_shape)
 
-      pred_mu_final = np.zeros((raw.shape[0], out_N, n_values), dtype=raw.dtype)
-      pred_std_final = np.zeros((raw.shape[0], out_N, n_values), dtype=raw.dtype)
-      for fidx in range(weights.shape[0]):
-        for hidx in range(out_N):
-          idxs = np.argsort(weights[fidx,:,hidx])[::-1]
-          pred_mu_final[fidx, hidx] = pred_mu[fidx, idxs[0]]
-          pred_std_final[fidx, hidx] = pred_std[fidx, idxs[0]]
+      # most likely hypothesis for each selection
+      best = np.argmax(weights, axis=1)
+      pred_mu_final = pred_mu[frames, best]
+      pred_std_final = pred_std[frames, best]
     else:
       pred_mu_final = pred_mu
       pred_std_final = pred_std
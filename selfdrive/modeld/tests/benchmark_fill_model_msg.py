@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import os
+import time
+
+import numpy as np
+
+import cereal.messaging as messaging
+from openpilot.selfdrive.modeld.constants import ModelConstants
+from openpilot.selfdrive.modeld.fill_model_msg import ModelMsgTemplates, PublishState, fill_model_msg, get_plan_t_idxs
+from openpilot.selfdrive.modeld.parse_model_outputs import Parser
+from openpilot.selfdrive.modeld.tests.benchmark_parser import OUTPUT_SIZES, sliced_outputs
+
+N = int(os.getenv("N", "2000"))
+
+
+def loop_plan_t_idxs(plan_x):
+  # walks the plan from the start for every X_IDXS point
+  plan_t_idxs = [np.nan] * ModelConstants.IDX_N
+  plan_t_idxs[0] = 0.0
+  plan_x = plan_x.tolist()
+  for xidx in range(1, ModelConstants.IDX_N):
+    tidx = 0
+    while tidx < ModelConstants.IDX_N - 1 and plan_x[tidx+1] < ModelConstants.X_IDXS[xidx]:
+      tidx += 1
+    if tidx == ModelConstants.IDX_N - 1:
+      plan_t_idxs[xidx] = ModelConstants.T_IDXS[ModelConstants.IDX_N - 1]
+      break
+    current_x_val = plan_x[tidx]
+    next_x_val = plan_x[tidx+1]
+    p = (ModelConstants.X_IDXS[xidx] - current_x_val) / (next_x_val - current_x_val) if abs(next_x_val - current_x_val) > 1e-9 else float('nan')
+    plan_t_idxs[xidx] = p * ModelConstants.T_IDXS[tidx+1] + (1 - p) * ModelConstants.T_IDXS[tidx]
+  return plan_t_idxs
+
+
+def new_messages():
+  return messaging.new_message('drivingModelData'), messaging.new_message('modelV2')
+
+
+def benchmark(outputs, make_messages, constants_filled):
+  publish_state = PublishState()
+  t = time.perf_counter()
+  for i, outs in enumerate(outputs):
+    base_msg, extended_msg = make_messages()
+    fill_model_msg(base_msg, extended_msg, outs, publish_state, i, i, i, 0., 0, 0.01, True, constants_filled=constants_filled)
+    extended_msg.to_bytes()
+  return (time.perf_counter() - t) / len(outputs)
+
+
+if __name__ == "__main__":
+  np.random.seed(0)
+  n_outputs = sum(OUTPUT_SIZES.values())
+  outputs = []
+  for _ in range(N):
+    outs = Parser().parse_outputs(sliced_outputs(np.random.normal(0, 2, n_outputs).astype(np.float32)))
+    # a plan driving forward at 20 to 30 m/s
+    outs['plan'][0, :, 0] = np.array(ModelConstants.T_IDXS) * np.random.uniform(20, 30)
+    outputs.append(outs)
+
+  templates = ModelMsgTemplates()
+  for name, make_messages, constants_filled in [("new messages", new_messages, False), ("templates", templates.new_messages, True)]:
+    print(f"{name:>16}: {benchmark(outputs, make_messages, constants_filled) * 1e6:6.1f} us per frame")
+
+  plans = [outs['plan'][0, :, 0].astype(np.float64) for outs in outputs]
+  for plan_x in plans:
+    np.testing.assert_array_equal(get_plan_t_idxs(plan_x), loop_plan_t_idxs(plan_x))
+  for name, f in [("plan t, loop", loop_plan_t_idxs), ("plan t, searched", get_plan_t_idxs)]:
+    t = time.perf_counter()
+    for plan_x in plans:
+      f(plan_x)
+    print(f"{name:>16}: {(time.perf_counter() - t) / N * 1e6:6.1f} us per frame")
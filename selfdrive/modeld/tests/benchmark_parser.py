@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import os
+import time
+
+import numpy as np
+
+from openpilot.selfdrive.modeld.constants import ModelConstants, Meta
+from openpilot.selfdrive.modeld.parse_model_outputs import Parser, softmax
+
+N = int(os.getenv("N", "2000"))
+
+
+def mdn_width(in_N, out_N, out_shape):
+  return max(in_N, 1) * (2 * int(np.prod(out_shape)) + out_N)
+
+
+# driving model outputs parsed by Parser.parse_outputs, and their sizes
+OUTPUT_SIZES = {
+  'plan': mdn_width(ModelConstants.PLAN_MHP_N, ModelConstants.PLAN_MHP_SELECTION, (ModelConstants.IDX_N, ModelConstants.PLAN_WIDTH)),
+  'lane_lines': mdn_width(0, 0, (ModelConstants.NUM_LANE_LINES, ModelConstants.IDX_N, ModelConstants.LANE_LINES_WIDTH)),
+  'road_edges': mdn_width(0, 0, (ModelConstants.NUM_ROAD_EDGES, ModelConstants.IDX_N, ModelConstants.LANE_LINES_WIDTH)),
+  'pose': mdn_width(0, 0, (ModelConstants.POSE_WIDTH,)),
+  'road_transform': mdn_width(0, 0, (ModelConstants.POSE_WIDTH,)),
+  'sim_pose': mdn_width(0, 0, (ModelConstants.POSE_WIDTH,)),
+  'wide_from_device_euler': mdn_width(0, 0, (ModelConstants.WIDE_FROM_DEVICE_WIDTH,)),
+  'lead': mdn_width(ModelConstants.LEAD_MHP_N, ModelConstants.LEAD_MHP_SELECTION, (ModelConstants.LEAD_TRAJ_LEN, ModelConstants.LEAD_WIDTH)),
+  'desired_curvature': mdn_width(0, 0, (ModelConstants.DESIRED_CURV_WIDTH,)),
+  'lead_prob': ModelConstants.LEAD_MHP_SELECTION,
+  'lane_lines_prob': 2 * ModelConstants.NUM_LANE_LINES,
+  'meta': Meta.RIGHT_BLINKER.stop,
+  'desire_state': ModelConstants.DESIRE_PRED_WIDTH,
+  'desire_pred': ModelConstants.DESIRE_PRED_LEN * ModelConstants.DESIRE_PRED_WIDTH,
+  'hidden_state': ModelConstants.FEATURE_LEN,
+}
+
+
+class LoopParser(Parser):
+  """Selects hypotheses frame by frame and allocates new arrays on every call"""
+  def parse_binary_crossentropy(self, name, outs):
+    if self.check_missing(outs, name):
+      return
+    outs[name] = 1. / (1. + np.exp(-outs[name]))
+
+  def parse_mdn(self, name, outs, in_N=0, out_N=1, out_shape=None):
+    if self.check_missing(outs, name):
+      return
+    raw = outs[name]
+    raw = raw.reshape((raw.shape[0], max(in_N, 1), -1))
+
+    n_values = (raw.shape[2] - out_N)//2
+    pred_mu = raw[:,:,:n_values]
+    pred_std = np.exp(raw[:,:,n_values: 2*n_values])
+
+    if in_N > 1:
+      weights = np.zeros((raw.shape[0], in_N, out_N), dtype=raw.dtype)
+      for i in range(out_N):
+        weights[:,:,i - out_N] = softmax(raw[:,:,i - out_N], axis=-1)
+
+      if out_N == 1:
+        for fidx in range(weights.shape[0]):
+          idxs = np.argsort(weights[fidx][:,0])[::-1]
+          weights[fidx] = weights[fidx][idxs]
+          pred_mu[fidx] = pred_mu[fidx][idxs]
+          pred_std[fidx] = pred_std[fidx][idxs]
+      full_shape = tuple([raw.shape[0], in_N] + list(out_shape))
+      outs[name + '_weights'] = weights
+      outs[name + '_hypotheses'] = pred_mu.reshape(full_shape)
+      outs[name + '_stds_hypotheses'] = pred_std.reshape(full_shape)
+
+      pred_mu_final = np.zeros((raw.shape[0], out_N, n_values), dtype=raw.dtype)
+      pred_std_final = np.zeros((raw.shape[0], out_N, n_values), dtype=raw.dtype)
+      for fidx in range(weights.shape[0]):
+        for hidx in range(out_N):
+          idxs = np.argsort(weights[fidx,:,hidx])[::-1]
+          pred_mu_final[fidx, hidx] = pred_mu[fidx, idxs[0]]
+          pred_std_final[fidx, hidx] = pred_std[fidx, idxs[0]]
+    else:
+      pred_mu_final = pred_mu
+      pred_std_final = pred_std
+
+    if out_N > 1:
+      final_shape = tuple([raw.shape[0], out_N] + list(out_shape))
+    else:
+      final_shape = tuple([raw.shape[0],] + list(out_shape))
+    outs[name] = pred_mu_final.reshape(final_shape)
+    outs[name + '_stds'] = pred_std_final.reshape(final_shape)
+
+
+def sliced_outputs(output):
+  # as modeld slices the network output, the parser gets views into it
+  slices, start = {}, 0
+  for name, size in OUTPUT_SIZES.items():
+    slices[name] = slice(start, start + size)
+    start += size
+  return {k: output[np.newaxis, v] for k, v in slices.items()}
+
+
+def benchmark(parser, frames):
+  output = np.zeros_like(frames[0])
+  t = time.perf_counter()
+  for frame in frames:
+    output[:] = frame
+    outs = parser.parse_outputs(sliced_outputs(output))
+  return (time.perf_counter() - t) / len(frames), outs
+
+
+if __name__ == "__main__":
+  np.random.seed(0)
+  n_outputs = sum(OUTPUT_SIZES.values())
+  frames = [np.random.normal(0, 2, n_outputs).astype(np.float32) for _ in range(N)]
+
+  results = {}
+  for name, parser in [("per frame loops", LoopParser()), ("vectorized", Parser())]:
+    dt, results[name] = benchmark(parser, frames)
+    print(f"{name:>16}: {dt * 1e6:6.1f} us per frame")
+
+  for k, v in results["per frame loops"].items():
+    np.testing.assert_array_equal(results["vectorized"][k], v, err_msg=k)
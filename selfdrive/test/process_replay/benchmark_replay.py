@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import dataclasses
+import time
+from collections import deque
+from typing import Any
+
+import capnp
+
+from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, IN_PROCESS_PROCS, ProcessConfig, _replay_loop, replay_process
+from openpilot.selfdrive.test.process_replay.test_processes import EXCLUDED_PROCS, segments
+from openpilot.tools.lib.filereader import FileReader
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+
+class RecordedContainer:
+  """
+  Stands in for a ProcessContainer without starting the process: messages are queued and flushed the same way,
+  and the process outputs recorded in the log are returned instead, so only the replay loop itself is measured.
+  """
+  def __init__(self, cfg: ProcessConfig, all_msgs):
+    self.cfg = copy.deepcopy(cfg)
+    self.msg_queue: list[capnp._DynamicStructReader] = []
+    self.cnt = 0
+    self.outputs = deque(m for m in all_msgs if m.which() in self.cfg.subs)
+
+  @property
+  def has_empty_queue(self) -> bool:
+    return len(self.msg_queue) == 0
+
+  @property
+  def pubs(self) -> list[str]:
+    return self.cfg.pubs
+
+  @property
+  def subs(self) -> list[str]:
+    return self.cfg.subs
+
+  def run_step(self, msg, frs):
+    end_of_cycle = True
+    if self.cfg.should_recv_callback is not None:
+      end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
+
+    self.msg_queue.append(msg)
+    if not end_of_cycle:
+      return []
+
+    self.msg_queue = []
+    output_msgs = []
+    while len(self.outputs) and self.outputs[0].logMonoTime <= msg.logMonoTime:
+      m = self.outputs.popleft().as_builder()
+      m.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
+      output_msgs.append(m.as_reader())
+    self.cnt += 1
+    return output_msgs
+
+
+def benchmark_migration(all_msgs) -> tuple[float, dict[str, float]]:
+  timings: dict[str, float] = {}
+  t = time.monotonic()
+  migrate_all(all_msgs, old_logtime=True, manager_states=True, panda_states=True, camera_states=True, timings=timings)
+  return time.monotonic() - t, timings
+
+
+def benchmark_scheduler(cfg: ProcessConfig, all_msgs) -> tuple[int, float]:
+  # duck typed as a ProcessContainer
+  containers: list[Any] = [RecordedContainer(cfg, all_msgs)]
+  n_msgs = sum(1 for m in all_msgs if m.which() in cfg.pubs)
+  t = time.monotonic()
+  _replay_loop(containers, all_msgs, None, True)
+  return n_msgs, time.monotonic() - t
+
+
+def benchmark_replay(cfg: ProcessConfig, lr) -> tuple[int, float]:
+  n_msgs = sum(1 for m in lr if m.which() in cfg.pubs)
+  t = time.monotonic()
+  replay_process(cfg, lr, disable_progress=True)
+  return n_msgs, time.monotonic() - t
+
+
+if __name__ == "__main__":
+  all_procs = [cfg.proc_name for cfg in CONFIGS if cfg.proc_name not in EXCLUDED_PROCS]
+
+  parser = argparse.ArgumentParser(description="Measures process replay throughput in messages/second for each process config")
+  parser.add_argument("--procs", type=str, nargs="*", default=all_procs, help="Processes to benchmark (e.g. controlsd)")
+  parser.add_argument("--car", type=str, default="TOYOTA", help="Car of the test_processes segment to replay (e.g. HONDA)")
+  parser.add_argument("--scheduler-only", action="store_true",
+                      help="Replace processes with their recorded outputs, to only measure the replay loop")
+  parser.add_argument("--in-process", action="store_true", help="Replay the processes in IN_PROCESS_PROCS in a thread instead of a subprocess")
+  args = parser.parse_args()
+
+  segment = next(seg for car, seg in segments if car == args.car.upper())
+  # read into memory as test_processes does, so log messages are published with their bytes from the log
+  with FileReader(get_url(*segment.rsplit("--", 1))) as f:
+    lr = LogReader.from_bytes(f.read())
+  all_msgs = list(lr)
+
+  dt, timings = benchmark_migration(all_msgs)
+  print(f"{segment}, migration of {len(all_msgs)} msgs in {dt:6.2f}s")
+  for name, migration_time in timings.items():
+    print(f"{name:>30}: {migration_time:6.3f}s")
+
+  if args.scheduler_only:
+    # replay_process migrates and sorts the logs itself
+    all_msgs = sorted(migrate_all(all_msgs, old_logtime=True, manager_states=True, panda_states=True, camera_states=True), key=lambda m: m.logMonoTime)
+
+  print(f"{segment}, {'scheduler only' if args.scheduler_only else 'full replay'}")
+  for cfg in CONFIGS:
+    if cfg.proc_name not in args.procs:
+      continue
+
+    if args.in_process and cfg.proc_name in IN_PROCESS_PROCS:
+      cfg = dataclasses.replace(cfg, in_process=True)
+    n_msgs, dt = benchmark_scheduler(cfg, all_msgs) if args.scheduler_only else benchmark_replay(cfg, lr)
+    mode = "in-process" if cfg.in_process else "subprocess"
+    print(f"{cfg.proc_name:>20} ({mode:>10}): {n_msgs:6d} msgs in {dt:6.2f}s, {n_msgs / dt:9.1f} msgs/s")
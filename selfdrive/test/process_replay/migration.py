@@ -1,94 +1,158 @@
+import time
 from collections import defaultdict
+from collections.abc import Callable
+from functools import partial
+from typing import Any
+
+import capnp
 
 from cereal import messaging
 from openpilot.selfdrive.car.fingerprints import MIGRATION
 from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_encode_index
 from openpilot.selfdrive.car.toyota.values import EPS_SCALE
 from openpilot.system.manager.process_config import managed_processes
+from openpilot.tools.lib.logreader import LogIterable
 from panda import Panda
 
-
-# TODO: message migration should happen in-place
-def migrate_all(lr, old_logtime=False, manager_states=False, panda_states=False, camera_states=False):
-  msgs = migrate_sensorEvents(lr, old_logtime)
-  msgs = migrate_carParams(msgs, old_logtime)
-  msgs = migrate_gpsLocation(msgs)
-  msgs = migrate_deviceState(msgs)
-  msgs = migrate_carOutput(msgs)
+# Position of a message in the migrated log. Messages of the input log are (index,), the messages replacing a
+# message are its key with their own index appended, so sorting keys gives the migrated log order.
+MsgKey = tuple[int, ...]
+MessageWithKey = tuple[MsgKey, capnp._DynamicStructReader]
+# Migrations get the messages of their input types in log order, and return the messages to replace, each with the
+# list of messages taking its place (empty to drop it)
+Replacements = list[tuple[MsgKey, list[capnp._DynamicStructReader]]]
+MigrationFunc = Callable[[list[MessageWithKey]], Replacements]
+
+
+def migration(inputs: list[str], product: str | None = None):
+  """Registers the message types a migration function reads and replaces. If the log already has its
+     product message type, the migration is skipped."""
+  def decorator(func: MigrationFunc) -> MigrationFunc:
+    func.inputs = inputs  # type: ignore[attr-defined]
+    func.product = product  # type: ignore[attr-defined]
+    return func
+  return decorator
+
+
+def migrate_all(lr: LogIterable, old_logtime=False, manager_states=False, panda_states=False, camera_states=False,
+                timings: dict[str, float] = None) -> list[capnp._DynamicStructReader]:
+  migrations: list[MigrationFunc] = [
+    partial(migrate_sensorEvents, old_logtime=old_logtime),
+    partial(migrate_carParams, old_logtime=old_logtime),
+    migrate_gpsLocation,
+    migrate_deviceState,
+    migrate_carOutput,
+  ]
   if manager_states:
-    msgs = migrate_managerState(msgs)
+    migrations.append(migrate_managerState)
   if panda_states:
-    msgs = migrate_pandaStates(msgs)
-    msgs = migrate_peripheralState(msgs)
+    migrations.extend([migrate_pandaStates, migrate_peripheralState])
   if camera_states:
-    msgs = migrate_cameraStates(msgs)
-
-  return msgs
-
+    migrations.append(migrate_cameraStates)
+
+  return migrate(lr, migrations, timings)
+
+
+def migrate(lr: LogIterable, migrations: list[MigrationFunc], timings: dict[str, float] = None) -> list[capnp._DynamicStructReader]:
+  """Runs migrations in order over the log, each only on the messages of its input types. Messages no
+     migration reads are passed through untouched. The time each migration took is added to timings."""
+  msgs = list(lr)
+  keys_by_type: defaultdict[str, list[MsgKey]] = defaultdict(list)
+  for i, msg in enumerate(msgs):
+    keys_by_type[msg.which()].append((i,))
+
+  migrated: dict[MsgKey, capnp._DynamicStructReader] = {}
+  replaced: dict[MsgKey, list[MsgKey]] = {}
+
+  def get_msg(key: MsgKey) -> capnp._DynamicStructReader:
+    return msgs[key[0]] if len(key) == 1 else migrated[key]
+
+  for migration_func in migrations:
+    # inputs and product are set on the function by the migration decorator
+    func: Any = migration_func.func if isinstance(migration_func, partial) else migration_func
+    inputs, product = func.inputs, func.product
+    t = time.perf_counter()
+
+    if product is None or all(key in replaced for key in keys_by_type.get(product, [])):
+      keys = sorted(key for msg_type in inputs for key in keys_by_type.get(msg_type, []) if key not in replaced)
+      for key, new_msgs in migration_func([(key, get_msg(key)) for key in keys]):
+        replaced[key] = [(*key, j) for j in range(len(new_msgs))]
+        for new_key, new_msg in zip(replaced[key], new_msgs, strict=True):
+          migrated[new_key] = new_msg
+          keys_by_type[new_msg.which()].append(new_key)
+
+    if timings is not None:
+      timings[func.__name__] = timings.get(func.__name__, 0.) + time.perf_counter() - t
+
+  def migrated_msgs(key: MsgKey):
+    if key in replaced:
+      for new_key in replaced[key]:
+        yield from migrated_msgs(new_key)
+    else:
+      yield get_msg(key)
 
-def migrate_managerState(lr):
   all_msgs = []
-  for msg in lr:
-    if msg.which() != "managerState":
+  for i, msg in enumerate(msgs):
+    if (i,) in replaced:
+      all_msgs.extend(migrated_msgs((i,)))
+    else:
       all_msgs.append(msg)
-      continue
+  return all_msgs
+
 
+@migration(inputs=["managerState"])
+def migrate_managerState(msgs):
+  ops = []
+  for key, msg in msgs:
     new_msg = msg.as_builder()
     new_msg.managerState.processes = [{'name': name, 'running': True} for name in managed_processes]
-    all_msgs.append(new_msg.as_reader())
-
-  return all_msgs
+    ops.append((key, [new_msg.as_reader()]))
+  return ops
 
 
-def migrate_gpsLocation(lr):
-  all_msgs = []
-  for msg in lr:
-    if msg.which() in ('gpsLocation', 'gpsLocationExternal'):
+@migration(inputs=["gpsLocation", "gpsLocationExternal"])
+def migrate_gpsLocation(msgs):
+  ops = []
+  for key, msg in msgs:
+    g = getattr(msg, msg.which())
+    # hasFix is a newer field
+    if not g.hasFix and g.flags == 1:
       new_msg = msg.as_builder()
-      g = getattr(new_msg, new_msg.which())
-      # hasFix is a newer field
-      if not g.hasFix and g.flags == 1:
-        g.hasFix = True
-      all_msgs.append(new_msg.as_reader())
-    else:
-      all_msgs.append(msg)
-  return all_msgs
+      getattr(new_msg, new_msg.which()).hasFix = True
+      ops.append((key, [new_msg.as_reader()]))
+  return ops
 
 
-def migrate_deviceState(lr):
-  all_msgs = []
+@migration(inputs=["initData", "deviceState"])
+def migrate_deviceState(msgs):
+  ops = []
   dt = None
-  for msg in lr:
+  for key, msg in msgs:
     if msg.which() == 'initData':
       dt = msg.initData.deviceType
-    if msg.which() == 'deviceState':
+    else:
       n = msg.as_builder()
       n.deviceState.deviceType = dt
-      all_msgs.append(n.as_reader())
-    else:
-      all_msgs.append(msg)
-  return all_msgs
-
-
-def migrate_carOutput(lr):
-  # migration needed only for routes before carOutput
-  if any(msg.which() == 'carOutput' for msg in lr):
-    return lr
-
-  all_msgs = []
-  for msg in lr:
-    if msg.which() == 'carControl':
-      co = messaging.new_message('carOutput')
-      co.valid = msg.valid
-      co.logMonoTime = msg.logMonoTime
-      co.carOutput.actuatorsOutput = msg.carControl.actuatorsOutputDEPRECATED
-      all_msgs.append(co.as_reader())
-    all_msgs.append(msg)
-  return all_msgs
-
-
-def migrate_pandaStates(lr):
-  all_msgs = []
+      ops.append((key, [n.as_reader()]))
+  return ops
+
+
+# migration needed only for routes before carOutput
+@migration(inputs=["carControl"], product="carOutput")
+def migrate_carOutput(msgs):
+  ops = []
+  for key, msg in msgs:
+    co = messaging.new_message('carOutput')
+    co.valid = msg.valid
+    co.logMonoTime = msg.logMonoTime
+    co.carOutput.actuatorsOutput = msg.carControl.actuatorsOutputDEPRECATED
+    ops.append((key, [co.as_reader(), msg]))
+  return ops
+
+
+@migration(inputs=["carParams", "pandaStates", "pandaStateDEPRECATED"])
+def migrate_pandaStates(msgs):
+  ops = []
   # TODO: safety param migration should be handled automatically
   safety_param_migration = {
     "TOYOTA_PRIUS": EPS_SCALE["TOYOTA_PRIUS"] | Panda.FLAG_TOYOTA_STOCK_LONGITUDINAL,
@@ -97,7 +161,7 @@ def migrate_pandaStates(lr):
   }
 
   # Migrate safety param base on carState
-  CP = next((m.carParams for m in lr if m.which() == 'carParams'), None)
+  CP = next((m.carParams for _, m in msgs if m.which() == 'carParams'), None)
   assert CP is not None, "carParams message not found"
   if CP.carFingerprint in safety_param_migration:
     safety_param = safety_param_migration[CP.carFingerprint]
@@ -108,49 +172,42 @@ def migrate_pandaStates(lr):
   else:
     safety_param = CP.safetyParamDEPRECATED
 
-  for msg in lr:
+  for key, msg in msgs:
     if msg.which() == 'pandaStateDEPRECATED':
       new_msg = messaging.new_message('pandaStates', 1)
       new_msg.valid = msg.valid
       new_msg.logMonoTime = msg.logMonoTime
       new_msg.pandaStates[0] = msg.pandaStateDEPRECATED
       new_msg.pandaStates[0].safetyParam = safety_param
-      all_msgs.append(new_msg.as_reader())
+      ops.append((key, [new_msg.as_reader()]))
     elif msg.which() == 'pandaStates':
       new_msg = msg.as_builder()
       new_msg.pandaStates[-1].safetyParam = safety_param
-      all_msgs.append(new_msg.as_reader())
-    else:
-      all_msgs.append(msg)
-
-  return all_msgs
+      ops.append((key, [new_msg.as_reader()]))
 
+  return ops
 
-def migrate_peripheralState(lr):
-  if any(msg.which() == "peripheralState" for msg in lr):
-    return lr
-
-  all_msg = []
-  for msg in lr:
-    all_msg.append(msg)
-    if msg.which() not in ["pandaStates", "pandaStateDEPRECATED"]:
-      continue
 
+@migration(inputs=["pandaStates", "pandaStateDEPRECATED"], product="peripheralState")
+def migrate_peripheralState(msgs):
+  ops = []
+  for key, msg in msgs:
     new_msg = messaging.new_message("peripheralState")
     new_msg.valid = msg.valid
     new_msg.logMonoTime = msg.logMonoTime
-    all_msg.append(new_msg.as_reader())
+    ops.append((key, [msg, new_msg.as_reader()]))
 
-  return all_msg
+  return ops
 
 
-def migrate_cameraStates(lr):
-  all_msgs = []
+@migration(inputs=["roadEncodeIdx", "wideRoadEncodeIdx", "driverEncodeIdx", "roadCameraState", "wideRoadCameraState", "driverCameraState"])
+def migrate_cameraStates(msgs):
+  ops = []
   frame_to_encode_id = defaultdict(dict)
   # just for encodeId fallback mechanism
   min_frame_id = defaultdict(lambda: float('inf'))
 
-  for msg in lr:
+  for _, msg in msgs:
     if msg.which() not in ["roadEncodeIdx", "wideRoadEncodeIdx", "driverEncodeIdx"]:
       continue
 
@@ -160,9 +217,8 @@ def migrate_cameraStates(lr):
     assert encode_index.segmentId < 1200, f"Encoder index segmentId greater that 1200: {msg.which()} {encode_index.segmentId}"
     frame_to_encode_id[meta.camera_state][encode_index.frameId] = encode_index.segmentId
 
-  for msg in lr:
+  for key, msg in msgs:
     if msg.which() not in ["roadCameraState", "wideRoadCameraState", "driverCameraState"]:
-      all_msgs.append(msg)
       continue
 
     camera_state = getattr(msg, msg.which())
@@ -172,6 +228,7 @@ def migrate_cameraStates(lr):
     if encode_id is None:
       print(f"Missing encoded frame for camera feed {msg.which()} with frameId: {camera_state.frameId}")
       if len(frame_to_encode_id[msg.which()]) != 0:
+        ops.append((key, []))
         continue
 
       # fallback mechanism for logs without encodeIdx (e.g. logs from before 2022 with dcamera recording disabled)
@@ -192,35 +249,32 @@ def migrate_cameraStates(lr):
     new_msg.logMonoTime = msg.logMonoTime
     new_msg.valid = msg.valid
 
-    all_msgs.append(new_msg.as_reader())
+    ops.append((key, [new_msg.as_reader()]))
 
-  return all_msgs
+  return ops
 
 
-def migrate_carParams(lr, old_logtime=False):
-  all_msgs = []
-  for msg in lr:
-    if msg.which() == 'carParams':
-      CP = msg.as_builder()
-      CP.carParams.carFingerprint = MIGRATION.get(CP.carParams.carFingerprint, CP.carParams.carFingerprint)
-      for car_fw in CP.carParams.carFw:
-        car_fw.brand = CP.carParams.carName
-      if old_logtime:
-        CP.logMonoTime = msg.logMonoTime
-      msg = CP.as_reader()
-    all_msgs.append(msg)
+@migration(inputs=["carParams"])
+def migrate_carParams(msgs, old_logtime=False):
+  ops = []
+  for key, msg in msgs:
+    CP = msg.as_builder()
+    CP.carParams.carFingerprint = MIGRATION.get(CP.carParams.carFingerprint, CP.carParams.carFingerprint)
+    for car_fw in CP.carParams.carFw:
+      car_fw.brand = CP.carParams.carName
+    if old_logtime:
+      CP.logMonoTime = msg.logMonoTime
+    ops.append((key, [CP.as_reader()]))
 
-  return all_msgs
+  return ops
 
 
-def migrate_sensorEvents(lr, old_logtime=False):
-  all_msgs = []
-  for msg in lr:
-    if msg.which() != 'sensorEventsDEPRECATED':
-      all_msgs.append(msg)
-      continue
-
+@migration(inputs=["sensorEventsDEPRECATED"])
+def migrate_sensorEvents(msgs, old_logtime=False):
+  ops = []
+  for key, msg in msgs:
     # migrate to split sensor events
+    new_msgs = []
     for evt in msg.sensorEventsDEPRECATED:
       # build new message for each sensor type
       sensor_service = ''
@@ -249,6 +303,7 @@ def migrate_sensorEvents(lr, old_logtime=False):
         m_dat.timestamp = evt.timestamp
       setattr(m_dat, evt.which(), getattr(evt, evt.which()))
 
-      all_msgs.append(m.as_reader())
+      new_msgs.append(m.as_reader())
+    ops.append((key, new_msgs))
 
-  return all_msgs
+  return ops
@@ -85,6 +85,8 @@ if __name__ == "__main__":
   # run replays
   if not NO_MODEL:
     log_msgs += model_replay(lr, frs)
+  for fr in frs.values():
+    fr.close()
 
   # get diff
   failed = False
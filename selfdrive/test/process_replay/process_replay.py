@@ -2,11 +2,14 @@
 import os
 import time
 import copy
+import gc
 import json
 import heapq
+import importlib
 import signal
+import struct
 import platform
-from collections import Counter, OrderedDict
+from collections import Counter, OrderedDict, deque
 from dataclasses import dataclass, field
 from typing import Any
 from collections.abc import Callable, Iterable
@@ -27,6 +30,7 @@ from openpilot.system.manager.process_config import managed_processes
 from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_camera_state, available_streams
 from openpilot.selfdrive.test.process_replay.migration import migrate_all
 from openpilot.selfdrive.test.process_replay.capture import ProcessOutputCapture
+from openpilot.selfdrive.test.profiling.lib import LockstepSockets
 from openpilot.tools.lib.logreader import LogIterable
 from openpilot.tools.lib.framereader import BaseFrameReader
 
@@ -48,6 +52,54 @@ class DummySocket:
   def send(self, data: bytes):
     self.data.append(data)
 
+def set_log_mono_time(dat: bytearray, log_mono_time: int) -> bool:
+  """
+  Sets logMonoTime of a serialized Event in place, returns False if the message layout isn't the one it handles.
+  https://capnproto.org/encoding.html
+  """
+  if len(dat) < 8:
+    return False
+  num_segments = struct.unpack_from("<I", dat, 0)[0] + 1
+  seg_start = 4 * (num_segments + 1)
+  seg_start += seg_start % 8
+  if len(dat) < seg_start + 8:
+    return False
+
+  # the root pointer must be a struct pointer, with logMonoTime as the first word of its data section
+  ptr = struct.unpack_from("<Q", dat, seg_start)[0]
+  offset = (ptr & 0xffffffff) >> 2
+  if offset & (1 << 29):
+    offset -= 1 << 30
+  data_words = (ptr >> 32) & 0xffff
+  pos = seg_start + 8 * (offset + 1)
+  if ptr & 3 != 0 or data_words == 0 or pos < seg_start + 8 or pos + 8 > seg_start + 8 * struct.unpack_from("<I", dat, 4)[0]:
+    return False
+
+  struct.pack_into("<Q", dat, pos, log_mono_time)
+  return True
+
+
+class MessageBytes:
+  """
+  Serialized messages to publish, shared by the containers of a replay. Log messages are published as read from
+  the log when their bytes are known, and process outputs as received, other messages are serialized once.
+  """
+  def __init__(self, raw_msgs: Iterable[tuple[capnp._DynamicStructReader, bytes]] = ()):
+    # keyed by id, the message is kept alive along with its bytes
+    self.msgs: dict[int, tuple[capnp._DynamicStructReader, bytes]] = {}
+    for msg, dat in raw_msgs:
+      self.add(msg, dat)
+
+  def add(self, msg: capnp._DynamicStructReader, dat: bytes):
+    self.msgs[id(msg)] = (msg, dat)
+
+  def get(self, msg: capnp._DynamicStructReader) -> bytes:
+    if (entry := self.msgs.get(id(msg))) is None:
+      entry = (msg, msg.as_builder().to_bytes())
+      self.msgs[id(msg)] = entry
+    return entry[1]
+
+
 class LauncherWithCapture:
   def __init__(self, capture: ProcessOutputCapture, launcher: Callable):
     self.capture = capture
@@ -126,6 +178,44 @@ class ReplayContext:
       self.all_recv_called_events[index].wait()
 
 
+class LockstepReplayContext:
+  """
+  ReplayContext of a process running in a thread of the replay (see InProcessContainer), with in-memory sockets
+  locked and unlocked the same way as msgq's fake events.
+  """
+  def __init__(self, cfg):
+    self.main_pub = cfg.main_pub
+    self.main_pub_drained = cfg.main_pub_drained
+    if self.main_pub is None:
+      self.locked_pubs = [pub for pub in cfg.pubs if pub not in cfg.unlocked_pubs]
+    else:
+      self.locked_pubs = [self.main_pub]
+    self.sockets = LockstepSockets(self.locked_pubs)
+
+  def open_context(self):
+    self.sockets.install()
+
+  def close_context(self):
+    self.sockets.stop(timeout=10)
+
+  def send_sync(self, pm, endpoint, dat):
+    self.sockets.wait_for_recv()
+    pm.send(endpoint, dat)
+    self.sockets.unlock([endpoint])
+
+  def unlock_sockets(self):
+    self.sockets.unlock(self.locked_pubs)
+
+  def wait_for_recv_called(self):
+    self.sockets.wait_for_recv()
+
+  def wait_for_next_recv(self, trigger_empty_recv):
+    self.sockets.wait_for_recv()
+    if self.main_pub is not None and self.main_pub_drained and trigger_empty_recv:
+      self.sockets.unlock([self.main_pub])
+      self.sockets.wait_for_recv()
+
+
 @dataclass
 class ProcessConfig:
   proc_name: str
@@ -144,18 +234,56 @@ class ProcessConfig:
   vision_pubs: list[str] = field(default_factory=list)
   ignore_alive_pubs: list[str] = field(default_factory=list)
   unlocked_pubs: list[str] = field(default_factory=list)
+  # opt-in: run the process main in a thread of the replay instead of a subprocess, see InProcessContainer
+  in_process: bool = False
+
+
+class ReplayScheduler:
+  """
+  Orders messages to replay by logMonoTime, merging the (already sorted) messages from logs with messages generated
+  by the processes. Generated messages are only scheduled while some container has queued messages left to flush.
+  """
+  def __init__(self, log_msgs: Iterable[capnp._DynamicStructReader]):
+    self.log_queue: deque[capnp._DynamicStructReader] = deque(log_msgs)
+    # heap of (logMonoTime, insertion count, msg), the count keeps generated messages with equal times in order
+    self.generated_heap: list[tuple[int, int, capnp._DynamicStructReader]] = []
+    self.generated_cnt = 0
+    # ids of containers with messages queued, but not yet sent to their process
+    self.pending_containers: set[int] = set()
+
+  @property
+  def done(self) -> bool:
+    return len(self.log_queue) == 0 and (len(self.generated_heap) == 0 or len(self.pending_containers) == 0)
+
+  def push(self, msg: capnp._DynamicStructReader):
+    heapq.heappush(self.generated_heap, (msg.logMonoTime, self.generated_cnt, msg))
+    self.generated_cnt += 1
+
+  def update(self, container: 'ProcessContainer'):
+    if container.has_empty_queue:
+      self.pending_containers.discard(id(container))
+    else:
+      self.pending_containers.add(id(container))
+
+  def pop(self) -> tuple[capnp._DynamicStructReader, bool]:
+    """Next message to replay, and whether it was taken from logs"""
+    if len(self.generated_heap) == 0 or (len(self.log_queue) != 0 and self.log_queue[0].logMonoTime < self.generated_heap[0][0]):
+      return self.log_queue.popleft(), True
+    return heapq.heappop(self.generated_heap)[2], False
 
 
 class ProcessContainer:
-  def __init__(self, cfg: ProcessConfig):
+  def __init__(self, cfg: ProcessConfig, msg_bytes: MessageBytes | None = None):
     self.prefix = OpenpilotPrefix(clean_dirs_on_exit=False)
     self.cfg = copy.deepcopy(cfg)
     self.process = copy.deepcopy(managed_processes[cfg.proc_name])
     self.msg_queue: list[capnp._DynamicStructReader] = []
+    # shared with the other containers, so messages passed between processes are only serialized once
+    self.msg_bytes = msg_bytes if msg_bytes is not None else MessageBytes()
     self.cnt = 0
     self.pm: messaging.PubMaster | None = None
     self.sockets: list[messaging.SubSocket] | None = None
-    self.rc: ReplayContext | None = None
+    self.rc: ReplayContext | LockstepReplayContext | None = None
     self.vipc_server: VisionIpcServer | None = None
     self.environ_config: dict[str, Any] | None = None
     self.capture: ProcessOutputCapture | None = None
@@ -164,6 +292,10 @@ class ProcessContainer:
   def has_empty_queue(self) -> bool:
     return len(self.msg_queue) == 0
 
+  @property
+  def is_alive(self) -> bool:
+    return self.process.proc is not None and self.process.proc.is_alive()
+
   @property
   def pubs(self) -> list[str]:
     return self.cfg.pubs
@@ -217,12 +349,19 @@ class ProcessContainer:
     self.vipc_server = vipc_server
     self.cfg.vision_pubs = [meta.camera_state for meta in streams_metas if meta.camera_state in self.cfg.vision_pubs]
 
+  def _new_replay_context(self) -> ReplayContext | LockstepReplayContext:
+    return ReplayContext(self.cfg)
+
   def _start_process(self):
     if self.capture is not None:
       self.process.launcher = LauncherWithCapture(self.capture, self.process.launcher)
     self.process.prepare()
     self.process.start()
 
+  def _stop_process(self):
+    self.process.signal(signal.SIGKILL)
+    self.process.stop()
+
   def start(
     self, params_config: dict[str, Any], environ_config: dict[str, Any],
     all_msgs: LogIterable, frs: dict[str, BaseFrameReader] | None,
@@ -235,7 +374,7 @@ class ProcessContainer:
         params = Params()
         self.cfg.config_callback(params, self.cfg, all_msgs)
 
-      self.rc = ReplayContext(self.cfg)
+      self.rc = self._new_replay_context()
       self.rc.open_context()
 
       self.pm = messaging.PubMaster(self.cfg.pubs)
@@ -261,14 +400,13 @@ class ProcessContainer:
 
   def stop(self):
     with self.prefix:
-      self.process.signal(signal.SIGKILL)
-      self.process.stop()
+      self._stop_process()
       self.rc.close_context()
       self.prefix.clean_dirs()
       self._clean_env()
 
   def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, BaseFrameReader] | None) -> list[capnp._DynamicStructReader]:
-    assert self.rc and self.pm and self.sockets and self.process.proc
+    assert self.rc and self.pm and self.sockets and self.is_alive
 
     output_msgs = []
     with self.prefix, Timeout(self.cfg.timeout, error_msg=f"timed out testing process {repr(self.cfg.proc_name)}"):
@@ -291,32 +429,83 @@ class ProcessContainer:
           trigger_empty_recv = next((True for m in self.msg_queue if m.which() == self.cfg.main_pub), False)
 
         for m in self.msg_queue:
-          self.pm.send(m.which(), m.as_builder())
+          self.pm.send(m.which(), self.msg_bytes.get(m))
           # send frames if needed
           if self.vipc_server is not None and m.which() in self.cfg.vision_pubs:
             camera_state = getattr(m, m.which())
             camera_meta = meta_from_camera_state(m.which())
             assert frs is not None
             img = frs[m.which()].get(camera_state.frameId, pix_fmt="nv12")[0]
-            self.vipc_server.send(camera_meta.stream, img.flatten().tobytes(),
+            self.vipc_server.send(camera_meta.stream, img.reshape(-1).data,
                                   camera_state.frameId, camera_state.timestampSof, camera_state.timestampEof)
         self.msg_queue = []
 
         self.rc.unlock_sockets()
         self.rc.wait_for_next_recv(trigger_empty_recv)
 
+        log_mono_time = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
         for socket in self.sockets:
-          ms = messaging.drain_sock(socket)
-          for m in ms:
-            m = m.as_builder()
-            m.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
-            output_msgs.append(m.as_reader())
+          for dat in messaging.drain_sock_raw(socket):
+            raw = bytearray(dat)
+            if set_log_mono_time(raw, log_mono_time):
+              dat = bytes(raw)
+              m = messaging.log_from_bytes(dat)
+              self.msg_bytes.add(m, dat)
+            else:
+              m = messaging.log_from_bytes(dat).as_builder()
+              m.logMonoTime = log_mono_time
+              m = m.as_reader()
+            output_msgs.append(m)
         self.cnt += 1
-    assert self.process.proc.is_alive()
+    assert self.is_alive
 
     return output_msgs
 
 
+class InProcessContainer(ProcessContainer):
+  """
+  Runs the process main in a thread of the replay, with its SubMaster and PubMaster on in-memory sockets instead of msgq.
+  It's stepped in lockstep the same way as a subprocess, without the IPC and context switches for every message.
+  The process shares the replay's environment, Params, gc and module state and its output isn't captured, so it's
+  opt-in per run and only meant for the processes in IN_PROCESS_PROCS. cereal.messaging's sockets are only swapped
+  while the process starts up, so nothing else may create sockets concurrently.
+  """
+  def __init__(self, cfg: ProcessConfig, msg_bytes: MessageBytes | None = None):
+    super().__init__(cfg, msg_bytes)
+    assert len(self.cfg.vision_pubs) == 0, "vision streams are only replayed to subprocesses"
+    self.gc_enabled = gc.isenabled()
+
+  @property
+  def is_alive(self) -> bool:
+    return isinstance(self.rc, LockstepReplayContext) and self.rc.sockets.alive
+
+  def _new_replay_context(self) -> LockstepReplayContext:
+    return LockstepReplayContext(self.cfg)
+
+  def _start_process(self):
+    assert isinstance(self.rc, LockstepReplayContext)
+    self.rc.sockets.run(importlib.import_module(self.process.module).main)
+
+  def _stop_process(self):
+    pass
+
+  def start(self, *args, **kwargs):
+    try:
+      super().start(*args, **kwargs)
+      # the process created all of its sockets once it waits to receive
+      assert self.rc is not None
+      self.rc.wait_for_recv_called()
+    finally:
+      if isinstance(self.rc, LockstepReplayContext):
+        self.rc.sockets.uninstall()
+
+  def stop(self):
+    super().stop()
+    # processes disable gc for themselves
+    if self.gc_enabled:
+      gc.enable()
+
+
 def card_fingerprint_callback(rc, pm, msgs, fingerprint):
   print("start fingerprinting")
   params = Params()
@@ -591,6 +780,9 @@ CONFIGS = [
   ),
 ]
 
+# python processes whose in-process replay is checked against the subprocess replay in test_in_process.py
+IN_PROCESS_PROCS = ["radard", "plannerd", "calibrationd", "dmonitoringd", "paramsd", "torqued"]
+
 
 def get_process_config(name: str) -> ProcessConfig:
   try:
@@ -654,11 +846,13 @@ def replay_process(
   else:
     cfgs = [cfg]
 
+  # publish log messages with their bytes as read from the log, when these are kept
+  msg_bytes = MessageBytes(lr.raw_events() if hasattr(lr, "raw_events") else ())
   all_msgs = migrate_all(lr, old_logtime=True,
                          manager_states=True,
                          panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
                          camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress, msg_bytes)
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -674,7 +868,8 @@ def replay_process(
 
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  msg_bytes: MessageBytes | None = None
 ) -> list[capnp._DynamicStructReader]:
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
@@ -694,43 +889,17 @@ def _replay_multi_process(
     assert all(st in frs for st in required_vision_pubs), f"frs for this process must contain following vision streams: {required_vision_pubs}"
 
   all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
+  if msg_bytes is None:
+    msg_bytes = MessageBytes()
   log_msgs = []
   try:
     containers = []
     for cfg in cfgs:
-      container = ProcessContainer(cfg)
+      container = (InProcessContainer if cfg.in_process else ProcessContainer)(cfg, msg_bytes)
       containers.append(container)
       container.start(params_config, env_config, all_msgs, frs, fingerprint, captured_output_store is not None)
 
-    all_pubs = {pub for container in containers for pub in container.pubs}
-    all_subs = {sub for container in containers for sub in container.subs}
-    lr_pubs = all_pubs - all_subs
-    pubs_to_containers = {pub: [container for container in containers if pub in container.pubs] for pub in all_pubs}
-
-    pub_msgs = [msg for msg in all_msgs if msg.which() in lr_pubs]
-    # external queue for messages taken from logs; internal queue for messages generated by processes, which will be republished
-    external_pub_queue: list[capnp._DynamicStructReader] = pub_msgs.copy()
-    internal_pub_queue: list[capnp._DynamicStructReader] = []
-    # heap for maintaining the order of messages generated by processes, where each element: (logMonoTime, index in internal_pub_queue)
-    internal_pub_index_heap: list[tuple[int, int]] = []
-
-    pbar = tqdm(total=len(external_pub_queue), disable=disable_progress)
-    while len(external_pub_queue) != 0 or (len(internal_pub_index_heap) != 0 and not all(c.has_empty_queue for c in containers)):
-      if len(internal_pub_index_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_index_heap[0][0]):
-        msg = external_pub_queue.pop(0)
-        pbar.update(1)
-      else:
-        _, index = heapq.heappop(internal_pub_index_heap)
-        msg = internal_pub_queue[index]
-
-      target_containers = pubs_to_containers[msg.which()]
-      for container in target_containers:
-        output_msgs = container.run_step(msg, frs)
-        for m in output_msgs:
-          if m.which() in all_pubs:
-            internal_pub_queue.append(m)
-            heapq.heappush(internal_pub_index_heap, (m.logMonoTime, len(internal_pub_queue) - 1))
-        log_msgs.extend(output_msgs)
+    log_msgs = _replay_loop(containers, all_msgs, frs, disable_progress)
   finally:
     for container in containers:
       container.stop()
@@ -742,6 +911,33 @@ def _replay_multi_process(
   return log_msgs
 
 
+def _replay_loop(
+  containers: list[ProcessContainer], all_msgs: list[capnp._DynamicStructReader], frs: dict[str, BaseFrameReader] | None, disable_progress: bool
+) -> list[capnp._DynamicStructReader]:
+  all_pubs = {pub for container in containers for pub in container.pubs}
+  all_subs = {sub for container in containers for sub in container.subs}
+  lr_pubs = all_pubs - all_subs
+  pubs_to_containers = {pub: [container for container in containers if pub in container.pubs] for pub in all_pubs}
+
+  log_msgs = []
+  scheduler = ReplayScheduler(msg for msg in all_msgs if msg.which() in lr_pubs)
+  pbar = tqdm(total=len(scheduler.log_queue), disable=disable_progress)
+  while not scheduler.done:
+    msg, from_log = scheduler.pop()
+    if from_log:
+      pbar.update(1)
+
+    for container in pubs_to_containers[msg.which()]:
+      output_msgs = container.run_step(msg, frs)
+      scheduler.update(container)
+      for m in output_msgs:
+        if m.which() in all_pubs:
+          scheduler.push(m)
+      log_msgs.extend(output_msgs)
+
+  return log_msgs
+
+
 def generate_params_config(lr=None, CP=None, fingerprint=None, custom_params=None) -> dict[str, Any]:
   params_dict = {
     "OpenpilotEnabledToggle": True,
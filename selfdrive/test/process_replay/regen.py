@@ -115,7 +115,11 @@ def regen_and_save(
                                needs_driver_cam="driverCameraState" in all_vision_pubs,
                                needs_road_cam="roadCameraState" in all_vision_pubs or "wideRoadCameraState" in all_vision_pubs,
                                dummy_driver_cam=dummy_driver_cam)
-  output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm)
+  try:
+    output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm)
+  finally:
+    for fr in frs.values():
+      fr.close()
 
   log_dir = os.path.join(outdir, time.strftime("%Y-%m-%d--%H-%M-%S--0", time.gmtime()))
   rel_log_dir = os.path.relpath(log_dir)
@@ -0,0 +1,156 @@
+import ast
+import dataclasses
+import functools
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+from openpilot.common.basedir import BASEDIR
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.system.manager.process import NativeProcess, PythonProcess
+from openpilot.system.manager.process_config import managed_processes
+from openpilot.selfdrive.test.process_replay.process_replay import FAKEDATA, ProcessConfig
+
+CACHE_DIR = os.path.join(FAKEDATA, "cache")
+# the replay harness itself, its callbacks run inside every replayed process
+REPLAY_MODULE = "selfdrive.test.process_replay.process_replay"
+# inputs of every replay not found by following imports: (directory, file suffix)
+# the car ports are imported by name when fingerprinting
+SHARED_SOURCES = [("cereal", ".capnp"), ("opendbc", ".dbc"), ("selfdrive/car", ".py")]
+
+
+@functools.cache
+def _file_hash(fn: str) -> bytes:
+  with open(fn, "rb") as f:
+    return hashlib.sha256(f.read()).digest()
+
+
+def _module_file(name: str) -> str | None:
+  path = os.path.join(BASEDIR, *name.removeprefix("openpilot.").split("."))
+  for fn in (path + ".py", os.path.join(path, "__init__.py")):
+    if os.path.isfile(fn):
+      return fn
+  return None
+
+
+def _imported_modules(fn: str) -> set[str]:
+  with open(fn) as f:
+    tree = ast.parse(f.read(), fn)
+
+  package = os.path.relpath(os.path.dirname(fn), BASEDIR).split(os.sep)
+  names: set[str] = set()
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Import):
+      names.update(alias.name for alias in node.names)
+    elif isinstance(node, ast.ImportFrom):
+      parts = package[:len(package) - node.level + 1] if node.level else []
+      module = ".".join(parts + ([node.module] if node.module else []))
+      names.add(module)
+      # imported names may be submodules
+      names.update(f"{module}.{alias.name}" for alias in node.names)
+  return names
+
+
+@functools.cache
+def _files_in(directory: str, suffix: str = "") -> list[str]:
+  files: list[str] = []
+  for root, dirs, fns in os.walk(directory):
+    dirs[:] = [d for d in dirs if d != "__pycache__"]
+    files.extend(os.path.join(root, fn) for fn in fns if fn.endswith(suffix))
+  return files
+
+
+@functools.cache
+def python_sources(module: str) -> frozenset[str]:
+  """Files of the modules within the repo imported by a module, directly or not, including itself"""
+  seen: set[str] = set()
+  stack = [module]
+  while len(stack):
+    fn = _module_file(stack.pop())
+    if fn is None or fn in seen:
+      continue
+    seen.add(fn)
+    stack.extend(_imported_modules(fn))
+
+  # compiled libraries (e.g. MPC solvers) are loaded from next to the modules using them
+  libs = {lib for fn in seen if not fn.endswith("__init__.py") for lib in _files_in(os.path.dirname(fn), ".so")}
+  return frozenset(seen | libs)
+
+
+def source_files(proc_name: str) -> list[str]:
+  """Files that determine the output of a process replay"""
+  files = set(python_sources(REPLAY_MODULE))
+  for directory, suffix in SHARED_SOURCES:
+    files.update(_files_in(os.path.join(BASEDIR, directory), suffix))
+
+  process = managed_processes[proc_name]
+  if isinstance(process, PythonProcess):
+    files.update(python_sources(process.module))
+  elif isinstance(process, NativeProcess):
+    files.update(_files_in(os.path.join(BASEDIR, process.cwd)))
+  return sorted(files)
+
+
+def config_key(cfg: ProcessConfig) -> str:
+  fields = []
+  for f in dataclasses.fields(cfg):
+    value = getattr(cfg, f.name)
+    if callable(value):
+      # callbacks are identified by name and state, their code is among the source files
+      value = getattr(value, "__qualname__", None) or f"{type(value).__qualname__}{sorted(vars(value).items())}"
+    fields.append((f.name, value))
+  return repr(fields)
+
+
+def inputs_hash(segment: str, cfg: ProcessConfig) -> str:
+  # segments are immutable once uploaded, so their name stands in for their content
+  h = hashlib.sha256()
+  h.update(segment.encode())
+  h.update(config_key(cfg).encode())
+  for fn in source_files(cfg.proc_name):
+    h.update(os.path.relpath(fn, BASEDIR).encode())
+    h.update(_file_hash(fn))
+  return h.hexdigest()[:16]
+
+
+class ReplayCache:
+  """Replayed logs keyed by a hash of their inputs, along with how long each replay took"""
+  def __init__(self, cache_dir: str = CACHE_DIR):
+    self.cache_dir = cache_dir
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+    self.durations: dict[str, float] = {}
+    if os.path.exists(self._durations_fn):
+      with open(self._durations_fn) as f:
+        self.durations = json.load(f)
+
+  @property
+  def _durations_fn(self) -> str:
+    return os.path.join(self.cache_dir, "durations.json")
+
+  def log_path(self, segment: str, proc_name: str, inputs: str) -> str:
+    return os.path.join(self.cache_dir, f"{segment}_{proc_name}_{inputs}.bz2")
+
+  def get(self, segment: str, proc_name: str, inputs: str) -> str | None:
+    path = self.log_path(segment, proc_name, inputs)
+    return path if os.path.exists(path) else None
+
+  def put(self, log_fn: str, segment: str, proc_name: str, inputs: str):
+    # outputs of older inputs won't be used again
+    for fn in glob.glob(glob.escape(os.path.join(self.cache_dir, f"{segment}_{proc_name}_")) + "*.bz2"):
+      os.remove(fn)
+
+    with open(log_fn, "rb") as src, atomic_write_in_dir(self.log_path(segment, proc_name, inputs), mode="wb", overwrite=True) as dst:
+      shutil.copyfileobj(src, dst)
+
+  def duration(self, segment: str, proc_name: str) -> float | None:
+    return self.durations.get(f"{segment}/{proc_name}")
+
+  def set_duration(self, segment: str, proc_name: str, duration: float):
+    self.durations[f"{segment}/{proc_name}"] = duration
+
+  def save_durations(self):
+    with atomic_write_in_dir(self._durations_fn, mode="w", overwrite=True) as f:
+      json.dump(self.durations, f, indent=2)
@@ -0,0 +1,27 @@
+import dataclasses
+from parameterized import parameterized
+
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs
+from openpilot.selfdrive.test.process_replay.process_replay import IN_PROCESS_PROCS, get_process_config, replay_process
+from openpilot.selfdrive.test.process_replay.test_processes import get_log_data, segments
+from openpilot.tools.lib.logreader import LogReader
+
+SEGMENT = next(seg for car, seg in segments if car == "TOYOTA")
+
+
+class TestInProcessReplay:
+  @classmethod
+  def setup_class(cls):
+    _, cls.lr_dat = get_log_data(SEGMENT)
+
+  @parameterized.expand([(name,) for name in IN_PROCESS_PROCS])
+  def test_in_process_matches_subprocess(self, proc_name):
+    cfg = get_process_config(proc_name)
+    log_msgs = {}
+    for in_process in (False, True):
+      lr = LogReader.from_bytes(self.lr_dat)
+      log_msgs[in_process] = replay_process(dataclasses.replace(cfg, in_process=in_process), lr, disable_progress=True)
+
+    assert len(log_msgs[True]) > 0
+    diff = compare_logs(log_msgs[False], log_msgs[True], cfg.ignore, tolerance=0)
+    assert diff == [], f"{proc_name} replayed in-process differs from its subprocess replay: {diff[:10]}"
@@ -2,7 +2,9 @@
 import argparse
 import concurrent.futures
 import os
+import shutil
 import sys
+import time
 from collections import defaultdict
 from tqdm import tqdm
 from typing import Any
@@ -13,6 +15,7 @@ from openpilot.tools.lib.openpilotci import get_url, upload_file
 from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_diff
 from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, replay_process, \
                                                                    check_openpilot_enabled, check_most_messages_valid
+from openpilot.selfdrive.test.process_replay.replay_cache import ReplayCache, inputs_hash
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.logreader import LogReader
 from openpilot.tools.lib.helpers import save_log
@@ -70,20 +73,37 @@ EXCLUDED_PROCS = {"modeld", "dmonitoringmodeld"}
 
 
 def run_test_process(data):
-  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat = data
-  res = None
+  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat, inputs, cached_log_fn = data
+  res, duration = None, None
   if not args.upload_only:
-    lr = LogReader.from_bytes(lr_dat)
-    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
-    # save logs so we can upload when updating refs
-    save_log(cur_log_fn, log_msgs)
+    cache = ReplayCache()
+    if cached_log_fn is not None:
+      # another run may have replaced the cached output since it was scheduled, it's replayed then
+      try:
+        shutil.copyfile(cached_log_fn, cur_log_fn)
+      except FileNotFoundError:
+        cached_log_fn = None
+
+    if cached_log_fn is not None:
+      res = check_process(cfg, list(LogReader(cur_log_fn)), segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
+    else:
+      if lr_dat is None:
+        _, lr_dat = get_log_data(segment)
+      t = time.monotonic()
+      lr = LogReader.from_bytes(lr_dat)
+      res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
+      duration = time.monotonic() - t
+      # save logs so we can upload when updating refs
+      save_log(cur_log_fn, log_msgs)
+      if inputs is not None:
+        cache.put(cur_log_fn, segment, cfg.proc_name, inputs)
 
   if args.update_refs or args.upload_only:
     print(f'Uploading: {os.path.basename(cur_log_fn)}')
     assert os.path.exists(cur_log_fn), f"Cannot find log to upload: {cur_log_fn}"
     upload_file(cur_log_fn, os.path.basename(cur_log_fn))
     os.remove(cur_log_fn)
-  return (segment, cfg.proc_name, res)
+  return (segment, cfg.proc_name, res, duration)
 
 
 def get_log_data(segment):
@@ -93,6 +113,15 @@ def get_log_data(segment):
 
 
 def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
+  try:
+    log_msgs = replay_process(cfg, lr, disable_progress=True)
+  except Exception as e:
+    raise Exception("failed on segment: " + segment) from e
+
+  return check_process(cfg, log_msgs, segment, ref_log_path, new_log_path, ignore_fields, ignore_msgs), log_msgs
+
+
+def check_process(cfg, log_msgs, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -100,28 +129,23 @@ def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=Non
 
   ref_log_msgs = list(LogReader(ref_log_path))
 
-  try:
-    log_msgs = replay_process(cfg, lr, disable_progress=True)
-  except Exception as e:
-    raise Exception("failed on segment: " + segment) from e
-
   # check to make sure openpilot is engaged in the route
   if cfg.proc_name == "controlsd":
     if not check_openpilot_enabled(log_msgs):
-      return f"Route did not enable at all or for long enough: {new_log_path}", log_msgs
+      return f"Route did not enable at all or for long enough: {new_log_path}"
   if not check_most_messages_valid(log_msgs):
-    return f"Route did not have enough valid messages: {new_log_path}", log_msgs
+    return f"Route did not have enough valid messages: {new_log_path}"
 
   if cfg.proc_name != 'ubloxd' or segment != 'regen3BB55FA5E20|2024-05-21--06-59-03--0':
     seen_msgs = {m.which() for m in log_msgs}
     expected_msgs = set(cfg.subs)
     if seen_msgs != expected_msgs:
-      return f"Expected messages: {expected_msgs}, but got: {seen_msgs}", log_msgs
+      return f"Expected messages: {expected_msgs}, but got: {seen_msgs}"
 
   try:
-    return compare_logs(ref_log_msgs, log_msgs, ignore_fields + cfg.ignore, ignore_msgs, cfg.tolerance), log_msgs
+    return compare_logs(ref_log_msgs, log_msgs, ignore_fields + cfg.ignore, ignore_msgs, cfg.tolerance)
   except Exception as e:
-    return str(e), log_msgs
+    return str(e)
 
 
 if __name__ == "__main__":
@@ -147,6 +171,8 @@ if __name__ == "__main__":
                       help="Updates reference logs using current commit")
   parser.add_argument("--upload-only", action="store_true",
                       help="Skips testing processes and uploads logs from previous test run")
+  parser.add_argument("--no-cache", action="store_true",
+                      help="Replays all processes, even those with cached outputs for unchanged inputs")
   parser.add_argument("-j", "--jobs", type=int, default=max(cpu_count - 2, 1),
                       help="Max amount of parallel jobs")
   args = parser.parse_args()
@@ -180,16 +206,10 @@ if __name__ == "__main__":
     untested = (set(interface_names) - set(excluded_interfaces)) - {c.lower() for c in tested_cars}
     assert len(untested) == 0, f"Cars missing routes: {str(untested)}"
 
+  replay_cache = ReplayCache()
   log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
   with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
-    if not args.upload_only:
-      download_segments = [seg for car, seg in segments if car in tested_cars]
-      log_data: dict[str, LogReader] = {}
-      p1 = pool.map(get_log_data, download_segments)
-      for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
-        log_data[segment] = lr
-
-    pool_args: Any = []
+    jobs: Any = []
     for car_brand, segment in segments:
       if car_brand not in tested_cars:
         continue
@@ -205,17 +225,35 @@ if __name__ == "__main__":
           ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.bz2")
           ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
 
-        dat = None if args.upload_only else log_data[segment]
-        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat))
+        inputs = None if args.no_cache else inputs_hash(segment, cfg)
+        cached_log_fn = None if inputs is None else replay_cache.get(segment, cfg.proc_name, inputs)
+        jobs.append((segment, cfg, cur_log_fn, ref_log_path, inputs, cached_log_fn))
 
         log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
         log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
 
+    # only segments with a process left to replay are needed
+    log_data: dict[str, bytes] = {}
+    if not args.upload_only:
+      download_segments = list(dict.fromkeys(segment for segment, *_, cached_log_fn in jobs if cached_log_fn is None))
+      p1 = pool.map(get_log_data, download_segments)
+      for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
+        log_data[segment] = lr
+      print(f"Replaying {sum(job[-1] is None for job in jobs)} of {len(jobs)} processes, others have cached outputs")
+
+    # longest first, so no long replay is left running alone at the end. unknown durations go first
+    jobs.sort(key=lambda job: -(replay_cache.duration(job[0], job[1].proc_name) or float('inf')))
+    futures = [pool.submit(run_test_process, (segment, cfg, args, cur_log_fn, ref_log_path, log_data.get(segment), inputs, cached_log_fn))
+               for segment, cfg, cur_log_fn, ref_log_path, inputs, cached_log_fn in jobs]
+
     results: Any = defaultdict(dict)
-    p2 = pool.map(run_test_process, pool_args)
-    for (segment, proc, result) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
+    for future in tqdm(concurrent.futures.as_completed(futures), desc="Running Tests", total=len(futures)):
+      segment, proc, result, duration = future.result()
       if not args.upload_only:
         results[segment][proc] = result
+      if duration is not None:
+        replay_cache.set_duration(segment, proc, duration)
+    replay_cache.save_durations()
 
   diff_short, diff_long, failed = format_diff(results, log_paths, ref_commit)
   if not upload:
@@ -1,3 +1,4 @@
+import threading
 from collections import defaultdict, deque
 from cereal.services import SERVICE_LIST
 import cereal.messaging as messaging
@@ -89,3 +90,141 @@ class SubMaster(messaging.SubMaster):
 class PubMaster(messaging.PubMaster):
   def __init__(self):
     self.sock = defaultdict(PubSocket)
+
+
+class LockstepSubSocket:
+  def __init__(self, sockets: 'LockstepSockets', endpoint: str, conflate: bool):
+    self.sockets = sockets
+    self.endpoint = endpoint
+    self.msgs: deque[bytes] = deque(maxlen=1 if conflate else None)
+
+  def setTimeout(self, timeout):
+    pass
+
+  def receive(self, non_blocking=False):
+    return self.sockets.receive(self, non_blocking)
+
+
+class LockstepPubSocket:
+  def __init__(self, sockets: 'LockstepSockets', endpoint: str):
+    self.sockets = sockets
+    self.endpoint = endpoint
+
+  def send(self, data):
+    self.sockets.send(self.endpoint, data)
+
+  def all_readers_updated(self):
+    return True
+
+
+class LockstepPoller:
+  # like msgq's poller with fake events, all sockets are returned and receiving from them is what blocks
+  def __init__(self):
+    self.socks = []
+
+  def registerSocket(self, sock):
+    self.socks.append(sock)
+
+  def poll(self, timeout):
+    return list(self.socks)
+
+
+class LockstepSockets:
+  """
+  In-memory sockets of a process running in a thread, stepped in lockstep with its replay as with msgq's fake events:
+  receiving from a locked endpoint blocks the process until the replay unlocks it, and the replay takes over
+  whenever the process blocks. Sockets created through cereal.messaging while installed are these ones.
+  """
+  def __init__(self, locked_endpoints: list[str]):
+    self.locked = set(locked_endpoints)
+    self.unlocked: set[str] = set()
+    self.subs: dict[str, list[LockstepSubSocket]] = defaultdict(list)
+    self.cv = threading.Condition()
+    self.waiting = False
+    self.done = False
+    self.exited = False
+    self.exception: Exception | None = None
+    self.thread: threading.Thread | None = None
+    self.replaced: dict[str, object] = {}
+
+  def install(self):
+    for name, replacement in [("sub_sock", self.sub_sock), ("pub_sock", self.pub_sock), ("Poller", LockstepPoller)]:
+      self.replaced[name] = getattr(messaging, name)
+      setattr(messaging, name, replacement)
+
+  def uninstall(self):
+    for name, original in self.replaced.items():
+      setattr(messaging, name, original)
+    self.replaced = {}
+
+  def sub_sock(self, endpoint, poller=None, addr="127.0.0.1", conflate=False, timeout=None):
+    sock = LockstepSubSocket(self, endpoint, conflate)
+    self.subs[endpoint].append(sock)
+    if poller is not None:
+      poller.registerSocket(sock)
+    return sock
+
+  def pub_sock(self, endpoint):
+    return LockstepPubSocket(self, endpoint)
+
+  def send(self, endpoint, data):
+    for sock in self.subs.get(endpoint, []):
+      sock.msgs.append(data)
+
+  def receive(self, sock, non_blocking):
+    with self.cv:
+      if sock.endpoint in self.locked:
+        self._wait_until(lambda: sock.endpoint in self.unlocked)
+        self.unlocked.discard(sock.endpoint)
+      if not non_blocking:
+        self._wait_until(lambda: len(sock.msgs) != 0)
+      return sock.msgs.popleft() if len(sock.msgs) else None
+
+  def _wait_until(self, predicate):
+    # in the process thread, hands over to the replay until it's done
+    while not predicate():
+      if self.done:
+        raise ReplayDone
+      self.waiting = True
+      self.cv.notify_all()
+      self.cv.wait()
+
+  def run(self, target):
+    def run_target():
+      try:
+        target()
+      except ReplayDone:
+        pass
+      except Exception as e:
+        self.exception = e
+      finally:
+        with self.cv:
+          self.exited = True
+          self.cv.notify_all()
+
+    self.thread = threading.Thread(target=run_target, daemon=True)
+    self.thread.start()
+
+  def wait_for_recv(self):
+    """Waits until the process blocks on receiving"""
+    with self.cv:
+      self.cv.wait_for(lambda: self.waiting or self.exited)
+    if self.exception is not None:
+      raise self.exception
+
+  def unlock(self, endpoints):
+    with self.cv:
+      self.unlocked.update(endpoints)
+      self.waiting = False
+      self.cv.notify_all()
+
+  def stop(self, timeout=None):
+    with self.cv:
+      self.done = True
+      self.cv.notify_all()
+    if self.thread is not None:
+      self.thread.join(timeout)
+
+  @property
+  def alive(self) -> bool:
+    return self.thread is not None and not self.exited
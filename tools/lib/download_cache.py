@@ -0,0 +1,140 @@
+import os
+import sqlite3
+import threading
+import time
+
+from openpilot.system.hardware.hw import Paths
+
+#  Byte budget of the download cache, least recently used files are evicted past it
+CACHE_SIZE = int(os.environ.get("FILEREADER_CACHE_SIZE_MB", "20000")) * 1000 * 1000
+#  Files used this recently are never evicted, other processes may still be filling them
+EVICTION_GRACE = 60.
+
+
+class DownloadCache:
+  """Chunks of remote files, stored in one sparse file per URL. A single sqlite index
+  tracks the length, present chunks and last access of each file for LRU eviction,
+  and the total size of the cache so eviction only runs once it is over budget."""
+  def __init__(self, root: str|None = None, max_size: int = CACHE_SIZE):
+    self.root = root if root is not None else Paths.download_cache_root()
+    self.max_size = max_size
+    #  last_access written to the index per file, reads only refresh it once it goes stale
+    self._last_access: dict[str, float] = {}
+    self._lock = threading.Lock()
+    self._pid = -1
+    self._connect()
+
+  def _connect(self) -> None:
+    # each transaction is atomic, so the index is safe to share between processes
+    self._db = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=30, check_same_thread=False)
+    self._pid = os.getpid()
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    with self._db:
+      self._db.execute("CREATE TABLE IF NOT EXISTS files (url_hash TEXT PRIMARY KEY, length INTEGER, size INTEGER, last_access REAL)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS chunks (url_hash TEXT, chunk INTEGER, PRIMARY KEY (url_hash, chunk))")
+      self._db.execute("CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)")
+      self._db.execute("INSERT OR IGNORE INTO total SELECT 0, COALESCE(SUM(size), 0) FROM files")
+
+  @property
+  def _conn(self) -> sqlite3.Connection:
+    # sqlite connections can't be used across a fork
+    if os.getpid() != self._pid:
+      self._connect()
+    return self._db
+
+  def _data_path(self, url_hash: str) -> str:
+    return os.path.join(self.root, url_hash + ".bin")
+
+  def _drop(self, conn: sqlite3.Connection, url_hash: str) -> None:
+    row = conn.execute("DELETE FROM files WHERE url_hash = ? RETURNING size", (url_hash,)).fetchone()
+    conn.execute("DELETE FROM chunks WHERE url_hash = ?", (url_hash,))
+    if row is not None:
+      conn.execute("UPDATE total SET size = size - ?", (row[0],))
+    self._last_access.pop(url_hash, None)
+
+  def get_length(self, url_hash: str) -> int|None:
+    with self._lock:
+      row = self._conn.execute("SELECT length FROM files WHERE url_hash = ?", (url_hash,)).fetchone()
+    return None if row is None else int(row[0])
+
+  def set_length(self, url_hash: str, length: int) -> None:
+    with self._lock, self._conn as conn:
+      conn.execute("INSERT OR IGNORE INTO files VALUES (?, ?, 0, ?)", (url_hash, length, time.time()))
+
+  def present_chunks(self, url_hash: str, first: int, last: int) -> set[int]:
+    with self._lock:
+      rows = self._conn.execute("SELECT chunk FROM chunks WHERE url_hash = ? AND chunk BETWEEN ? AND ?", (url_hash, first, last)).fetchall()
+    return {r[0] for r in rows}
+
+  def write_chunks(self, url_hash: str, length: int, chunk_size: int, chunks: dict[int, bytes]) -> None:
+    fd = os.open(self._data_path(url_hash), os.O_RDWR | os.O_CREAT)
+    try:
+      created = os.fstat(fd).st_size == 0
+      if created:
+        os.ftruncate(fd, length)
+      for chunk, data in chunks.items():
+        os.pwrite(fd, data, chunk * chunk_size)
+    finally:
+      os.close(fd)
+
+    with self._lock:
+      with self._conn as conn:
+        if created:
+          # chunks indexed for a data file that was removed are gone with it
+          self._drop(conn, url_hash)
+        now = time.time()
+        conn.execute("INSERT OR IGNORE INTO files VALUES (?, ?, 0, ?)", (url_hash, length, now))
+        new = [c for c in chunks if conn.execute("INSERT OR IGNORE INTO chunks VALUES (?, ?)", (url_hash, c)).rowcount]
+        added = sum(len(chunks[c]) for c in new)
+        conn.execute("UPDATE files SET size = size + ?, last_access = ? WHERE url_hash = ?", (added, now, url_hash))
+        total = conn.execute("UPDATE total SET size = size + ? RETURNING size", (added,)).fetchone()[0]
+      self._last_access[url_hash] = now
+    if total > self.max_size:
+      self.evict()
+
+  def read(self, url_hash: str, begin: int, end: int) -> bytes|None:
+    """Reads [begin, end) of a cached file, all chunks in the range must be present.
+    Returns None if the data file is gone, its index entry is dropped so it is fetched again."""
+    try:
+      fd = os.open(self._data_path(url_hash), os.O_RDONLY)
+    except FileNotFoundError:
+      with self._lock, self._conn as conn:
+        self._drop(conn, url_hash)
+      return None
+    try:
+      data = os.pread(fd, end - begin, begin)
+    finally:
+      os.close(fd)
+
+    # refreshed at most every half grace period, so files read since stay out of eviction
+    now = time.time()
+    if now - self._last_access.get(url_hash, -EVICTION_GRACE) > EVICTION_GRACE / 2:
+      with self._lock, self._conn as conn:
+        conn.execute("UPDATE files SET last_access = ? WHERE url_hash = ?", (now, url_hash))
+      self._last_access[url_hash] = now
+    return data
+
+  def size(self) -> int:
+    with self._lock:
+      return int(self._conn.execute("SELECT size FROM total").fetchone()[0])
+
+  def evict(self) -> None:
+    evicted = []
+    with self._lock, self._conn as conn:
+      total = conn.execute("SELECT size FROM total").fetchone()[0]
+      if total <= self.max_size:
+        return
+
+      rows = conn.execute("SELECT url_hash, size FROM files WHERE last_access < ? ORDER BY last_access",
+                          (time.time() - EVICTION_GRACE,)).fetchall()
+      for url_hash, size in rows:
+        if total <= self.max_size:
+          break
+        self._drop(conn, url_hash)
+        evicted.append(url_hash)
+        total -= size
+
+    for url_hash in evicted:
+      if os.path.exists(self._data_path(url_hash)):
+        os.remove(self._data_path(url_hash))
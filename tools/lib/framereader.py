@@ -1,9 +1,11 @@
+import contextlib
 import json
 import os
 import pickle
 import struct
 import subprocess
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
 from functools import wraps
 
@@ -22,12 +24,27 @@ HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+# decoder processes running at once in get_batch
+BATCH_WORKERS = int(os.getenv("FRAMEREADER_BATCH_WORKERS", "4"))
+# byte budget of all persistent decoded frame stores
+FRAME_STORE_SIZE = int(os.getenv("FRAMEREADER_CACHE_SIZE_MB", "20000")) * 1000 * 1000
+# GOPs past the requested one fed to a decoder session, unless access is sequential
+SESSION_LOOKAHEAD_GOPS = 2
+
 
 class GOPReader:
   def get_gop(self, num):
     # returns (start_frame_num, num_frames, frames_to_skip, gop_data)
     raise NotImplementedError
 
+  def get_gop_range(self, num):
+    # returns (start_frame_num, end_frame_num) of the GOP containing frame num
+    raise NotImplementedError
+
+  def get_gop_stream(self, num, end_num=None):
+    # returns (start_frame_num, iterator over the stream data from that GOP through the GOP of end_num, or the end)
+    raise NotImplementedError
+
 
 class DoNothingContextManager:
   def __enter__(self):
@@ -197,6 +214,138 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   return ret
 
 
+def frame_shape(w, h, pix_fmt):
+  # shape of a single decoded frame, as returned by the readers
+  if pix_fmt == "rgb24":
+    return (h, w, 3)
+  elif pix_fmt in ("nv12", "yuv420p"):
+    return (h*w*3//2,)
+  elif pix_fmt == "yuv444p":
+    return (3, h, w)
+  raise NotImplementedError
+
+
+class DecodedFrameStore:
+  """Decoded frames of a video in a memory-mapped file per (file, pix_fmt), shared across readers and runs.
+  Stores are removed least recently used first once they exceed FRAME_STORE_SIZE together."""
+
+  def __init__(self, fn, pix_fmt, frame_count, shape, cache_dir=DEFAULT_CACHE_DIR, max_size=None):
+    base = cache_path_for_file_path(resolve_name(fn), cache_dir) + f".{pix_fmt}"
+    self.frames_path, self.present_path = base + ".frames", base + ".present"
+    self.max_size = max_size if max_size is not None else FRAME_STORE_SIZE
+
+    self.frames = self._open(self.frames_path, (frame_count, *shape))
+    self.present = self._open(self.present_path, (frame_count,))
+    self.evict()
+
+  @staticmethod
+  def _open(path, shape):
+    # sparse until frames are written, and never truncated if another reader created it first
+    size = int(np.prod(shape))
+    with open(path, "ab") as f:
+      if f.tell() < size:
+        f.truncate(size)
+    os.utime(path)
+    return np.memmap(path, dtype=np.uint8, mode="r+", shape=shape)
+
+  def get(self, num):
+    if not self.present[num]:
+      return None
+    frame = np.asarray(self.frames[num])
+    frame.flags.writeable = False
+    return frame
+
+  def put(self, num, frame):
+    self.frames[num] = frame
+    self.present[num] = 1
+
+  def evict(self):
+    stores = []
+    for fn in os.listdir(os.path.dirname(self.frames_path)):
+      path = os.path.join(os.path.dirname(self.frames_path), fn)
+      if fn.endswith(".frames") and path != self.frames_path:
+        st = os.stat(path)
+        stores.append((st.st_mtime, st.st_blocks * 512, path))
+
+    total = os.stat(self.frames_path).st_blocks * 512 + sum(size for _, size, _ in stores)
+    for _, size, path in sorted(stores):
+      if total <= self.max_size:
+        break
+      for p in (path, path.removesuffix(".frames") + ".present"):
+        with contextlib.suppress(FileNotFoundError):
+          os.remove(p)
+      total -= size
+
+
+class GOPDecoderSession:
+  """Long-lived ffmpeg process decoding a stream from the start of a GOP up to frame_e,
+  so consecutive GOPs are decoded without spawning a process for each"""
+
+  def __init__(self, chunks, frame_b, frame_e, vid_fmt, w, h, pix_fmt):
+    self.next_frame = frame_b
+    self.end_frame = frame_e
+    self.shape = frame_shape(w, h, pix_fmt)
+    self.out_size = int(np.prod(self.shape))
+
+    threads = os.getenv("FFMPEG_THREADS", "0")
+    cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
+    args = ["ffmpeg", "-v", "quiet",
+            "-threads", threads,
+            "-hwaccel", "none" if not cuda else "cuda",
+            "-c:v", "hevc",
+            "-vsync", "0",
+            "-f", vid_fmt,
+            "-flags2", "showall",
+            "-i", "pipe:0",
+            "-threads", threads,
+            "-f", "rawvideo",
+            "-pix_fmt", pix_fmt,
+            "pipe:1"]
+    self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # the writer doesn't reference the session, so ffmpeg stops once an unclosed session is collected
+    self.t = threading.Thread(target=self.write_thread, args=(self.proc.stdin, chunks))
+    self.t.daemon = True
+    self.t.start()
+
+  @staticmethod
+  def write_thread(stdin, chunks):
+    try:
+      for chunk in chunks:
+        stdin.write(chunk)
+    except (BrokenPipeError, ValueError):
+      pass
+    finally:
+      with contextlib.suppress(BrokenPipeError):
+        stdin.close()
+
+  def readinto(self, buf):
+    # decodes the next frame straight into a contiguous buffer
+    view = memoryview(buf).cast("B")
+    assert len(view) == self.out_size
+    read = 0
+    while read < self.out_size:
+      n = self.proc.stdout.readinto(view[read:])
+      if not n:
+        raise DataUnreadableError(f"decoder stopped at frame {self.next_frame}")
+      read += n
+    self.next_frame += 1
+
+  def read(self):
+    # returns (frame number, frame) of the next decoded frame
+    dat = self.proc.stdout.read(self.out_size)
+    if len(dat) != self.out_size:
+      raise DataUnreadableError(f"decoder stopped at frame {self.next_frame}")
+    num = self.next_frame
+    self.next_frame += 1
+    return num, np.frombuffer(dat, dtype=np.uint8).reshape(self.shape)
+
+  def close(self):
+    self.proc.kill()
+    self.proc.wait()
+    self.proc.stdout.close()
+    self.t.join()
+
+
 class BaseFrameReader:
   # properties: frame_type, frame_count, w, h
 
@@ -212,15 +361,32 @@ class BaseFrameReader:
   def get(self, num, count=1, pix_fmt="yuv420p"):
     raise NotImplementedError
 
+  def _batch_out(self, count, pix_fmt, out):
+    shape = (count, *frame_shape(self.w, self.h, pix_fmt))
+    if out is None:
+      return np.empty(shape, dtype=np.uint8)
+    if out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+      raise ValueError(f"out must be a contiguous uint8 array of shape {shape}")
+    return out
 
-def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=False, index_data=None):
+  def get_batch(self, indices, pix_fmt="yuv420p", out=None):
+    """Frames at indices in a single (N, *frame shape) array, filling out if given:
+    (N, H, W, 3) for rgb24, (N, H*W*3/2) for yuv420p and nv12, and (N, 3, H, W) for yuv444p"""
+    out = self._batch_out(len(indices), pix_fmt, out)
+    for k, num in enumerate(indices):
+      out[k] = self.get(num, pix_fmt=pix_fmt)[0]
+    return out
+
+
+def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=False, index_data=None, persist_frames=False):
   frame_type = fingerprint_video(fn)
   if frame_type == FrameType.raw:
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_dir)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind,
+                             store_dir=cache_dir if persist_frames else None)
   else:
     raise NotImplementedError(frame_type)
 
@@ -294,7 +460,7 @@ class VideoStreamDecompressor:
 
   def write_thread(self):
     try:
-      with FileReader(self.fn) as f:
+      with FileReader(self.fn, readahead=8*1024*1024) as f:
         while True:
           r = f.read(1024*1024)
           if len(r) == 0:
@@ -422,16 +588,43 @@ class StreamGOPReader(GOPReader):
 
     return frame_b, num_frames, skip_frames, rawdat
 
+  def get_gop_range(self, num):
+    frame_b, frame_e, _, _ = self._lookup_gop(num)
+    return frame_b, frame_e
+
+  def get_gop_stream(self, num, end_num=None):
+    frame_b, _, offset_b, _ = self._lookup_gop(num)
+    offset_e = self._lookup_gop(end_num)[3] if end_num is not None else None
+
+    read_size = 1024*1024
+    # remote reads fetch ahead, but not past the end of the range
+    readahead = 8*1024*1024 if offset_e is None else min(8*1024*1024, max(0, offset_e - offset_b - read_size))
+
+    def chunks():
+      yield self.prefix
+      with FileReader(self.fn, readahead=readahead) as f:
+        f.seek(offset_b)
+        pos = offset_b
+        while len(r := f.read(read_size if offset_e is None else min(read_size, offset_e - pos))):
+          pos += len(r)
+          yield r
+
+    return frame_b, chunks()
+
 
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, store_dir=None):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
     self.frame_cache = LRU(64)
+    # per pix_fmt decoder sessions and persistent decoded frame stores
+    self.sessions = {}
+    self.store_dir = store_dir
+    self.stores = {}
 
     if self.readahead:
       self.cache_lock = threading.RLock()
@@ -455,6 +648,10 @@ class GOPFrameReader(BaseFrameReader):
       self.readahead_c.release()
       self.readahead_thread.join()
 
+    for session in self.sessions.values():
+      session.close()
+    self.sessions.clear()
+
   def _readahead_thread(self):
     while True:
       self.readahead_c.acquire()
@@ -486,16 +683,88 @@ class GOPFrameReader(BaseFrameReader):
       if (num, pix_fmt) in self.frame_cache:
         return self.frame_cache[(num, pix_fmt)]
 
-      frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+      store = self._get_store(pix_fmt)
+      if store is not None and (frame := store.get(num)) is not None:
+        self.frame_cache[(num, pix_fmt)] = frame
+        return frame
+
+      # keep decoding forward in the current session, unless the frame is behind it, in a later GOP or past its end
+      session = self.sessions.get(pix_fmt)
+      frame_b, frame_e = self.get_gop_range(num)
+      if session is None or not (frame_b <= session.next_frame <= num < session.end_frame):
+        # a session is only fed the rest of the file when reading on where the last one ended
+        sequential = session is not None and session.next_frame == num
+        if session is not None:
+          session.close()
+        if sequential:
+          frame_e = self.frame_count
+        for _ in range(SESSION_LOOKAHEAD_GOPS):
+          if frame_e < self.frame_count:
+            frame_e = self.get_gop_range(frame_e)[1]
+        _, chunks = self.get_gop_stream(num, frame_e - 1)
+        session = self.sessions[pix_fmt] = GOPDecoderSession(chunks, frame_b, frame_e, self.vid_fmt, self.w, self.h, pix_fmt)
+
+      while session.next_frame <= num:
+        i, frame = session.read()
+        self.frame_cache[(i, pix_fmt)] = frame
+        if store is not None:
+          store.put(i, frame)
+
+      return frame
+
+  def get_batch(self, indices, pix_fmt="yuv420p", out=None):
+    assert self.frame_count is not None
+    if len(indices) and not (0 <= min(indices) and max(indices) < self.frame_count):
+      raise ValueError(f"indices out of range [0, {self.frame_count})")
+    if pix_fmt not in ("nv12", "yuv420p", "rgb24", "yuv444p"):
+      raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
+
+    out = self._batch_out(len(indices), pix_fmt, out)
+    positions = {}
+    for k, num in enumerate(indices):
+      positions.setdefault(int(num), []).append(k)
+
+    # coalesce the needed frames into runs of adjacent GOPs, split across the decoder processes
+    gops = []
+    for num in sorted(positions):
+      frame_b, frame_e = self.get_gop_range(num)
+      if len(gops) and gops[-1][0] == frame_b:
+        gops[-1][2].append(num)
+      else:
+        gops.append((frame_b, frame_e, [num]))
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
-      ret = ret[skip_frames:]
-      assert ret.shape[0] == num_frames
+    max_gops = -(-len(gops) // BATCH_WORKERS)
+    runs = []
+    for frame_b, frame_e, nums in gops:
+      if len(runs) and runs[-1][1] == frame_b and runs[-1][3] < max_gops:
+        runs[-1] = (runs[-1][0], frame_e, runs[-1][2] + nums, runs[-1][3] + 1)
+      else:
+        runs.append((frame_b, frame_e, nums, 1))
 
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+    def decode_run(run):
+      frame_b, frame_e, nums, _ = run
+      _, chunks = self.get_gop_stream(frame_b, nums[-1])
+      session = GOPDecoderSession(chunks, frame_b, frame_e, self.vid_fmt, self.w, self.h, pix_fmt)
+      try:
+        scratch = np.empty(out.shape[1:], dtype=np.uint8)
+        for num in range(frame_b, nums[-1] + 1):
+          ks = positions.get(num)
+          session.readinto(out[ks[0]] if ks else scratch)
+          for k in (ks or [])[1:]:
+            out[k] = out[ks[0]]
+      finally:
+        session.close()
 
-      return self.frame_cache[(num, pix_fmt)]
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+      list(executor.map(decode_run, runs))
+    return out
+
+  def _get_store(self, pix_fmt):
+    if self.store_dir is None:
+      return None
+    if pix_fmt not in self.stores:
+      self.stores[pix_fmt] = DecodedFrameStore(self.fn, pix_fmt, self.frame_count, frame_shape(self.w, self.h, pix_fmt), self.store_dir)
+    return self.stores[pix_fmt]
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -518,9 +787,9 @@ class GOPFrameReader(BaseFrameReader):
 
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, store_dir=None):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, store_dir)
 
 
 def GOPFrameIterator(gop_reader, pix_fmt):
@@ -0,0 +1,67 @@
+import hashlib
+import os
+from collections.abc import Iterable
+
+import capnp
+import numpy as np
+
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
+from openpilot.tools.lib.filereader import resolve_name
+from openpilot.tools.lib.logindex import source_stat
+
+MONO_TIME = "logMonoTime"
+SOURCE_KEY = "__source__"
+
+
+def columns_cache_path(fn, service: str, fields: list[str], cache_dir=DEFAULT_CACHE_DIR):
+  fields_hash = hashlib.sha256(",".join(sorted(fields)).encode()).hexdigest()[:16]
+  return cache_path_for_file_path(resolve_name(fn), cache_dir) + f".{service}.{fields_hash}.npz"
+
+
+def get_field(msg, field: str):
+  # dotted paths into nested structs, lists are returned as python lists
+  for name in field.split("."):
+    msg = getattr(msg, name)
+  if isinstance(msg, capnp.lib.capnp._DynamicListReader):
+    return list(msg)
+  return msg
+
+
+def extract_columns(events: Iterable[capnp._DynamicStructReader], service: str, fields: list[str]) -> dict[str, np.ndarray]:
+  """Scalar and fixed-length list fields of a service's events as arrays, along with their logMonoTime"""
+  mono_times = []
+  values: dict[str, list] = {f: [] for f in fields}
+  for evt in events:
+    mono_times.append(evt.logMonoTime)
+    msg = getattr(evt, service)
+    for f in fields:
+      values[f].append(get_field(msg, f))
+
+  columns = {MONO_TIME: np.array(mono_times, dtype=np.uint64)}
+  for f in fields:
+    columns[f] = np.array(values[f])
+  return columns
+
+
+def concat_columns(segments: list[dict[str, np.ndarray]], fields: list[str]) -> dict[str, np.ndarray]:
+  # empty segments can't infer the shape of list fields, so they are skipped
+  segments = [s for s in segments if len(s[MONO_TIME])] or segments[:1]
+  if not len(segments):
+    return {f: np.empty(0) for f in [MONO_TIME, *fields]}
+  return {f: np.concatenate([s[f] for s in segments]) for f in [MONO_TIME, *fields]}
+
+
+def load_columns(fn, service: str, fields: list[str], cache_dir=DEFAULT_CACHE_DIR) -> dict[str, np.ndarray] | None:
+  path = columns_cache_path(fn, service, fields, cache_dir)
+  if not os.path.exists(path):
+    return None
+  with np.load(path) as dat:
+    if tuple(dat[SOURCE_KEY].tolist()) != (source_stat(resolve_name(fn)) or ()):
+      return None
+    return {f: dat[f] for f in dat.files if f != SOURCE_KEY}
+
+
+def save_columns(fn, service: str, fields: list[str], columns: dict[str, np.ndarray], cache_dir=DEFAULT_CACHE_DIR):
+  with atomic_write_in_dir(columns_cache_path(fn, service, fields, cache_dir), mode="wb", overwrite=True) as f:
+    np.savez(f, **columns, **{SOURCE_KEY: np.array(source_stat(resolve_name(fn)) or (), dtype=np.int64)})
@@ -0,0 +1,80 @@
+import os
+import pickle
+import urllib.parse
+
+import numpy as np
+
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
+from openpilot.tools.lib.filereader import resolve_name
+
+INDEX_VERSION = 1
+
+
+def index_path(fn, cache_dir=DEFAULT_CACHE_DIR):
+  return cache_path_for_file_path(resolve_name(fn), cache_dir) + ".index"
+
+
+def source_stat(fn):
+  # remote logs are immutable, local ones are validated against their size and mtime
+  if urllib.parse.urlparse(fn).scheme != '':
+    return None
+  st = os.stat(fn)
+  return st.st_size, st.st_mtime_ns
+
+
+class LogIndex:
+  """Decompressed byte offsets, sizes and logMonoTimes of a segment's events, grouped by union type"""
+  def __init__(self, offsets: dict[str, np.ndarray], sizes: dict[str, np.ndarray], times: dict[str, np.ndarray]):
+    self.offsets = offsets
+    self.sizes = sizes
+    self.times = times
+
+  @classmethod
+  def from_events(cls, events: list[tuple[str, int, int, int]]) -> 'LogIndex':
+    # events are (which, offset, size, logMonoTime)
+    grouped: dict[str, list[tuple[int, int, int]]] = {}
+    for which, offset, size, t in events:
+      grouped.setdefault(which, []).append((offset, size, t))
+
+    offsets, sizes, times = {}, {}, {}
+    for which, ents in grouped.items():
+      arr = np.array(ents, dtype=np.uint64).reshape(-1, 3)
+      offsets[which], sizes[which], times[which] = arr[:, 0], arr[:, 1], arr[:, 2]
+    return cls(offsets, sizes, times)
+
+  @classmethod
+  def load(cls, fn, cache_dir=DEFAULT_CACHE_DIR) -> 'LogIndex | None':
+    path = index_path(fn, cache_dir)
+    if not os.path.exists(path):
+      return None
+
+    with open(path, "rb") as f:
+      dat = pickle.load(f)
+    if dat['version'] != INDEX_VERSION or dat['source'] != source_stat(resolve_name(fn)):
+      return None
+    return cls(dat['offsets'], dat['sizes'], dat['times'])
+
+  def save(self, fn, cache_dir=DEFAULT_CACHE_DIR):
+    dat = {
+      'version': INDEX_VERSION,
+      'source': source_stat(resolve_name(fn)),
+      'offsets': self.offsets,
+      'sizes': self.sizes,
+      'times': self.times,
+    }
+    with atomic_write_in_dir(index_path(fn, cache_dir), mode="wb", overwrite=True) as f:
+      pickle.dump(dat, f, -1)
+
+  def select(self, which: str, start_time: int | None = None, end_time: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Offsets and sizes of the events of a type within [start_time, end_time), in file order"""
+    if which not in self.offsets:
+      return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+
+    offsets, sizes, times = self.offsets[which], self.sizes[which], self.times[which]
+    mask = np.ones(len(offsets), dtype=bool)
+    if start_time is not None:
+      mask &= times >= start_time
+    if end_time is not None:
+      mask &= times < end_time
+    return offsets[mask], sizes[mask]
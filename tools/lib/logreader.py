@@ -4,14 +4,19 @@ from functools import cache, partial
 import multiprocessing
 import capnp
 import enum
+import heapq
+import itertools
+import numpy as np
 import os
 import pathlib
+import struct
 import sys
 import tqdm
 import urllib.parse
 import warnings
 import zstd
 
+from collections import deque
 from collections.abc import Callable, Iterable, Iterator
 from urllib.parse import parse_qs, urlparse
 
@@ -20,36 +25,186 @@ from openpilot.common.swaglog import cloudlog
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
 from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
+from openpilot.tools.lib.logcolumns import concat_columns, extract_columns, load_columns, save_columns
+from openpilot.tools.lib.logindex import LogIndex
 from openpilot.tools.lib.route import Route, SegmentRange
+from openpilot.tools.lib.url_file import CHUNK_SIZE
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
 
 
+# streamed remote files are downloaded this far ahead of the decoder
+STREAM_READAHEAD = 8 * CHUNK_SIZE
+
+
+def _is_bz2(ext, dat):
+  return ext == ".bz2" or dat.startswith(b'BZh9')
+
+
+def _is_zstd(ext, dat):
+  # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+  return ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD')
+
+
+def _decompressed_chunks(f, ext, chunk_size=CHUNK_SIZE) -> Iterator[bytes]:
+  dat = f.read(chunk_size)
+  if _is_bz2(ext, dat):
+    decompressor = bz2.BZ2Decompressor()
+    while dat:
+      yield decompressor.decompress(dat)
+      if decompressor.eof:
+        # concatenated bz2 streams
+        dat = decompressor.unused_data
+        decompressor = bz2.BZ2Decompressor()
+        if dat:
+          continue
+      dat = f.read(chunk_size)
+  elif _is_zstd(ext, dat):
+    # the zstd module has no streaming decoder, events are still decoded lazily
+    yield zstd.decompress(dat + f.read())
+  else:
+    while dat:
+      yield dat
+      dat = f.read(chunk_size)
+
+
+def _message_sizes(buf) -> list[int]:
+  # sizes of the complete capnp messages at the start of buf, parsed from their segment tables
+  # https://capnproto.org/encoding.html#serialization-over-a-stream
+  sizes = []
+  offset = 0
+  while len(buf) - offset >= 4:
+    num_segments = struct.unpack_from("<I", buf, offset)[0] + 1
+    header_size = 4 * (num_segments + 1)
+    header_size += header_size % 8
+    if len(buf) - offset < header_size:
+      break
+    size = header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", buf, offset + 4))
+    if len(buf) - offset < size:
+      break
+    sizes.append(size)
+    offset += size
+  return sizes
+
+
+def _stream_batches(chunks: Iterable[bytes]) -> Iterator[tuple[int, bytes, list[int]]]:
+  # yields (decompressed offset, data, message sizes) for each run of complete messages
+  buf = bytearray()
+  offset = 0
+  for chunk in chunks:
+    buf += chunk
+    sizes = _message_sizes(buf)
+    if len(sizes):
+      end = sum(sizes)
+      yield offset, bytes(buf[:end]), sizes
+      del buf[:end]
+      offset += end
+
+  if len(buf):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+
+def _file_ext(fn):
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ('', '.bz2', '.zst'):
+    # old rlogs weren't compressed
+    raise Exception(f"unknown extension {ext}")
+  return ext
+
+
+def _decompressed_segment(fn, sort_by_time=False) -> bytes:
+  # runs in prefetch workers: download and decompress, and reorder the raw messages by time
+  with FileReader(fn) as f:
+    dat = b"".join(_decompressed_chunks(f, _file_ext(fn)))
+  if not sort_by_time:
+    return dat
+
+  sizes = _message_sizes(dat)
+  times = []
+  try:
+    for ent in capnp_log.Event.read_multiple_bytes(dat):
+      times.append(ent.logMonoTime)
+  except capnp.KjException:
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+  offsets = list(itertools.accumulate(sizes, initial=0))
+  order = sorted(range(len(times)), key=times.__getitem__)
+  return b"".join(dat[offsets[i]:offsets[i + 1]] for i in order)
+
+
+def _merge_sorted_segments(segments: Iterable[Iterable[capnp._DynamicStructReader]]) -> Iterator[capnp._DynamicStructReader]:
+  """k-way merge of time sorted segments. A segment is only pulled in once the merge reaches its first message,
+  so only segments overlapping in time are held at once. Segments may overlap, but each has to start no earlier
+  than the messages already merged when it's pulled in, as consecutive segments of a route do. One that starts
+  earlier can't be merged anymore and is concatenated after the segments being merged, with a warning."""
+  heap: list = []
+  tiebreak = itertools.count()
+  last = None
+
+  def peek(seg, it):
+    msg = next(it, None)
+    return None if msg is None else (msg.logMonoTime, seg, next(tiebreak), msg, it)
+
+  upcoming = (e for e in itertools.starmap(peek, enumerate(map(iter, segments))) if e is not None)
+  nxt = next(upcoming, None)
+  while len(heap) or nxt is not None:
+    overlaps = nxt is not None and last is not None and nxt[0] < last
+    if nxt is not None and (not len(heap) or (not overlaps and nxt[0] <= heap[0][0])):
+      if overlaps:
+        warnings.warn(f"Segment {nxt[1]} starts before messages already merged, concatenating it", RuntimeWarning, stacklevel=1)
+      if not len(heap):
+        last = None
+      heapq.heappush(heap, nxt)
+      nxt = next(upcoming, None)
+      continue
+
+    last, seg, _, msg, it = heapq.heappop(heap)
+    yield msg
+    if (e := peek(seg, it)) is not None:
+      heapq.heappush(heap, e)
+
+
+def _in_time_range(t: int, start_time: int | None, end_time: int | None) -> bool:
+  return (start_time is None or t >= start_time) and (end_time is None or t < end_time)
+
+
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None, streaming=False, index=False):
     self.data_version = None
+    self._fn = fn
     self._only_union_types = only_union_types
+    self._ents: list[capnp._DynamicStructReader] | None = None
+    self._use_index = False
+    self._index: LogIndex | None = None
+    self._dat: bytes | None = None
+    self._order: list[int] | None = None
 
     ext = None
     if not dat:
-      _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-      if ext not in ('', '.bz2', '.zst'):
-        # old rlogs weren't compressed
-        raise Exception(f"unknown extension {ext}")
+      ext = _file_ext(fn)
+    self._ext = ext
 
+    # in streaming mode the file is read, decompressed and decoded incrementally on each iteration
+    if streaming and not dat and not sort_by_time:
+      if index:
+        self._use_index = True
+        self._index = LogIndex.load(fn)
+      return
+
+    if not dat:
       with FileReader(fn) as f:
         dat = f.read()
 
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
+    if _is_bz2(ext, dat):
       dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+    elif _is_zstd(ext, dat):
       dat = zstd.decompress(dat)
 
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
+    self._dat = dat
     self._ents = []
     try:
       for e in ents:
@@ -58,10 +213,64 @@ class _LogFileReader:
       warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
     if sort_by_time:
-      self._ents.sort(key=lambda x: x.logMonoTime)
+      self._order = sorted(range(len(self._ents)), key=lambda i: self._ents[i].logMonoTime)
+      self._ents = [self._ents[i] for i in self._order]
+
+  def _batches(self) -> Iterator[tuple[int, bytes, list[int]]]:
+    with FileReader(self._fn, readahead=STREAM_READAHEAD) as f:
+      yield from _stream_batches(_decompressed_chunks(f, self._ext))
+
+  def _stream(self) -> Iterator[capnp._DynamicStructReader]:
+    build_index = self._use_index and self._index is None
+    events = []
+    try:
+      for offset, batch, sizes in self._batches():
+        if not build_index:
+          yield from capnp_log.Event.read_multiple_bytes(batch)
+          continue
+
+        for ent, size in zip(capnp_log.Event.read_multiple_bytes(batch), sizes, strict=True):
+          try:
+            events.append((ent.which(), offset, size, ent.logMonoTime))
+          except capnp.KjException:
+            pass  # non-union events can't be filtered for
+          offset += size
+          yield ent
+    except capnp.KjException:
+      warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+      return
+
+    # the index is only written after a complete read
+    if build_index:
+      self._index = LogIndex.from_events(events)
+      self._index.save(self._fn)
+
+  def _stream_selected(self, offsets: np.ndarray, sizes: np.ndarray) -> Iterator[capnp._DynamicStructReader]:
+    # decompresses up to the last selected event, but only decodes the selected ones
+    if not len(offsets):
+      return
+
+    last_end = int(offsets[-1] + sizes[-1])
+    try:
+      for offset, batch, _ in self._batches():
+        batch_end = offset + len(batch)
+        lo, hi = np.searchsorted(offsets, [offset, batch_end])
+        if hi > lo:
+          selected = b"".join(batch[o - offset:o - offset + s] for o, s in zip(offsets[lo:hi].tolist(), sizes[lo:hi].tolist(), strict=True))
+          yield from capnp_log.Event.read_multiple_bytes(selected)
+        if batch_end >= last_end:
+          break
+    except capnp.KjException:
+      warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+  def filter(self, which: str, start_time: int | None = None, end_time: int | None = None) -> Iterator[capnp._DynamicStructReader]:
+    if self._index is None:
+      return (ent for ent in self if ent.which() == which and _in_time_range(ent.logMonoTime, start_time, end_time))
+    return self._stream_selected(*self._index.select(which, start_time, end_time))
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    ents = self._ents if self._ents is not None else self._stream()
+    for ent in ents:
       if self._only_union_types:
         try:
           ent.which()
@@ -71,6 +280,19 @@ class _LogFileReader:
       else:
         yield ent
 
+  def raw_events(self) -> Iterator[tuple[capnp._DynamicStructReader, bytes]]:
+    """Events with their serialized bytes as read from the log, for logs read into memory"""
+    assert self._ents is not None and self._dat is not None, "raw events are only kept for logs read into memory"
+    offsets = list(itertools.accumulate(_message_sizes(self._dat), initial=0))
+    order = self._order if self._order is not None else range(len(self._ents))
+    for i, ent in zip(order, self._ents, strict=True):
+      if self._only_union_types:
+        try:
+          ent.which()
+        except capnp.lib.capnp.KjException:
+          continue
+      yield ent, self._dat[offsets[i]:offsets[i + 1]]
+
 
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
@@ -257,25 +479,57 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               default_source=auto_source, sort_by_time=False, only_union_types=False):
+               default_source=auto_source, sort_by_time=False, only_union_types=False, streaming=True, use_index=False,
+               prefetch=0):
     self.default_mode = default_mode
     self.default_source = default_source
     self.identifier = identifier
 
+    # sort each segment by logMonoTime and merge them, see _merge_sorted_segments for segments overlapping in time
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    # stream segments with bounded memory, re-reading them on every iteration
+    self.streaming = streaming
+    # cache a per-segment index of event offsets by type, used by filter() and first()
+    self.use_index = use_index
+    # number of upcoming segments downloaded and decompressed in worker processes while iterating,
+    # segments are still yielded (or merged with sort_by_time) in order
+    self.prefetch = prefetch
 
     self.__lrs: dict[int, _LogFileReader] = {}
     self.reset()
 
   def _get_lr(self, i):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                                     streaming=self.streaming, index=self.use_index)
     return self.__lrs[i]
 
+  def _prefetched_segments(self) -> Iterator[LogIterable]:
+    identifiers = iter(self.logreader_identifiers)
+    with multiprocessing.Pool(self.prefetch) as pool:
+      pending: deque = deque()
+      for fn in itertools.islice(identifiers, self.prefetch):
+        pending.append(pool.apply_async(_decompressed_segment, (fn, self.sort_by_time)))
+
+      while len(pending):
+        dat = pending.popleft().get()
+        if (fn := next(identifiers, None)) is not None:
+          pending.append(pool.apply_async(_decompressed_segment, (fn, self.sort_by_time)))
+        yield _LogFileReader("", dat=dat, only_union_types=self.only_union_types) if len(dat) else []
+
   def __iter__(self):
-    for i in range(len(self.logreader_identifiers)):
-      yield from self._get_lr(i)
+    num_segs = len(self.logreader_identifiers)
+    if self.prefetch > 0 and num_segs > 1:
+      segments = self._prefetched_segments()
+    else:
+      segments = (self._get_lr(i) for i in range(num_segs))
+
+    if self.sort_by_time:
+      yield from _merge_sorted_segments(segments)
+    else:
+      for lr in segments:
+        yield from lr
 
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
@@ -288,6 +542,28 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
         ret.extend(p)
       return ret
 
+  def _segment_columns(self, service, fields, cache, i):
+    fn = self.logreader_identifiers[i]
+    if cache and (columns := load_columns(fn, service, fields)) is not None:
+      return columns
+
+    columns = extract_columns(self._get_lr(i).filter(service), service, fields)
+    if cache:
+      save_columns(fn, service, fields, columns)
+    return columns
+
+  def to_columns(self, service: str, fields: list[str], num_processes: int | None = None, cache: bool = False) -> dict[str, np.ndarray]:
+    """Extracts fields of a service across all segments into arrays keyed by field name and logMonoTime.
+    Fields are dotted paths to scalar or fixed-length list fields, e.g. ['vEgo', 'cruiseState.speed']."""
+    num_segs = len(self.logreader_identifiers)
+    func = partial(self._segment_columns, service, fields, cache)
+    if num_segs <= 1 or num_processes == 1:
+      segments = [func(i) for i in range(num_segs)]
+    else:
+      with multiprocessing.Pool(num_processes) as pool:
+        segments = pool.map(func, range(num_segs))
+    return concat_columns(segments, fields)
+
   def reset(self):
     self.logreader_identifiers = self._parse_identifiers(self.identifier)
 
@@ -295,8 +571,13 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
-  def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+  def filter(self, msg_type: str, start_time: int | None = None, end_time: int | None = None):
+    # optionally limited to events with start_time <= logMonoTime < end_time
+    if self.prefetch > 0 or self.sort_by_time:
+      msgs = (m for m in self if m.which() == msg_type and _in_time_range(m.logMonoTime, start_time, end_time))
+    else:
+      msgs = (m for i in range(len(self.logreader_identifiers)) for m in self._get_lr(i).filter(msg_type, start_time, end_time))
+    return (getattr(m, msg_type) for m in msgs)
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import http.server
+import os
+import shutil
+import threading
+import time
+
+from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.url_file import CHUNK_SIZE, URLFile
+
+SIZE_MB = int(os.getenv("SIZE_MB", "32"))
+LATENCY = float(os.getenv("LATENCY", "0.05"))  # seconds added to every request
+BANDWIDTH_MBPS = float(os.getenv("BANDWIDTH_MBPS", "200"))  # per connection
+
+
+class StandInRequestHandler(http.server.BaseHTTPRequestHandler):
+  """Serves random bytes with range support, and per-request latency and per-connection bandwidth"""
+  DATA = os.urandom(SIZE_MB * CHUNK_SIZE)
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+  def do_GET(self):
+    time.sleep(LATENCY)
+    if "Range" in self.headers:
+      begin, end = (int(x) for x in self.headers["Range"].removeprefix("bytes=").split("-"))
+      data = self.DATA[begin:end + 1]
+      self.send_response(206)
+    else:
+      data = self.DATA
+      self.send_response(200)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    time.sleep(len(data) / (BANDWIDTH_MBPS * 1e6))
+    self.wfile.write(data)
+
+
+def timed(name, url, clear_cache=True, **kwargs):
+  if clear_cache and os.path.exists(Paths.download_cache_root()):
+    shutil.rmtree(Paths.download_cache_root())
+  read_size = kwargs.pop("read_size", None)
+
+  t = time.monotonic()
+  f = URLFile(url, **kwargs)
+  total = 0
+  while len(dat := f.read(ll=read_size)):
+    total += len(dat)
+    if read_size is None:
+      break
+  dt = time.monotonic() - t
+  assert total == len(StandInRequestHandler.DATA)
+  print(f"{name:>45}: {dt:6.2f}s, {total / dt / 1e6:7.1f} MB/s")
+
+
+if __name__ == "__main__":
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInRequestHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = f"http://127.0.0.1:{server.server_port}/rlog.bz2"
+
+  print(f"{SIZE_MB} MB file, {LATENCY * 1000:.0f} ms latency, {BANDWIDTH_MBPS:.0f} MB/s per connection")
+  timed("no cache, single read", url, cache=False)
+  timed("no cache, 1 chunk reads", url, cache=False, read_size=CHUNK_SIZE)
+  timed("no cache, 1 chunk reads, 8 chunk readahead", url, cache=False, read_size=CHUNK_SIZE, readahead=8 * CHUNK_SIZE)
+  timed("cache, single read", url, cache=True)
+  timed("cache, 1 chunk reads", url, cache=True, read_size=CHUNK_SIZE)
+  timed("cache, 1 chunk reads, 8 chunk readahead", url, cache=True, read_size=CHUNK_SIZE, readahead=8 * CHUNK_SIZE)
+  timed("hot cache, single read", url, clear_cache=False, cache=True)
+  timed("hot cache, 1 chunk reads", url, clear_cache=False, cache=True, read_size=CHUNK_SIZE)
+  server.shutdown()
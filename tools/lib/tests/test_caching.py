@@ -1,11 +1,13 @@
 import http.server
 import os
+import random
 import shutil
 import socket
 import pytest
 
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.download_cache import DownloadCache
 from openpilot.tools.lib.url_file import URLFile
 
 
@@ -28,6 +30,27 @@ class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
     self.end_headers()
 
 
+class RangeTestRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = random.Random(0).randbytes(4567)
+
+  def do_GET(self):
+    if "Range" in self.headers:
+      begin, end = (int(x) for x in self.headers["Range"].removeprefix("bytes=").split("-"))
+      data = self.DATA[begin:end + 1]
+      self.send_response(206)
+    else:
+      data = self.DATA
+      self.send_response(200)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+
 @pytest.fixture
 def host():
   with http_server_context(handler=CachingTestRequestHandler) as (host, port):
@@ -128,3 +151,90 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+  @pytest.mark.parametrize("cache_enabled", [True, False])
+  def test_concurrent_ranges(self, mocker, cache_enabled):
+    # small chunks so reads span many coalesced range requests
+    mocker.patch("openpilot.tools.lib.url_file.CHUNK_SIZE", 100)
+    if os.path.exists(Paths.download_cache_root()):
+      shutil.rmtree(Paths.download_cache_root())
+
+    data = RangeTestRequestHandler.DATA
+    with http_server_context(handler=RangeTestRequestHandler) as (host, port):
+      file_url = f"http://{host}:{port}/test.bin"
+      for start, length, readahead in [(0, None, 0), (50, 1000, 0), (120, 3000, 500), (4500, 100, 1000), (0, 10, 10000)]:
+        f = URLFile(file_url, cache=cache_enabled, readahead=readahead)
+        f.seek(start)
+        end = len(data) if length is None else min(start + length, len(data))
+        assert f.read(ll=length) == data[start:end]
+        assert f.read(ll=1) == data[end:end + 1]
+
+    # everything is served from the cache after the server is gone
+    if cache_enabled:
+      assert URLFile(file_url, cache=True).read() == data
+
+  def test_lru_eviction(self, mocker, tmp_path):
+    mocker.patch("openpilot.tools.lib.download_cache.EVICTION_GRACE", 0)
+    mocker.patch("openpilot.tools.lib.download_cache.time.time", side_effect=range(100))
+    cache = DownloadCache(str(tmp_path), max_size=250)
+
+    for url_hash in ("a", "b", "c"):
+      cache.write_chunks(url_hash, 100, 10, {i: bytes([i]) * 10 for i in range(10)})
+    assert cache.size() == 300 - 100
+
+    # a was evicted, b is used again so c is next
+    assert cache.present_chunks("a", 0, 9) == set()
+    assert cache.read("b", 5, 25) == b"\x00" * 5 + b"\x01" * 10 + b"\x02" * 5
+    cache.write_chunks("d", 100, 10, dict.fromkeys(range(10), b"d" * 10))
+    assert cache.present_chunks("c", 0, 9) == set()
+    assert cache.present_chunks("b", 0, 9) == set(range(10))
+    assert cache.get_length("d") == 100
+
+  def test_missing_data_file(self, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    cache.write_chunks("a", 20, 10, {0: b"a" * 10, 1: b"b" * 10})
+    assert cache.size() == 20
+
+    # a data file removed behind the index is a miss, not an error
+    os.remove(os.path.join(str(tmp_path), "a.bin"))
+    assert cache.read("a", 0, 20) is None
+    assert cache.present_chunks("a", 0, 1) == set()
+    assert cache.get_length("a") is None
+    assert cache.size() == 0
+
+    cache.write_chunks("a", 20, 10, {1: b"b" * 10})
+    assert cache.read("a", 10, 20) == b"b" * 10
+    assert cache.size() == 10
+
+  def test_missing_data_file_refetch(self):
+    if os.path.exists(Paths.download_cache_root()):
+      shutil.rmtree(Paths.download_cache_root())
+
+    data = RangeTestRequestHandler.DATA
+    with http_server_context(handler=RangeTestRequestHandler) as (host, port):
+      file_url = f"http://{host}:{port}/test.bin"
+      assert URLFile(file_url, cache=True).read() == data
+      for fn in os.listdir(Paths.download_cache_root()):
+        if fn.endswith(".bin"):
+          os.remove(os.path.join(Paths.download_cache_root(), fn))
+      assert URLFile(file_url, cache=True).read() == data
+
+  def test_shared_cache(self):
+    a, b = URLFile("http://localhost/a.bin", cache=True), URLFile("http://localhost/b.bin", cache=True)
+    assert a._cache is b._cache
+
+    # rebuilt once the cache directory is removed
+    shutil.rmtree(Paths.download_cache_root())
+    assert URLFile("http://localhost/a.bin", cache=True)._cache is not a._cache
+    assert os.path.exists(os.path.join(Paths.download_cache_root(), "index.db"))
+
+  def test_missing_data_file_fallback(self, mocker):
+    # a data file that keeps disappearing is fetched again once, then read without the cache
+    read = mocker.patch.object(DownloadCache, "read", return_value=None)
+    data = RangeTestRequestHandler.DATA
+    with http_server_context(handler=RangeTestRequestHandler) as (host, port):
+      f = URLFile(f"http://{host}:{port}/test.bin", cache=True)
+      f.seek(100)
+      assert f.read(ll=1000) == data[100:1100]
+      assert f.read(ll=10) == data[1100:1110]
+    assert read.call_count == 4
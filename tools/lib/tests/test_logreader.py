@@ -1,3 +1,4 @@
+import bz2
 import capnp
 import contextlib
 import io
@@ -6,11 +7,13 @@ import tempfile
 import os
 import pytest
 import requests
+import zstd
 
 from parameterized import parameterized
 
 from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
+from openpilot.tools.lib.logindex import index_path
+from openpilot.tools.lib.logreader import LogIterable, LogReader, _LogFileReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
 from openpilot.tools.lib.route import SegmentRange
 from openpilot.tools.lib.url_file import URLFileException
 
@@ -255,3 +258,120 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("compress", [None, bz2.compress, zstd.compress])
+  def test_streaming(self, compress):
+    with tempfile.NamedTemporaryFile() as qlog:
+      num_msgs = 1000
+      msgs = [capnp_log.Event.new_message(logMonoTime=i, carState={"vEgo": i}).to_bytes() for i in range(num_msgs)]
+      dat = b"".join(msgs)
+      with open(qlog.name, "wb") as f:
+        f.write(compress(dat) if compress is not None else dat)
+
+      streamed = [m.as_builder().to_bytes() for m in LogReader(qlog.name)]
+      eager = [m.as_builder().to_bytes() for m in LogReader(qlog.name, streaming=False)]
+      assert streamed == eager == msgs
+      assert LogReader(qlog.name).first("carState").vEgo == 0
+
+      # trailing partial message is dropped
+      with open(qlog.name, "wb") as f:
+        f.write(dat + msgs[0][:16])
+      with pytest.warns(RuntimeWarning, match="Corrupted events detected"):
+        assert len(list(LogReader(qlog.name))) == num_msgs
+
+  def test_raw_events(self):
+    num_msgs = 100
+    msgs = [capnp_log.Event.new_message(logMonoTime=(i * 7) % num_msgs, carState={"vEgo": i}).to_bytes() for i in range(num_msgs)]
+    for sort_by_time in (False, True):
+      lr = _LogFileReader("", dat=b"".join(msgs), sort_by_time=sort_by_time)
+      raw = list(lr.raw_events())
+      assert [m for m, _ in raw] == list(lr)
+      assert sorted(dat for _, dat in raw) == sorted(msgs)
+      for m, dat in raw:
+        assert next(iter(LogReader.from_bytes(dat))).carState.vEgo == m.carState.vEgo
+
+  def test_index(self):
+    with tempfile.NamedTemporaryFile(suffix=".bz2") as qlog:
+      num_msgs = 1000
+      msgs = []
+      for i in range(num_msgs):
+        msg = capnp_log.Event.new_message(logMonoTime=i)
+        if i % 10 == 0:
+          msg.init("carState").vEgo = i
+        else:
+          msg.init("can", 1)
+        msgs.append(msg.to_bytes())
+      with open(qlog.name, "wb") as f:
+        f.write(bz2.compress(b"".join(msgs)))
+
+      try:
+        lr = LogReader(qlog.name, use_index=True)
+        expected = [m.vEgo for m in LogReader(qlog.name).filter("carState")]
+        assert [m.vEgo for m in lr.filter("carState")] == expected
+        assert os.path.exists(index_path(qlog.name))
+
+        # served from the index
+        lr = LogReader(qlog.name, use_index=True)
+        assert [m.vEgo for m in lr.filter("carState")] == expected
+        assert [m.vEgo for m in lr.filter("carState", 100, 200)] == list(range(100, 200, 10))
+        assert lr.first("carState").vEgo == 0
+        assert lr.first("liveCalibration") is None
+      finally:
+        if os.path.exists(index_path(qlog.name)):
+          os.remove(index_path(qlog.name))
+
+  def test_to_columns(self):
+    with tempfile.NamedTemporaryFile(suffix=".bz2") as qlog:
+      msgs = []
+      for i in range(100):
+        msg = capnp_log.Event.new_message(logMonoTime=i)
+        if i % 2 == 0:
+          msg.init("carState").vEgo = i
+          msg.carState.cruiseState.speed = 2 * i
+        else:
+          msg.init("liveCalibration").rpyCalib = [0., 0., i]
+        msgs.append(msg.to_bytes())
+      with open(qlog.name, "wb") as f:
+        f.write(bz2.compress(b"".join(msgs)))
+
+      lr = LogReader([qlog.name, qlog.name])
+      for num_processes in (1, 2):
+        columns = lr.to_columns("carState", ["vEgo", "cruiseState.speed"], num_processes=num_processes)
+        assert list(columns["logMonoTime"]) == list(range(0, 100, 2)) * 2
+        assert list(columns["vEgo"]) == list(range(0, 100, 2)) * 2
+        assert list(columns["cruiseState.speed"]) == list(range(0, 200, 4)) * 2
+
+      calib = lr.to_columns("liveCalibration", ["rpyCalib"])["rpyCalib"]
+      assert calib.shape == (100, 3)
+      assert len(lr.to_columns("carControl", ["enabled"])["enabled"]) == 0
+
+  @pytest.mark.parametrize("sort_by_time", [True, False])
+  def test_prefetch(self, sort_by_time):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      # segments overlap in time and aren't sorted
+      fns = []
+      for seg in range(3):
+        times = [seg * 1000 + (i * 7919) % 1200 for i in range(200)]
+        fns.append(os.path.join(tmpdir, f"rlog{seg}.bz2"))
+        with open(fns[-1], "wb") as f:
+          f.write(bz2.compress(b"".join(capnp_log.Event.new_message(logMonoTime=t).to_bytes() for t in times)))
+
+      expected = [m.logMonoTime for m in LogReader(fns, sort_by_time=sort_by_time)]
+      assert [m.logMonoTime for m in LogReader(fns, sort_by_time=sort_by_time, prefetch=2)] == expected
+      if sort_by_time:
+        assert expected == sorted(m.logMonoTime for m in LogReader(fns))
+
+  @pytest.mark.parametrize("prefetch", [0, 2])
+  def test_sort_overlapping_segments(self, prefetch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      # the second segment overlaps the first, the third starts before both have been merged
+      segments = [list(range(0, 1000, 3)), list(range(500, 1500, 7)), list(range(200, 300, 5))]
+      fns = []
+      for seg, times in enumerate(segments):
+        fns.append(os.path.join(tmpdir, f"rlog{seg}.bz2"))
+        with open(fns[-1], "wb") as f:
+          f.write(bz2.compress(b"".join(capnp_log.Event.new_message(logMonoTime=t).to_bytes() for t in reversed(times))))
+
+      with pytest.warns(RuntimeWarning, match="Segment 2 starts before"):
+        times = [m.logMonoTime for m in LogReader(fns, sort_by_time=True, prefetch=prefetch)]
+      assert times == sorted(segments[0] + segments[1]) + segments[2]
@@ -1,11 +1,41 @@
+import os
 import pytest
 import requests
+import subprocess
 import tempfile
 
 from collections import defaultdict
 import numpy as np
-from openpilot.tools.lib.framereader import FrameReader
+from openpilot.tools.lib.framereader import BaseFrameReader, DecodedFrameStore, FrameReader
 from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.vidindex import hevc_index
+
+
+class CountingFrameReader(BaseFrameReader):
+  w, h, frame_count = 8, 6, 10
+
+  def get(self, num, count=1, pix_fmt="yuv420p"):
+    shape = (self.h, self.w, 3) if pix_fmt == "rgb24" else (self.h * self.w * 3 // 2,)
+    return [np.full(shape, num + i, dtype=np.uint8) for i in range(count)]
+
+
+@pytest.fixture
+def hevc_video(tmp_path):
+  # 100 frames in GOPs of 10, indexed here so the reader doesn't need ffprobe
+  w, h, frame_count = 64, 48, 100
+  fn = str(tmp_path / "video.hevc")
+  subprocess.check_call(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"testsrc=size={w}x{h}:rate=20", "-frames:v", str(frame_count),
+                         "-pix_fmt", "yuv420p", "-c:v", "libx265", "-x265-params", "log-level=error:keyint=10:min-keyint=10:bframes=0:scenecut=0",
+                         "-f", "hevc", fn])
+  frame_types, dat_len, prefix = hevc_index(fn)
+  index_data = {
+    'index': np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32),
+    'global_prefix': prefix,
+    'probe': {'streams': [{'width': w, 'height': h}]},
+  }
+  raw = subprocess.check_output(["ffmpeg", "-v", "error", "-i", fn, "-f", "rawvideo", "-pix_fmt", "yuv420p", "pipe:1"])
+  frames = np.frombuffer(raw, dtype=np.uint8).reshape(frame_count, -1)
+  return fn, index_data, frames
 
 
 class TestReaders:
@@ -61,3 +91,69 @@ class TestReaders:
 
     fr_url = FrameReader("https://github.com/commaai/comma2k19/blob/master/Example_1/b0c9d2329ad1606b%7C2018-08-02--08-34-47/40/video.hevc?raw=true")
     _check_data(fr_url)
+
+  def test_decoded_frame_store(self, tmp_path):
+    shape = (6, 4, 3)
+    frame_size = int(np.prod(shape))
+    store = DecodedFrameStore("/tmp/a.hevc", "rgb24", 10, shape, cache_dir=str(tmp_path), max_size=10 * frame_size)
+    assert store.get(3) is None
+    store.put(3, np.full(shape, 3, dtype=np.uint8))
+
+    # shared with other readers of the same file, and read-only
+    frame = DecodedFrameStore("/tmp/a.hevc", "rgb24", 10, shape, cache_dir=str(tmp_path)).get(3)
+    assert np.all(frame == 3)
+    assert not frame.flags.writeable
+
+    # filling another store past the budget evicts the least recently used one
+    other = DecodedFrameStore("/tmp/b.hevc", "rgb24", 10, shape, cache_dir=str(tmp_path), max_size=10 * frame_size)
+    for i in range(10):
+      other.put(i, np.full(shape, i, dtype=np.uint8))
+    other.frames.flush()
+    other.evict()
+    assert not os.path.exists(store.frames_path)
+    assert DecodedFrameStore("/tmp/b.hevc", "rgb24", 10, shape, cache_dir=str(tmp_path)).get(9)[0, 0, 0] == 9
+
+  def test_decoder_session_reuse(self, hevc_video):
+    fn, index_data, frames = hevc_video
+    with FrameReader(fn, index_data=index_data) as fr:
+      sessions = []
+      for i in range(len(frames)):
+        assert np.all(fr.get(i)[0] == frames[i])
+        if fr.sessions["yuv420p"] not in sessions:
+          sessions.append(fr.sessions["yuv420p"])
+
+      # the first session is fed the GOP and a few after it, reading on from its end feeds the rest of the file
+      assert len(sessions) == 2
+      assert sessions[0].end_frame == 30
+      assert sessions[1].end_frame == fr.frame_count
+
+      # seeking back, past the decoded frames kept in memory, restarts at the GOP of the frame
+      assert np.all(fr.get(15)[0] == frames[15])
+      session = fr.sessions["yuv420p"]
+      assert session not in sessions
+      assert (session.next_frame, session.end_frame) == (16, 40)
+
+  def test_get_batch_hevc(self, hevc_video):
+    fn, index_data, frames = hevc_video
+    with FrameReader(fn, index_data=index_data) as fr:
+      # unsorted, duplicated and spanning GOPs split across the decoder processes
+      indices = [57, 3, 99, 3, 0, 42, 57, 11, 10, 98]
+      batch = fr.get_batch(indices)
+      assert np.array_equal(batch, frames[indices])
+      assert np.array_equal(batch, np.stack([fr.get(i)[0] for i in indices]))
+
+      rgb = fr.get_batch(indices, pix_fmt="rgb24")
+      assert np.array_equal(rgb, np.stack([fr.get(i, pix_fmt="rgb24")[0] for i in indices]))
+
+  def test_get_batch(self):
+    fr = CountingFrameReader()
+    batch = fr.get_batch([3, 1, 3])
+    assert batch.shape == (3, 6 * 8 * 3 // 2)
+    assert list(batch[:, 0]) == [3, 1, 3]
+
+    out = np.zeros((2, 6, 8, 3), dtype=np.uint8)
+    assert fr.get_batch([7, 9], pix_fmt="rgb24", out=out) is out
+    assert np.all(out[1] == 9)
+
+    with pytest.raises(ValueError):
+      fr.get_batch([0], pix_fmt="rgb24", out=np.zeros((1, 8, 6, 3), dtype=np.uint8))
@@ -2,16 +2,20 @@ import logging
 import os
 import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
 from urllib3.util import Timeout
 
-from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.download_cache import DownloadCache
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+#  Adjacent missing chunks are fetched in a single range request of up to this many chunks
+MAX_RANGE_CHUNKS = 8
+NUM_FETCH_WORKERS = 8
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -24,12 +28,27 @@ class URLFileException(Exception):
   pass
 
 
+def coalesce_chunks(chunks: list[int], max_run: int = MAX_RANGE_CHUNKS) -> list[list[int]]:
+  """Groups sorted chunk numbers into runs of consecutive chunks"""
+  runs: list[list[int]] = []
+  for c in chunks:
+    if len(runs) and runs[-1][-1] == c - 1 and len(runs[-1]) < max_run:
+      runs[-1].append(c)
+    else:
+      runs.append([c])
+  return runs
+
+
 class URLFile:
   _pool_manager: PoolManager|None = None
+  _executor: ThreadPoolExecutor|None = None
+  _download_cache: DownloadCache|None = None
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    URLFile._executor = None
+    URLFile._download_cache = None
 
   @staticmethod
   def pool_manager() -> PoolManager:
@@ -39,8 +58,27 @@ class URLFile:
       URLFile._pool_manager = PoolManager(num_pools=10, maxsize=100, socket_options=socket_options, retries=retries)
     return URLFile._pool_manager
 
-  def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None):
+  @staticmethod
+  def executor() -> ThreadPoolExecutor:
+    if URLFile._executor is None:
+      URLFile._executor = ThreadPoolExecutor(max_workers=NUM_FETCH_WORKERS)
+    return URLFile._executor
+
+  @staticmethod
+  def cache() -> DownloadCache:
+    #  One index connection per process, rebuilt if the cache directory moved or was removed
+    root = Paths.download_cache_root()
+    cache = URLFile._download_cache
+    if cache is None or cache.root != root or not os.path.exists(os.path.join(root, "index.db")):
+      os.makedirs(root, exist_ok=True)
+      cache = URLFile._download_cache = DownloadCache(root)
+    return cache
+
+  def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None, readahead: int=0):
     self._url = url
+    #  Bytes past each read that are fetched alongside it, into the cache or an in-memory buffer
+    self._readahead = readahead
+    self._buffer: tuple[int, bytes] = (0, b"")
     self._timeout = Timeout(connect=timeout, read=timeout)
     self._pos = 0
     self._length: int|None = None
@@ -51,7 +89,7 @@ class URLFile:
       self._force_download = not cache
 
     if not self._force_download:
-      os.makedirs(Paths.download_cache_root(), exist_ok=True)
+      self._cache: DownloadCache = URLFile.cache()
 
   def __enter__(self):
     return self
@@ -73,50 +111,115 @@ class URLFile:
     if self._length is not None:
       return self._length
 
-    file_length_path = os.path.join(Paths.download_cache_root(), hash_256(self._url) + "_length")
-    if not self._force_download and os.path.exists(file_length_path):
-      with open(file_length_path) as file_length:
-        content = file_length.read()
-        self._length = int(content)
-        return self._length
+    if not self._force_download and (length := self._cache.get_length(hash_256(self._url))) is not None:
+      self._length = length
+      return self._length
 
     self._length = self.get_length_online()
     if not self._force_download and self._length != -1:
-      with atomic_write_in_dir(file_length_path, mode="w") as file_length:
-        file_length.write(str(self._length))
+      self._cache.set_length(hash_256(self._url), self._length)
     return self._length
 
+  def _fetch_range(self, start: int, end: int) -> bytes:
+    #  Downloads [start, end) without moving the file position
+    headers = {'Range': f"bytes={start}-{end - 1}"}
+
+    if self._debug:
+      t1 = time.time()
+
+    response = self._request('GET', self._url, headers=headers)
+    ret = response.data
+
+    if self._debug:
+      t2 = time.time()
+      if t2 - t1 > 0.1:
+        print(f"get {self._url} {headers!r} {t2 - t1:.3f} slow")
+
+    if response.status != 206:  # Partial Content
+      raise URLFileException(f"Error, requested range but got unexpected response {response.status} {headers} ({self._url}): {repr(ret)[:500]}")
+    if len(ret) != end - start:
+      raise URLFileException(f"Error, requested {end - start} bytes but got {len(ret)} {headers} ({self._url})")
+    return ret
+
+  def _fetch_ranges(self, ranges: list[tuple[int, int]]) -> list[bytes]:
+    if len(ranges) == 1:
+      return [self._fetch_range(*ranges[0])]
+    return list(URLFile.executor().map(lambda r: self._fetch_range(*r), ranges))
+
   def read(self, ll: int|None=None) -> bytes:
     if self._force_download:
+      return self._read_download(ll=ll)
+    return self._read_cached(ll=ll)
+
+  def _read_cached(self, ll: int|None=None, retry: bool=True) -> bytes:
+    file_begin = self._pos
+    length = self.get_length()
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
+    file_end = min(self._pos + ll, length) if ll is not None else length
+    if file_begin >= file_end:
+      return b""
+
+    #  We have to align with chunks we store
+    first_chunk = file_begin // CHUNK_SIZE
+    last_chunk = (file_end - 1) // CHUNK_SIZE
+
+    #  Download missing chunks concurrently, coalescing adjacent ones into single requests.
+    #  Readahead is only done on a miss, so sequential reads fetch in batches.
+    url_hash = hash_256(self._url)
+    last_fetch_chunk = (min(file_end + self._readahead, length) - 1) // CHUNK_SIZE
+    present = self._cache.present_chunks(url_hash, first_chunk, last_fetch_chunk)
+    missing = [c for c in range(first_chunk, last_chunk + 1) if c not in present]
+    if len(missing):
+      missing += [c for c in range(last_chunk + 1, last_fetch_chunk + 1) if c not in present]
+      runs = coalesce_chunks(missing)
+      ranges = [(run[0] * CHUNK_SIZE, min((run[-1] + 1) * CHUNK_SIZE, length)) for run in runs]
+      downloaded = {}
+      for run, data in zip(runs, self._fetch_ranges(ranges), strict=True):
+        for i, chunk in enumerate(run):
+          downloaded[chunk] = data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE]
+      self._cache.write_chunks(url_hash, length, CHUNK_SIZE, downloaded)
+
+    response = self._cache.read(url_hash, file_begin, file_end)
+    if response is None:
+      #  The cached file was removed from under the index, fetch it again once, then read past the cache
+      return self._read_cached(ll=ll, retry=False) if retry else self.read_aux(ll=ll)
+    self._pos = file_end
+    return response
+
+  def _read_download(self, ll: int|None=None) -> bytes:
+    if ll is None or self._readahead <= 0:
+      return self._download(ll=ll)
+
+    buffer_begin, buffer = self._buffer
+    if not (buffer_begin <= self._pos and self._pos + ll <= buffer_begin + len(buffer)):
+      pos = self._pos
+      self._buffer = (pos, self._download(ll=ll + self._readahead))
+      self._pos = pos
+
+    buffer_begin, buffer = self._buffer
+    ret = buffer[self._pos - buffer_begin:self._pos - buffer_begin + ll]
+    self._pos += len(ret)
+    return ret
+
+  def _download(self, ll: int|None=None) -> bytes:
+    #  Large reads are split into ranges that are downloaded concurrently
+    if ll is not None and ll <= MAX_RANGE_CHUNKS * CHUNK_SIZE:
       return self.read_aux(ll=ll)
 
+    length = self.get_length()
     file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
+    file_end = min(self._pos + ll, length) if ll is not None else length
+    if length == -1 or file_end - file_begin <= MAX_RANGE_CHUNKS * CHUNK_SIZE:
+      return self.read_aux(ll=ll)
 
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+    range_size = MAX_RANGE_CHUNKS * CHUNK_SIZE
+    ranges = [(begin, min(begin + range_size, file_end)) for begin in range(file_begin, file_end, range_size)]
+    response = bytearray(file_end - file_begin)
+    for (begin, end), data in zip(ranges, self._fetch_ranges(ranges), strict=True):
+      response[begin - file_begin:end - file_begin] = data
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    self._pos = file_end
+    return bytes(response)
 
   def read_aux(self, ll: int|None=None) -> bytes:
     download_range = False
@@ -126,7 +229,7 @@ class URLFile:
         end = self.get_length() - 1
       else:
         end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
+      if self._pos > end:
         return b""
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True